@@ -0,0 +1,255 @@
+"""
+Functions for aligning overlapping CCD frames
+-Fitting of homography and polynomial warps to control points
+-Tiled, multi-threaded resampling of frames and bad pixel masks
+"""
+
+import os
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+class Warp(object):
+    """
+    Geometric transformation from the pixel coordinates of frame 1 to
+    the pixel coordinates of frame 2, as fitted by fitWarp
+    
+    Pixel coordinates follow the FITS (1-based) convention used by the
+    wcs conversion functions
+    """
+    
+    def __init__(self, model, params, scale=None, order=None):
+        """
+        Parameters
+        ----------
+        model : str
+            Type of warp - 'homography' or 'polynomial'
+        params : array-like
+            3x3 homography matrix, or (n_terms, 2) polynomial
+            coefficients for x and y
+        scale : tuple, optional
+            (x_mid, y_mid, x_half, y_half) normalisation applied to the
+            input coords of a polynomial warp
+            Default = None
+        order : int, optional
+            Order of a polynomial warp
+            Default = None
+        """
+        self.model = model
+        self.params = np.asarray(params, dtype=np.float64)
+        self.scale = scale
+        self.order = order
+        self.rms = None
+        self.inliers = None
+    
+    def __call__(self, x, y):
+        """
+        Apply the warp to pixel coordinates in frame 1
+        
+        Parameters
+        ----------
+        x, y : array-like
+            Pixel coords in frame 1
+        
+        Returns
+        -------
+        x_2, y_2 : array-like
+            Corresponding pixel coords in frame 2
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        
+        if self.model == 'homography':
+            h = self.params
+            w = h[2, 0]*x + h[2, 1]*y + h[2, 2]
+            return ((h[0, 0]*x + h[0, 1]*y + h[0, 2]) / w,
+                    (h[1, 0]*x + h[1, 1]*y + h[1, 2]) / w)
+        
+        terms = _polynomialTerms(x, y, self.order, self.scale)
+        
+        return (np.tensordot(terms, self.params[:, 0], axes=(0, 0)),
+                np.tensordot(terms, self.params[:, 1], axes=(0, 0)))
+
+def fitWarp(x_1, y_1, x_2, y_2, model='homography', order=2,
+            ransac_thresh=None):
+    """
+    Fit a warp mapping control points in frame 1 onto frame 2
+    
+    Parameters
+    ----------
+    x_1, y_1 : array-like
+        Pixel coords of the control points in frame 1
+    x_2, y_2 : array-like
+        Pixel coords of the control points in frame 2
+    model : str, optional
+        Type of warp - 'homography' or 'polynomial'
+        Default = 'homography'
+    order : int, optional
+        Order of the polynomial warp
+        Default = 2
+    ransac_thresh : float, optional
+        Reprojection threshold in pixels for rejecting outlying control
+        points with RANSAC (homography only)
+        Default = None, plain least squares
+    
+    Returns
+    -------
+    warp : Warp object
+        Fitted transformation, with the rms residual in pixels and the
+        mask of control points used
+    
+    Raises
+    ------
+    ValueError
+        If the model is unknown or there are too few control points
+    """
+    src = np.column_stack([x_1, y_1]).astype(np.float64)
+    dst = np.column_stack([x_2, y_2]).astype(np.float64)
+    
+    if model == 'homography':
+        if len(src) < 4:
+            raise ValueError('At least 4 control points are needed')
+        method = 0 if ransac_thresh is None else cv2.RANSAC
+        thresh = 3. if ransac_thresh is None else ransac_thresh
+        h, inliers = cv2.findHomography(src, dst, method, thresh)
+        if h is None:
+            raise ValueError('Homography fit failed')
+        warp = Warp(model, h)
+        inliers = inliers.ravel().astype(bool)
+    
+    elif model == 'polynomial':
+        n_terms = (order + 1) * (order + 2) // 2
+        if len(src) < n_terms:
+            raise ValueError('At least {} control points are '
+                             'needed'.format(n_terms))
+        
+        # normalise coords to [-1, 1] to condition the fit
+        lo, hi = src.min(axis=0), src.max(axis=0)
+        scale = ((lo[0] + hi[0]) / 2., (lo[1] + hi[1]) / 2.,
+                 max((hi[0] - lo[0]) / 2., 1.),
+                 max((hi[1] - lo[1]) / 2., 1.))
+        terms = _polynomialTerms(src[:, 0], src[:, 1], order, scale)
+        coeffs = np.linalg.lstsq(terms.T, dst, rcond=None)[0]
+        warp = Warp(model, coeffs, scale=scale, order=order)
+        inliers = np.ones(len(src), dtype=bool)
+    
+    else:
+        raise ValueError('Unknown warp model {}'.format(model))
+    
+    x_fit, y_fit = warp(src[inliers, 0], src[inliers, 1])
+    warp.rms = float(np.sqrt(np.mean((x_fit - dst[inliers, 0])**2 +
+                                     (y_fit - dst[inliers, 1])**2)))
+    warp.inliers = inliers
+    
+    return warp
+
+def _polynomialTerms(x, y, order, scale):
+    """
+    Stack the monomials x^i y^j (i + j <= order) of normalised coords
+    """
+    u = (x - scale[0]) / scale[2]
+    v = (y - scale[1]) / scale[3]
+    
+    return np.array([u**i * v**j
+                     for i in range(order + 1)
+                     for j in range(order + 1 - i)])
+
+def alignImage(data, warp, shape, mask=None, out=None, tile_rows=256,
+               n_threads=None, interpolation=cv2.INTER_LINEAR,
+               fill=np.nan):
+    """
+    Resample frame 2 onto the pixel grid of frame 1
+    
+    The output is built in blocks of rows on a thread pool, so only
+    the output frame and per-tile coordinate maps are allocated
+    
+    Parameters
+    ----------
+    data : array-like
+        Image data for frame 2 (or the loaded section of it, in which
+        case the warp must map to the coords of that section)
+    warp : Warp object
+        Transformation from frame 1 to frame 2 pixel coords
+    shape : tuple
+        (ny, nx) shape of frame 1
+    mask : array-like, optional
+        Bad pixel mask for frame 2 - resampled through the same warp,
+        with any output pixel touching a bad or missing input pixel
+        flagged as bad
+        Default = None
+    out : array-like, optional
+        Buffer of the given shape in which to place the aligned frame
+        Default = None, a new array is allocated (float64 for float64
+        data, otherwise float32)
+    tile_rows : int, optional
+        Number of output rows resampled per task
+        Default = 256
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    interpolation : int, optional
+        OpenCV interpolation flag
+        Default = cv2.INTER_LINEAR
+    fill : float, optional
+        Value given to output pixels that fall outside frame 2
+        Default = np.nan
+    
+    Returns
+    -------
+    aligned : array-like
+        Frame 2 resampled onto the grid of frame 1
+    aligned_mask : array-like or None
+        Boolean bad pixel mask for the aligned frame, if a mask was
+        given
+    """
+    ny, nx = shape
+    
+    # OpenCV needs contiguous native data of a supported type
+    dtype = np.float64 if data.dtype == np.float64 else np.float32
+    src = np.ascontiguousarray(data, dtype=dtype)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    
+    # bytes keep the mask small, 255 so a small weight still rounds up
+    src_mask, aligned_mask = None, None
+    if mask is not None:
+        src_mask = np.ascontiguousarray(mask, dtype=bool).view(np.uint8)
+        src_mask = src_mask * np.uint8(255)
+        aligned_mask = np.empty(shape, dtype=bool)
+    
+    # FITS pixel coords of the output columns
+    x = np.arange(1, nx + 1, dtype=np.float64)
+    
+    def _remapRows(y0):
+        y1 = min(y0 + tile_rows, ny)
+        y = np.arange(y0 + 1, y1 + 1, dtype=np.float64)
+        xx, yy = np.meshgrid(x, y)
+        map_x, map_y = warp(xx, yy)
+        
+        # back to zero-based array coords for OpenCV
+        map_x = (map_x - 1).astype(np.float32)
+        map_y = (map_y - 1).astype(np.float32)
+        
+        out[y0:y1] = cv2.remap(src,
+                               map_x,
+                               map_y,
+                               interpolation,
+                               borderMode=cv2.BORDER_CONSTANT,
+                               borderValue=fill)
+        if src_mask is not None:
+            bad = cv2.remap(src_mask,
+                            map_x,
+                            map_y,
+                            cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT,
+                            borderValue=255)
+            aligned_mask[y0:y1] = bad > 0
+        
+        return None
+    
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(_remapRows, range(0, ny, tile_rows)))
+    
+    return out, aligned_mask
@@ -0,0 +1,648 @@
+"""
+Reusable sky background models for sequences of exposures
+-Background mesh (back and rms grids) estimated once with SEP
+-Cheap rescale or incremental update for later exposures
+-Automatic full re-estimate when the residual sky drifts
+-In-memory and on-disk cache keyed by CCD and time window
+"""
+
+from frames import toNativeByteOrder
+from instrument import stage, timed, size
+import os
+import sep
+import numpy as np
+from collections import OrderedDict
+from scipy.interpolate import CubicSpline
+from scipy.ndimage import median_filter
+
+class BackgroundModel(object):
+    """
+    Spatially varying sky background stored as SEP's mesh of box
+    values, from which the full resolution background is interpolated
+    with the same natural bicubic spline as sep.Background
+    """
+    
+    def __init__(self, back, rms, shape, box_width=32, box_height=32,
+                 filter_width=3, filter_height=3, globalrms=None):
+        """
+        Parameters
+        ----------
+        back : array-like
+            Background level at the centre of each box
+        rms : array-like
+            Background noise at the centre of each box
+        shape : tuple
+            (ny, nx) shape of the frames the model applies to
+        box_width, box_height : int, optional
+            Size of the background boxes in pixels
+            Default = 32
+        filter_width, filter_height : int, optional
+            Size of the median filter applied to the mesh, in boxes
+            Default = 3
+        globalrms : float, optional
+            Global rms of the background
+            Default = None, the mean of the rms mesh
+        """
+        self.back_mesh = np.asarray(back, dtype=np.float32)
+        self.rms_mesh = np.asarray(rms, dtype=np.float32)
+        self.shape = tuple(int(n) for n in shape)
+        self.box_width = int(box_width)
+        self.box_height = int(box_height)
+        self.filter_width = int(filter_width)
+        self.filter_height = int(filter_height)
+        if globalrms is None:
+            globalrms = float(np.mean(self.rms_mesh))
+        self.globalrms = float(globalrms)
+    
+    @classmethod
+    @timed('background_model',
+           counts=lambda cls, data, *a, **k: {'pixels': size(data)})
+    def estimate(cls, data, mask=None, box_width=32, box_height=32,
+                 filter_width=3, filter_height=3):
+        """
+        Estimate the background of a frame with sep.Background
+        
+        Parameters
+        ----------
+        data : array-like
+            CCD data for which to model the background
+        mask : array-like, optional
+            Bad pixel mask for the CCD frame
+            Default = None
+        box_width, box_height : int, optional
+            Size of the background boxes in pixels
+            Default = 32
+        filter_width, filter_height : int, optional
+            Size of the median filter applied to the mesh, in boxes
+            Default = 3
+        
+        Returns
+        -------
+        model : BackgroundModel object
+            Background model of the frame
+        back : array-like
+            Full resolution background of the frame
+        """
+        data = toNativeByteOrder(data)
+        if mask is not None:
+            mask = toNativeByteOrder(mask)
+        
+        with stage('sep_background', pixels=data.size):
+            bkg = sep.Background(data,
+                                 mask=mask,
+                                 bw=box_width,
+                                 bh=box_height,
+                                 fw=filter_width,
+                                 fh=filter_height)
+        back = bkg.back(dtype=np.float32)
+        
+        # sep does not expose its mesh, but its spline passes through
+        # the mesh values at the box centres, which fall between pixels
+        ys = _centrePixels(data.shape[0], box_height)
+        xs = _centrePixels(data.shape[1], box_width)
+        rms = bkg.rms(dtype=np.float32)
+        model = cls(_sampleCentres(back, ys, xs),
+                    _sampleCentres(rms, ys, xs),
+                    data.shape,
+                    box_width=box_width,
+                    box_height=box_height,
+                    filter_width=filter_width,
+                    filter_height=filter_height,
+                    globalrms=bkg.globalrms)
+        
+        return model, back
+    
+    def back(self, step=1):
+        """
+        Evaluate the background at full resolution
+        
+        Parameters
+        ----------
+        step : int, optional
+            Evaluate only every step'th pixel in each direction - must
+            divide the box size
+            Default = 1
+        
+        Returns
+        -------
+        back : array-like
+            Background level at each (sampled) pixel
+        """
+        return _bicubic(self.back_mesh,
+                        self.box_width,
+                        self.box_height,
+                        self.shape,
+                        step)
+    
+    def rms(self, step=1):
+        """
+        Evaluate the background noise at full resolution
+        
+        Parameters
+        ----------
+        step : int, optional
+            Evaluate only every step'th pixel in each direction - must
+            divide the box size
+            Default = 1
+        
+        Returns
+        -------
+        rms : array-like
+            Background noise at each (sampled) pixel
+        """
+        return _bicubic(self.rms_mesh,
+                        self.box_width,
+                        self.box_height,
+                        self.shape,
+                        step)
+    
+    def matches(self, shape, box_width=32, box_height=32, filter_width=3,
+                filter_height=3):
+        """
+        Whether the model can be applied to a frame with the given shape
+        and background parameters
+        
+        Parameters
+        ----------
+        shape : tuple
+            (ny, nx) shape of the frame
+        box_width, box_height, filter_width, filter_height : int
+            Background parameters, as for estimate
+        
+        Returns
+        -------
+        matches : bool
+            True if the model has the same shape and parameters
+        """
+        return (tuple(shape) == self.shape and
+                (box_width, box_height, filter_width, filter_height) ==
+                (self.box_width, self.box_height,
+                 self.filter_width, self.filter_height))
+    
+    def residual(self, data, mask=None, step=4):
+        """
+        Measure the background left in a frame by the model, as a median
+        in each box of a regular subsample of its pixels
+        
+        Parameters
+        ----------
+        data : array-like
+            CCD data the model is compared with
+        mask : array-like, optional
+            Bad pixel mask for the CCD frame
+            Default = None
+        step : int, optional
+            Use every step'th pixel in each direction - reduced to a 
+            divisor of the box size if need be
+            Default = 4
+        
+        Returns
+        -------
+        resid_mesh : array-like
+            Median residual in each box, on the same grid as the mesh
+        noise : float
+            Robust estimate of the per-pixel noise in the residuals
+        per_box : int
+            Number of pixels sampled in each box
+        
+        Raises
+        ------
+        ValueError
+            If the frame is smaller than one background box
+        """
+        ny, nx = self.shape
+        bw, bh = self.box_width, self.box_height
+        step = int(np.gcd(np.gcd(step, bw), bh))
+        n_y, n_x = ny // bh, nx // bw
+        if n_y == 0 or n_x == 0:
+            raise ValueError('Frame smaller than one background box')
+        
+        # whole boxes only - partial boxes at the edges take the value
+        # of their neighbour
+        back = self.back(step=step)[:n_y*bh // step, :n_x*bw // step]
+        sample = data[:n_y*bh:step, :n_x*bw:step] - back
+        bad = ~np.isfinite(sample)
+        if mask is not None:
+            bad |= mask[:n_y*bh:step, :n_x*bw:step].astype(bool)
+        if bad.any():
+            sample[bad] = 0.
+        
+        def _byBox(a):
+            a = a.reshape(n_y, bh // step, n_x, bw // step)
+            return a.transpose(0, 2, 1, 3).reshape(n_y, n_x, -1)
+        
+        boxes = _byBox(sample)
+        medians = np.median(boxes, axis=2)
+        
+        resid_mesh = np.empty(self.back_mesh.shape, dtype=np.float32)
+        resid_mesh[:n_y, :n_x] = medians
+        resid_mesh[n_y:, :n_x] = medians[-1:, :]
+        resid_mesh[:, n_x:] = resid_mesh[:, n_x - 1:n_x]
+        
+        deviations = boxes - medians[:, :, np.newaxis]
+        noise = 1.4826 * np.median(np.abs(deviations[~_byBox(bad)]))
+        
+        return resid_mesh, float(noise), boxes.shape[2]
+    
+    def update(self, data, mask=None, mode='rescale', step=4,
+               recompute_threshold=0.25):
+        """
+        Subtract the model from a later exposure, correcting it for
+        changes in the sky with a rescale or incremental update
+        
+        The residual background is measured in each box on a subsample
+        of pixels. In 'rescale' mode the model is scaled and offset to
+        fit the residuals; in 'incremental' mode the (median filtered)
+        residuals are added to the mesh. If the residual structure left
+        after the correction exceeds recompute_threshold times the
+        background rms, the background is re-estimated from scratch.
+        
+        Parameters
+        ----------
+        data : array-like
+            CCD data from which to subtract the background
+        mask : array-like, optional
+            Bad pixel mask for the CCD frame
+            Default = None
+        mode : str, optional
+            'rescale' or 'incremental'
+            Default = 'rescale'
+        step : int, optional
+            Sample every step'th pixel in each direction to measure the
+            residual background
+            Default = 4
+        recompute_threshold : float, optional
+            Largest rms of the corrected residual background, in units
+            of the background rms, before a full re-estimate
+            Default = 0.25
+        
+        Returns
+        -------
+        model : BackgroundModel object
+            Updated model - self, or a new model if re-estimated
+        data_sub : array-like
+            Data array with background signal subtracted
+        bkg_rms : float
+            Global rms of the background
+        recomputed : bool
+            True if the background was re-estimated from scratch
+        
+        Raises
+        ------
+        ValueError
+            If the frame does not match the model's shape, or the mode
+            is not recognised
+        """
+        if mode not in ('rescale', 'incremental'):
+            raise ValueError('Unknown update mode {}'.format(mode))
+        data = toNativeByteOrder(data)
+        if tuple(data.shape) != self.shape:
+            raise ValueError('Frame shape {} does not match model shape '
+                             '{}'.format(data.shape, self.shape))
+        
+        with stage('background_update', pixels=data.size) as s:
+            resid_mesh, noise, per_box = self.residual(data, 
+                                                       mask=mask, 
+                                                       step=step)
+            
+            # least squares fit of resid = dscale*(back - mean) + offset,
+            # centred so a flat sky does not make the terms degenerate
+            mean = float(np.mean(self.back_mesh))
+            design = np.column_stack([self.back_mesh.ravel() - mean,
+                                      np.ones(self.back_mesh.size)])
+            (dscale, offset), _, _, _ = np.linalg.lstsq(design,
+                                                        resid_mesh.ravel(),
+                                                        rcond=None)
+            if mode == 'rescale':
+                correction = dscale*(self.back_mesh - mean) + offset
+            else:
+                correction = median_filter(resid_mesh,
+                                           size=(self.filter_height,
+                                                 self.filter_width),
+                                           mode='nearest')
+            
+            # structure the correction cannot follow, less the noise of
+            # the box medians (~1.25 sigma / sqrt(samples per box))
+            left = resid_mesh - correction
+            expected = 1.25 * noise / np.sqrt(per_box)
+            drift = np.sqrt(max(np.mean((left - np.median(left))**2) -
+                                expected**2, 0.)) / max(noise, 1e-12)
+            s['drift'] = drift
+            
+            if drift > recompute_threshold:
+                s['action'] = 'recompute'
+                model, back = BackgroundModel.estimate(
+                    data,
+                    mask=mask,
+                    box_width=self.box_width,
+                    box_height=self.box_height,
+                    filter_width=self.filter_width,
+                    filter_height=self.filter_height)
+                data_sub = np.subtract(data, back, out=back)
+                return model, data_sub, model.globalrms, True
+            
+            # the spline is linear in the mesh, so correcting the mesh
+            # corrects the full resolution background
+            s['action'] = mode
+            self.back_mesh = (self.back_mesh + correction).astype(np.float32)
+            self.globalrms = noise
+            back = self.back()
+            data_sub = np.subtract(data, back, out=back)
+        
+        return self, data_sub, self.globalrms, False
+    
+    def save(self, filepath):
+        """
+        Save the model to a numpy .npz file
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the output file
+        
+        Returns
+        -------
+        None
+        """
+        np.savez(filepath,
+                 back=self.back_mesh,
+                 rms=self.rms_mesh,
+                 shape=np.array(self.shape),
+                 box=np.array([self.box_width, self.box_height]),
+                 filter=np.array([self.filter_width, self.filter_height]),
+                 globalrms=self.globalrms)
+        
+        return None
+    
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a model saved with save
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the .npz file
+        
+        Returns
+        -------
+        model : BackgroundModel object
+            Restored model
+        """
+        with np.load(filepath) as f:
+            return cls(f['back'],
+                       f['rms'],
+                       tuple(f['shape']),
+                       box_width=int(f['box'][0]),
+                       box_height=int(f['box'][1]),
+                       filter_width=int(f['filter'][0]),
+                       filter_height=int(f['filter'][1]),
+                       globalrms=float(f['globalrms']))
+
+class BackgroundCache(object):
+    """
+    Background models keyed by CCD and time window, held in memory and
+    optionally on disk, so that exposures close in time reuse a model
+    rather than re-estimating the background
+    """
+    
+    def __init__(self, window=1800., cache_dir=None, mode='rescale',
+                 recompute_threshold=0.25, max_models=64, **bkg_kwargs):
+        """
+        Parameters
+        ----------
+        window : float, optional
+            Length of the time windows in seconds - exposures in the
+            same window share a model
+            Default = 1800.
+        cache_dir : str, optional
+            Directory in which models are saved
+            Default = None, memory only
+        mode : str, optional
+            Update mode, 'rescale' or 'incremental' (see
+            BackgroundModel.update)
+            Default = 'rescale'
+        recompute_threshold : float, optional
+            Drift in the residual background, in units of the
+            background rms, that triggers a full re-estimate
+            Default = 0.25
+        max_models : int, optional
+            Number of models held in memory, least recently used first
+            out
+            Default = 64
+        **bkg_kwargs
+            Background parameters (box_width, box_height, filter_width,
+            filter_height) passed to BackgroundModel.estimate
+        """
+        self.window = float(window)
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.recompute_threshold = recompute_threshold
+        self.max_models = max_models
+        self.bkg_kwargs = bkg_kwargs
+        self.counts = {'estimate': 0, 'update': 0, 'recompute': 0}
+        self._models = OrderedDict()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    
+    def key(self, ccd, time):
+        """
+        Cache key for an exposure
+        
+        Parameters
+        ----------
+        ccd : int or str
+            CCD (or HDU) the exposure was taken with
+        time : float
+            Time of the exposure in seconds, e.g. MJD-OBS * 86400
+        
+        Returns
+        -------
+        key : tuple
+            (ccd, window index)
+        """
+        return str(ccd), int(np.floor(time / self.window))
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir,
+                            'bkg_{}_{}.npz'.format(*key))
+    
+    def get(self, ccd, time):
+        """
+        Look up the model for an exposure
+        
+        Parameters
+        ----------
+        ccd : int or str
+            CCD the exposure was taken with
+        time : float
+            Time of the exposure in seconds
+        
+        Returns
+        -------
+        model : BackgroundModel object
+            Cached model, or None
+        """
+        key = self.key(ccd, time)
+        model = self._models.get(key)
+        if model is None and self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                model = BackgroundModel.load(path)
+        if model is not None:
+            self._remember(key, model)
+        
+        return model
+    
+    def put(self, ccd, time, model):
+        """
+        Store the model for an exposure
+        
+        Parameters
+        ----------
+        ccd : int or str
+            CCD the exposure was taken with
+        time : float
+            Time of the exposure in seconds
+        model : BackgroundModel object
+            Model to store
+        
+        Returns
+        -------
+        None
+        """
+        key = self.key(ccd, time)
+        self._remember(key, model)
+        if self.cache_dir is not None:
+            # written aside and renamed, as other processes may share
+            # the directory
+            path = self._path(key)
+            model.save(path + '.tmp.npz')
+            os.replace(path + '.tmp.npz', path)
+        
+        return None
+    
+    def _remember(self, key, model):
+        self._models[key] = model
+        self._models.move_to_end(key)
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+    
+    def subtract(self, data, ccd, time, mask=None):
+        """
+        Subtract the background from an exposure, reusing the cached
+        model for its CCD and time window where possible
+        
+        Parameters
+        ----------
+        data : array-like
+            CCD data from which to subtract the background
+        ccd : int or str
+            CCD the exposure was taken with
+        time : float
+            Time of the exposure in seconds
+        mask : array-like, optional
+            Bad pixel mask for the CCD frame
+            Default = None
+        
+        Returns
+        -------
+        data_sub : array-like
+            Data array with background signal subtracted
+        bkg_rms : float
+            Global rms of the background, as for subtractBackground
+        """
+        model = self.get(ccd, time)
+        if model is not None and not model.matches(data.shape,
+                                                   **self.bkg_kwargs):
+            model = None
+        
+        if model is None:
+            model, back = BackgroundModel.estimate(data,
+                                                   mask=mask,
+                                                   **self.bkg_kwargs)
+            data_sub = np.subtract(toNativeByteOrder(data), back, out=back)
+            bkg_rms = model.globalrms
+            self.counts['estimate'] += 1
+        else:
+            model, data_sub, bkg_rms, recomputed = model.update(
+                data,
+                mask=mask,
+                mode=self.mode,
+                recompute_threshold=self.recompute_threshold)
+            self.counts['recompute' if recomputed else 'update'] += 1
+        self.put(ccd, time, model)
+        
+        return data_sub, bkg_rms
+
+def _centrePixels(n, box):
+    """
+    Coordinates of the box centres along an axis of n pixels
+    """
+    return (np.arange(-(-n // box)) + 0.5)*box - 0.5
+
+def _sampleCentres(image, ys, xs):
+    """
+    Value of a smooth full resolution image at the box centres,
+    averaging the pixels either side of each half-pixel centre
+    """
+    ny, nx = image.shape
+    y0 = np.clip(np.floor(ys).astype(np.intp), 0, ny - 1)
+    y1 = np.clip(np.ceil(ys).astype(np.intp), 0, ny - 1)
+    x0 = np.clip(np.floor(xs).astype(np.intp), 0, nx - 1)
+    x1 = np.clip(np.ceil(xs).astype(np.intp), 0, nx - 1)
+    
+    return 0.25*(image[np.ix_(y0, x0)] + image[np.ix_(y0, x1)] +
+                 image[np.ix_(y1, x0)] + image[np.ix_(y1, x1)])
+
+def _bicubic(mesh, box_width, box_height, shape, step=1):
+    """
+    Natural bicubic spline through a mesh of box values, evaluated at
+    every step'th pixel of a frame, one axis at a time
+    """
+    columns = _splineRows(mesh.T, box_height, shape[0], step)
+    
+    return _splineRows(np.ascontiguousarray(columns.T),
+                       box_width,
+                       shape[1],
+                       step)
+
+def _splineRows(values, box, n, step=1):
+    """
+    Natural cubic spline along each row of a mesh, evaluated at every
+    step'th pixel of n
+    
+    As the box centres are evenly spaced, the pixels between each pair
+    of centres sit at the same offsets, so the spline polynomials are
+    evaluated for all rows and intervals with one matrix product
+    """
+    rows, m = values.shape
+    centres = _centrePixels(m*box, box)
+    out = np.empty((rows, len(range(0, n, step))), dtype=np.float32)
+    if m < 2:
+        out[...] = values[:, :1]
+        return out
+    
+    spline = CubicSpline(centres, values, axis=1, bc_type='natural')
+    coeffs = np.ascontiguousarray(spline.c.transpose(2, 1, 0),
+                                  dtype=np.float32)
+    
+    # first sampled pixel after the first centre, and the offsets of
+    # the pixels in each interval
+    first = int(np.ceil(centres[0] / step))*step
+    t = first - centres[0] + np.arange(0, box, step)
+    powers = np.vstack([t**3, t**2, t, np.ones_like(t)]).astype(np.float32)
+    main = np.dot(coeffs.reshape(-1, 4), powers).reshape(rows, -1)
+    
+    i0 = first // step
+    i1 = min(i0 + main.shape[1], out.shape[1])
+    out[:, i0:i1] = main[:, :i1 - i0]
+    
+    # extrapolate the end polynomials over the half boxes at the edges
+    for i in list(range(0, i0)) + list(range(i1, out.shape[1])):
+        k = 0 if i < i0 else m - 2
+        dt = i*step - centres[k]
+        c = coeffs[:, k, :]
+        out[:, i] = ((c[:, 0]*dt + c[:, 1])*dt + c[:, 2])*dt + c[:, 3]
+    
+    return out
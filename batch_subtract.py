@@ -0,0 +1,408 @@
+"""
+Align and subtract many pairs of CCD frames listed in a manifest
+-CSV or JSON manifest of frame pairs, WCS solutions and HDUs
+-Every CCD of every pair run concurrently on a process pool
+-Per-CCD status and timing report, from which failed pairs are retried
+"""
+
+from image_subtract import subtractPair
+from extract import _imageHDUs
+from instrument import enable
+import os
+import csv
+import json
+import time
+import argparse as ap
+import numpy as np
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+    )
+from concurrent.futures.process import BrokenProcessPool
+
+# columns of the manifest - hdu columns and paths may hold ';'-separated
+# lists, and paths may contain {hdu}, filled in for each CCD
+MANIFEST_COLUMNS = ('id', 'img_1', 'img_2', 'wcs_1', 'wcs_2', 'bp_mask',
+                    'hdu_1', 'hdu_2', 'mask_hdu', 'out')
+
+REPORT_COLUMNS = ('id', 'hdu', 'status', 'seconds', 'out', 'warp_rms',
+                  'points', 'sources', 'error')
+
+def argParse():
+    """
+    Argument parser settings
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    args : array-like
+        Array of command line arguments
+    """
+    parser = ap.ArgumentParser()
+    
+    parser.add_argument('manifest',
+                        help='CSV or JSON file listing the frame pairs',
+                        type=str)
+    
+    parser.add_argument('--out_dir',
+                        help='directory for difference images without an '
+                             'out path in the manifest',
+                        type=str,
+                        default='.')
+    
+    parser.add_argument('--report',
+                        help='path of the status and timing report',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--workers',
+                        help='number of worker processes',
+                        type=int,
+                        default=None)
+    
+    parser.add_argument('--force',
+                        help='redo CCDs already done in the report?',
+                        action='store_true')
+    
+    parser.add_argument('--float32',
+                        help='load frames as float32 to save memory?',
+                        action='store_true')
+    
+    parser.add_argument('--roi',
+                        help='only read the section of frame 2 that '
+                             'overlaps frame 1?',
+                        action='store_true')
+    
+    parser.add_argument('--warp',
+                        help='model used to align frame 2 to frame 1',
+                        choices=['homography', 'polynomial'],
+                        default='homography')
+    
+    parser.add_argument('--trace',
+                        help='file to which per-stage timings are '
+                             'written as JSON lines (- for stderr)',
+                        type=str,
+                        default=None)
+    
+    return parser.parse_args()
+
+def readManifest(filepath):
+    """
+    Read the frame pairs listed in a manifest
+    
+    A CSV manifest has a header row naming MANIFEST_COLUMNS, of which
+    img_1, img_2, wcs_1, wcs_2 and bp_mask are required. A JSON
+    manifest is a list of objects with the same keys, where the HDU
+    entries may also be lists.
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the manifest (.csv or .json)
+    
+    Returns
+    -------
+    pairs : list
+        Dictionary of the manifest entries for each pair
+    
+    Raises
+    ------
+    ValueError
+        If a required column is missing or an id is repeated
+    """
+    if os.path.splitext(filepath)[1].lower() == '.json':
+        with open(filepath) as f:
+            pairs = json.load(f)
+    else:
+        with open(filepath, newline='') as f:
+            pairs = [row for row in csv.DictReader(f)]
+    
+    ids = set()
+    for i, pair in enumerate(pairs):
+        for key in ('img_1', 'img_2', 'wcs_1', 'wcs_2', 'bp_mask'):
+            if not pair.get(key):
+                raise ValueError('Manifest entry {} has no {}'.format(i,
+                                                                      key))
+        if not pair.get('id'):
+            pair['id'] = str(i)
+        pair['id'] = str(pair['id'])
+        if pair['id'] in ids:
+            raise ValueError('Repeated id {} in manifest'.format(pair['id']))
+        ids.add(pair['id'])
+    
+    return pairs
+
+def _hduList(value):
+    """
+    HDU selections from a manifest entry - a list, or a ';'-separated
+    string of indices or EXTNAMEs
+    """
+    if value is None or value == '':
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = str(value).split(';')
+    
+    return [int(v) if str(v).strip().isdigit() else str(v).strip()
+            for v in value]
+
+def pairJobs(pair, out_dir='.'):
+    """
+    Split a manifest entry into one job per CCD
+    
+    Without HDU selections, every image HDU of frame 1 is paired with
+    the same HDU of frame 2 and the mask. When there are several CCDs
+    and the out path has no {hdu}, _{hdu} is added before its
+    extension so each CCD gets its own difference image
+    
+    Parameters
+    ----------
+    pair : dict
+        Manifest entry, from readManifest
+    out_dir : str, optional
+        Directory for difference images without an out path
+        Default = '.'
+    
+    Returns
+    -------
+    jobs : list
+        Keyword arguments for subtractPair for each CCD, with the pair
+        id and a CCD label (hdu) added
+    
+    Raises
+    ------
+    ValueError
+        If the HDU lists differ in length
+    """
+    hdus_1 = _hduList(pair.get('hdu_1'))
+    if hdus_1 is None:
+        hdus_1 = _imageHDUs(pair['img_1'])
+    hdus_2 = _hduList(pair.get('hdu_2')) or hdus_1
+    mask_hdus = _hduList(pair.get('mask_hdu')) or hdus_1
+    if not len(hdus_1) == len(hdus_2) == len(mask_hdus):
+        raise ValueError('HDU lists of pair {} differ in '
+                         'length'.format(pair['id']))
+    
+    out = pair.get('out') or os.path.join(out_dir,
+                                          '{}_{{hdu}}_diff.fits'.format(
+                                              pair['id']))
+    if len(hdus_1) > 1 and '{hdu}' not in out:
+        root, ext = os.path.splitext(out)
+        out = root + '_{hdu}' + ext
+    jobs = []
+    for hdu_1, hdu_2, mask_hdu in zip(hdus_1, hdus_2, mask_hdus):
+        _fill = lambda path: path.replace('{hdu}', str(hdu_1))
+        jobs.append({'id': pair['id'],
+                     'hdu': str(hdu_1),
+                     'img_1': _fill(pair['img_1']),
+                     'img_2': _fill(pair['img_2']),
+                     'wcs_1': _fill(pair['wcs_1']),
+                     'wcs_2': _fill(pair['wcs_2']),
+                     'bp_mask': _fill(pair['bp_mask']),
+                     'out': _fill(out),
+                     'hdu_1': hdu_1,
+                     'hdu_2': hdu_2,
+                     'mask_hdu': mask_hdu})
+    
+    return jobs
+
+def readReport(filepath):
+    """
+    Read a status report written by runBatch
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the report
+    
+    Returns
+    -------
+    report : dict
+        Report row for each (id, hdu), empty if there is no report
+    """
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, newline='') as f:
+        return {(row['id'], row['hdu']): row for row in csv.DictReader(f)}
+
+def writeReport(filepath, report):
+    """
+    Write a status report, replacing any previous one in a single step
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the report
+    report : dict
+        Report row for each (id, hdu)
+    
+    Returns
+    -------
+    None
+    """
+    tmp = filepath + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+        writer.writeheader()
+        for key in sorted(report):
+            writer.writerow({c: report[key].get(c, '')
+                             for c in REPORT_COLUMNS})
+    os.replace(tmp, filepath)
+    
+    return None
+
+def _runJob(job, options):
+    """
+    Worker task for runBatch - subtract one CCD of a pair, returning a
+    report row rather than raising
+    """
+    start = time.perf_counter()
+    row = {'id': job['id'], 'hdu': job['hdu'], 'out': job['out']}
+    kwargs = {k: v for k, v in job.items() if k not in ('id', 'hdu')}
+    try:
+        info = subtractPair(verbose=False, **dict(kwargs, **options))
+        row.update(status='done',
+                   warp_rms='{:.4f}'.format(info['warp_rms']),
+                   points=info['points'],
+                   sources=info['sources'],
+                   error='')
+    except Exception as e:
+        row.update(status='failed',
+                   error='{}: {}'.format(type(e).__name__, e))
+    row['seconds'] = '{:.2f}'.format(time.perf_counter() - start)
+    
+    return row
+
+def runBatch(jobs, report_path, n_workers=None, force=False, **options):
+    """
+    Run subtraction jobs on a pool of worker processes, skipping those
+    already done according to the report, and keep the report up to
+    date as each finishes
+    
+    If a worker process dies, the jobs on its pool are reported as 
+    failed and the remaining jobs run on a new pool
+    
+    Parameters
+    ----------
+    jobs : list
+        Jobs from pairJobs
+    report_path : str
+        Path to the status report, read first if it exists
+    n_workers : int, optional
+        Number of worker processes
+        Default = None, one per CPU
+    force : bool, optional
+        Toggle to redo jobs already done
+        Default = False
+    **options
+        Keyword arguments for subtractPair (dtype, roi, warp_model)
+    
+    Yields
+    ------
+    row : dict
+        Report row for each job run, in order of completion
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    
+    report = readReport(report_path)
+    todo = []
+    for job in jobs:
+        previous = report.get((job['id'], job['hdu']))
+        if not force and previous is not None and \
+           previous['status'] == 'done' and os.path.exists(job['out']):
+            continue
+        report[(job['id'], job['hdu'])] = {'id': job['id'],
+                                           'hdu': job['hdu'],
+                                           'status': 'pending',
+                                           'out': job['out']}
+        todo.append(job)
+    writeReport(report_path, report)
+    
+    def _record(future, job):
+        try:
+            row = future.result()
+        except BrokenProcessPool as e:
+            # a worker process died (e.g. killed for using too much 
+            # memory), failing every job still on the pool
+            row = {'id': job['id'],
+                   'hdu': job['hdu'],
+                   'out': job['out'],
+                   'status': 'failed',
+                   'error': '{}: {}'.format(type(e).__name__, e)}
+        report[(row['id'], row['hdu'])] = row
+        writeReport(report_path, report)
+        return row
+    
+    # keep a bounded queue of work so results stream back steadily, 
+    # replacing the pool if a worker dies
+    pool = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        pending = {}
+        for job in todo:
+            if len(pending) >= 2 * n_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _record(future, pending.pop(future))
+            try:
+                future = pool.submit(_runJob, job, options)
+            except BrokenProcessPool:
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=n_workers)
+                future = pool.submit(_runJob, job, options)
+            pending[future] = job
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield _record(future, pending.pop(future))
+    finally:
+        pool.shutdown(wait=True)
+
+if __name__ == "__main__":
+	
+	args = argParse()
+	if args.trace is not None:
+		enable(args.trace)
+	
+	report_path = args.report
+	if report_path is None:
+		report_path = os.path.join(args.out_dir, 'report.csv')
+	if not os.path.isdir(args.out_dir):
+		os.makedirs(args.out_dir)
+	
+	jobs = []
+	for pair in readManifest(args.manifest):
+		try:
+			jobs.extend(pairJobs(pair, out_dir=args.out_dir))
+		except (OSError, KeyError, ValueError) as e:
+			print('Skipping pair {}: {}'.format(pair['id'], e))
+	
+	start = time.perf_counter()
+	n_done, n_failed = 0, 0
+	for row in runBatch(jobs,
+	                    report_path,
+	                    n_workers=args.workers,
+	                    force=args.force,
+	                    dtype=np.float32 if args.float32 else np.float64,
+	                    roi=args.roi,
+	                    warp_model=args.warp):
+		if row['status'] == 'done':
+			n_done += 1
+			print('{} [{}] done in {} s'.format(row['id'],
+			                                    row['hdu'],
+			                                    row['seconds']))
+		else:
+			n_failed += 1
+			print('{} [{}] failed: {}'.format(row['id'],
+			                                  row['hdu'],
+			                                  row['error']))
+	
+	print('{} done, {} failed, {} skipped in {:.1f} s - report written to '
+	      '{}'.format(n_done,
+	                  n_failed,
+	                  len(jobs) - n_done - n_failed,
+	                  time.perf_counter() - start,
+	                  report_path))
@@ -0,0 +1,316 @@
+"""
+Benchmarks for the pyCCD pipeline stages on synthetic frames
+-Wall clock time (best of several runs) and peak memory per stage
+-Several frame sizes, up to a full INT WFC frame
+-Comparison against a saved baseline to catch regressions
+"""
+
+from synthetic import makeFrame, wcsHeader, detectorHeader, FRAME_SHAPE
+from extract import subtractBackground, subtractBackgroundTiled, sourceExtract
+from wcs import (
+    convertToDetector,
+    convertToWCS,
+    convertToPixels,
+    pixelToPixel,
+    clearWCSCache,
+    ApproxWCS,
+    )
+from image_subtract import sampleOverlap
+from align import fitWarp, alignImage
+from psfmatch import subtractImages
+import argparse as ap
+import numpy as np
+import tracemalloc
+import json
+import time
+import sys
+
+def argParse():
+    """
+    Argument parser settings
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    args : array-like
+        Array of command line arguments
+    """
+    parser = ap.ArgumentParser()
+    
+    parser.add_argument('--sizes',
+                        help='frame sizes - side length in pixels or '
+                             '"full" for an 8176x6132 frame',
+                        nargs='+',
+                        default=['1024', '2048'])
+    
+    parser.add_argument('--stages',
+                        help='only run these stages',
+                        nargs='+',
+                        default=None)
+    
+    parser.add_argument('--repeat',
+                        help='number of timed runs per stage',
+                        type=int,
+                        default=3)
+    
+    parser.add_argument('--json',
+                        help='path to which results are written',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--baseline',
+                        help='results file to compare against',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--tolerance',
+                        help='fractional slowdown or memory growth '
+                             'flagged as a regression',
+                        type=float,
+                        default=0.2)
+    
+    return parser.parse_args()
+
+def frameShape(size):
+    """
+    Shape of the frame for a --sizes entry
+    
+    Parameters
+    ----------
+    size : str
+        Side length in pixels, or 'full'
+    
+    Returns
+    -------
+    shape : tuple
+        (ny, nx) shape of the frame
+    """
+    if size == 'full':
+        return FRAME_SHAPE
+    
+    return (int(size), int(size))
+
+def measure(func, repeat=3):
+    """
+    Time a function and measure the peak memory it allocates
+    
+    The timed runs are made without tracing, then one further run is
+    made under tracemalloc (which numpy reports its buffers to) to find
+    the peak - memory allocated directly by C libraries such as sep is
+    not seen
+    
+    Parameters
+    ----------
+    func : callable
+        Function of no arguments to benchmark
+    repeat : int, optional
+        Number of timed runs
+        Default = 3
+    
+    Returns
+    -------
+    seconds : float
+        Fastest wall clock time of the runs
+    peak_mb : float
+        Peak memory allocated during a run, in MB
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    return min(times), peak / 1024.**2
+
+def pipelineStages(shape, seed=0):
+    """
+    Build the synthetic inputs and benchmark functions for a frame size
+    
+    Parameters
+    ----------
+    shape : tuple
+        (ny, nx) shape of the frame
+    seed : int, optional
+        Seed for the synthetic frames
+        Default = 0
+    
+    Returns
+    -------
+    stages : list
+        (name, function) pairs in pipeline order
+    """
+    ny, nx = shape
+    n_stars = max(int(nx * ny / 1e4), 50)
+    
+    # frame 2 sees the same stars shifted, in worse seeing
+    data_1, mask, stars = makeFrame(shape=shape, n_stars=n_stars, seed=seed)
+    shifted = (stars[0] + 3.3, stars[1] - 2.1, stars[2])
+    data_2, mask_2, _ = makeFrame(shape=shape,
+                                  stars=shifted,
+                                  fwhm=3.6,
+                                  seed=seed + 1)
+    hdr = wcsHeader(150., 20., shape=shape)
+    
+    data_sub, bkg_rms = subtractBackground(data_1, mask=mask)
+    sources = sourceExtract(data_sub, bkg_rms=bkg_rms, mask=mask)
+    
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(1, nx, 100000)
+    y = rng.uniform(1, ny, 100000)
+    ra, dec = convertToWCS(x, y, hdr)
+    approx = ApproxWCS(hdr, shape=shape)
+    
+    # a second CCD offset by half a frame along x, and a second pointing
+    # of the detector plane, for the frame to frame transforms
+    det_1 = detectorHeader(shape)
+    det_2 = detectorHeader(shape, x_offset=nx / 2., y_offset=ny / 8.)
+    for det in (det_1, det_2):
+        det['NAXIS1'], det['NAXIS2'] = nx, ny
+    wcs_1 = wcsHeader(150., 20., shape=(2*ny, 2*nx))
+    wcs_2 = wcsHeader(150.001, 20.001, shape=(2*ny, 2*nx), rot=0.2)
+    
+    warp = fitWarp(stars[0], stars[1], shifted[0], shifted[1])
+    aligned_2, aligned_mask = alignImage(data_2, warp, shape, mask=mask_2)
+    aligned_2 = aligned_2 - np.nanmedian(aligned_2)
+    
+    # small frames hold too few isolated stars for a 2nd order kernel
+    spatial_order = 1 if min(shape) < 2048 else 2
+    
+    def _wcsToWorld():
+        clearWCSCache()
+        convertToWCS(x, y, hdr)
+    
+    def _wcsToPixels():
+        clearWCSCache()
+        convertToPixels(ra, dec, hdr)
+    
+    def _approxWCS():
+        ApproxWCS(hdr, shape=shape).pixToWorld(x, y)
+    
+    def _toDetector():
+        clearWCSCache()
+        convertToDetector(x, y, det_2)
+    
+    def _pixelToPixel():
+        clearWCSCache()
+        pixelToPixel(x, y, det_1, wcs_1, wcs_2, det_2)
+    
+    def _sampleOverlap():
+        clearWCSCache()
+        sampleOverlap(det_1, wcs_1, wcs_2, det_2)
+    
+    return [
+        ('background', lambda: subtractBackground(data_1, mask=mask)),
+        ('background_tiled',
+         lambda: subtractBackgroundTiled(data_1, mask=mask)),
+        ('extract',
+         lambda: sourceExtract(data_sub, bkg_rms=bkg_rms, mask=mask)),
+        ('extract_extras',
+         lambda: sourceExtract(data_sub,
+                               bkg_rms=bkg_rms,
+                               mask=mask,
+                               extras=True)),
+        ('to_detector', _toDetector),
+        ('wcs_to_world', _wcsToWorld),
+        ('wcs_to_pixels', _wcsToPixels),
+        ('pixel_to_pixel', _pixelToPixel),
+        ('sample_overlap', _sampleOverlap),
+        ('approx_wcs', _approxWCS),
+        ('approx_to_world', lambda: approx.pixToWorld(x, y)),
+        ('approx_wcs_query', lambda: approx.worldToPix(ra, dec)),
+        ('align', lambda: alignImage(data_2, warp, shape, mask=mask_2)),
+        ('psf_subtract',
+         lambda: subtractImages(data_sub,
+                                aligned_2,
+                                sources,
+                                mask=mask | aligned_mask,
+                                spatial_order=spatial_order)),
+        ]
+
+def compareBaseline(results, baseline, tolerance=0.2):
+    """
+    Flag stages that have slowed down or grown in memory
+    
+    Parameters
+    ----------
+    results : list
+        Result dictionaries from this run
+    baseline : list
+        Result dictionaries from the baseline run
+    tolerance : float, optional
+        Fractional increase flagged as a regression
+        Default = 0.2
+    
+    Returns
+    -------
+    regressions : list
+        Description of each regression
+    """
+    previous = {(r['stage'], r['size']): r for r in baseline}
+    
+    regressions = []
+    for r in results:
+        old = previous.get((r['stage'], r['size']))
+        if old is None:
+            continue
+        for key in ('seconds', 'peak_mb'):
+            if r[key] > old[key] * (1. + tolerance):
+                regressions.append('{} [{}] {}: {:.3g} -> {:.3g}'.format(
+                    r['stage'], r['size'], key, old[key], r[key]))
+    
+    return regressions
+
+if __name__ == "__main__":
+	
+	args = argParse()
+	
+	results = []
+	print('{:<18} {:>10} {:>10} {:>10}'.format('stage',
+	                                          'size',
+	                                          'time [s]',
+	                                          'peak [MB]'))
+	for size in args.sizes:
+		shape = frameShape(size)
+		for name, func in pipelineStages(shape):
+			if args.stages is not None and name not in args.stages:
+				continue
+			try:
+				seconds, peak_mb = measure(func, repeat=args.repeat)
+			except ValueError as e:
+				print('{:<18} {:>10} failed: {}'.format(name, size, e))
+				continue
+			results.append({'stage': name,
+			                'size': size,
+			                'seconds': seconds,
+			                'peak_mb': peak_mb})
+			print('{:<18} {:>10} {:>10.3f} {:>10.1f}'.format(name,
+			                                                 size,
+			                                                 seconds,
+			                                                 peak_mb))
+	
+	if args.json is not None:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=1)
+	
+	if args.baseline is not None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compareBaseline(results,
+		                              baseline,
+		                              tolerance=args.tolerance)
+		if regressions:
+			print('Regressions against {}:'.format(args.baseline))
+			for r in regressions:
+				print('  ' + r)
+			sys.exit(1)
+		print('No regressions against {}'.format(args.baseline))
@@ -0,0 +1,584 @@
+"""
+Lightweight source catalogue for the extraction hot path
+-Single numpy structured array holding SEP and derived columns
+-Preallocated extra columns and single pass nan pruning
+-Conversion to astropy Table on request
+-Buffered, append-mode writing of many catalogues to one HDF5 or 
+ Parquet store, and column-projected reading
+"""
+
+import os
+import threading
+import numpy as np
+from astropy.table import Table
+
+# optional columnar storage backends
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+# derived columns filled in by sourceExtract when extras are requested
+EXTRA_COLUMNS = (('ellipticity', np.float64),
+                 ('fwhm', np.float64),
+                 ('kronr', np.float64),
+                 ('fluxr', np.float64))
+
+# identifying columns added to every row of a catalogue store
+FRAME_ID_WIDTH = 64
+STORE_COLUMNS = (('frame_id', 'S{}'.format(FRAME_ID_WIDTH)),
+                 ('ccd', np.int16))
+
+# name of the table within an HDF5 store
+HDF5_DATASET = 'sources'
+
+class Catalogue(object):
+    """
+    Source catalogue backed by one numpy structured array
+    
+    Columns are accessed by name, as with an astropy Table, and are
+    views into the array, so in-place updates (e.g. sources['flag'] |=
+    flags) cost no copies. Rows are selected with integers, slices or
+    boolean masks. Adding a column that was not preallocated copies the
+    array, so derived columns should be allocated up front with
+    fromSEP.
+    """
+    
+    def __init__(self, data, meta=None):
+        """
+        Parameters
+        ----------
+        data : array-like
+            Numpy structured array of sources
+        meta : dict, optional
+            Metadata carried over to to_table
+            Default = None
+        """
+        self.data = np.asarray(data)
+        self.meta = {} if meta is None else dict(meta)
+    
+    @classmethod
+    def fromSEP(cls, objects, extras=(), prune=True):
+        """
+        Build a catalogue from the output of sep.extract
+        
+        Parameters
+        ----------
+        objects : array-like
+            Structured array returned by sep.extract
+        extras : sequence, optional
+            (name, dtype) pairs of extra columns to allocate, filled
+            with nan - e.g. EXTRA_COLUMNS
+            Default = (), no extra columns
+        prune : bool, optional
+            Toggle to drop sources with nan in any column
+            Default = True
+        
+        Returns
+        -------
+        catalogue : Catalogue object
+            Catalogue of the extracted sources
+        """
+        keep = slice(None)
+        n = len(objects)
+        if prune:
+            bad = nanRows(objects)
+            if bad.any():
+                keep = ~bad
+                n -= int(bad.sum())
+        
+        # one allocation holding the sep output and the extra columns
+        names = objects.dtype.names
+        dtype = objects.dtype.descr + [(name, np.dtype(t).str)
+                                       for name, t in extras]
+        data = np.empty(n, dtype=dtype)
+        for name in names:
+            data[name] = objects[name][keep]
+        for name, _ in extras:
+            data[name] = np.nan
+        
+        return cls(data)
+    
+    @property
+    def colnames(self):
+        return list(self.data.dtype.names)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, name):
+        return name in self.data.dtype.names
+    
+    def __iter__(self):
+        return iter(self.data)
+    
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.data[item]
+        if isinstance(item, (int, np.integer)):
+            return self.data[item]
+        
+        return Catalogue(self.data[item], meta=self.meta)
+    
+    def __setitem__(self, name, values):
+        if not isinstance(name, str):
+            self.data[name] = values
+            return
+        
+        if name not in self.data.dtype.names:
+            values = np.asarray(values)
+            self.data = _appendColumn(self.data, name, values.dtype)
+        self.data[name] = values
+    
+    def __repr__(self):
+        return '<Catalogue length={} columns={}>'.format(len(self),
+                                                         self.colnames)
+    
+    def pruneNans(self):
+        """
+        Remove sources with nan in any column
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        catalogue : Catalogue object
+            Catalogue pruned of nans - self if there were none
+        """
+        bad = nanRows(self.data)
+        if not bad.any():
+            return self
+        
+        return Catalogue(self.data[~bad], meta=self.meta)
+    
+    def to_table(self, copy=True):
+        """
+        Convert to an astropy Table object
+        
+        Parameters
+        ----------
+        copy : bool, optional
+            Toggle to copy the data rather than share the array
+            Default = True
+        
+        Returns
+        -------
+        table : astropy Table object
+            Table with the same columns as the catalogue
+        """
+        return Table(self.data, meta=self.meta, copy=copy)
+    
+    def write(self, outpath, **kwargs):
+        """
+        Write the catalogue via astropy Table.write
+        
+        Parameters
+        ----------
+        outpath : str
+            Path to the output file
+        **kwargs
+            Keyword arguments for Table.write (e.g. format)
+        
+        Returns
+        -------
+        None
+        """
+        self.to_table(copy=False).write(outpath, **kwargs)
+        
+        return None
+
+def nanRows(data):
+    """
+    Flag the rows of a structured array containing nan in any column
+    
+    Parameters
+    ----------
+    data : array-like
+        Numpy structured array
+    
+    Returns
+    -------
+    bad : array-like
+        Boolean array, True for rows containing nans
+    """
+    bad = np.zeros(len(data), dtype=bool)
+    for name in data.dtype.names:
+        if data.dtype[name].kind in 'fc':
+            np.logical_or(bad, np.isnan(data[name]), out=bad)
+    
+    return bad
+
+def _appendColumn(data, name, dtype):
+    """
+    Copy a structured array into one with an extra, empty column
+    """
+    out = np.empty(len(data), dtype=data.dtype.descr + [(name, dtype.str)])
+    for field in data.dtype.names:
+        out[field] = data[field]
+    
+    return out
+
+class CatalogueWriter(object):
+    """
+    Append the catalogues of many frames to a single night-level store
+    
+    Each catalogue is tagged with frame_id and ccd columns and held in 
+    memory until buffer_rows rows have built up, then written in one 
+    go - as a resize of a chunked HDF5 dataset, or as a Parquet row 
+    group. The columns of the first catalogue fix the schema; later 
+    catalogues missing a column have it filled with nan (or 0).
+    
+    HDF5 stores may be reopened and appended to across sessions. 
+    Parquet files are written once, so appending to an existing 
+    Parquet store raises an error.
+    """
+    
+    def __init__(self, filepath, fmt=None, mode='a', buffer_rows=100000,
+                 compression=None):
+        """
+        Parameters
+        ----------
+        filepath : str
+            Path to the store
+        fmt : str, optional
+            Storage format - 'hdf5' or 'parquet'
+            Default = None, from the file extension
+        mode : str, optional
+            'a' to append to an existing store, 'w' to overwrite
+            Default = 'a'
+        buffer_rows : int, optional
+            Number of rows buffered in memory before a write
+            Default = 100000
+        compression : str, optional
+            Compression filter, e.g. 'gzip' (HDF5) or 'snappy' (Parquet)
+            Default = None
+        
+        Raises
+        ------
+        ImportError
+            If the library for the format is not installed
+        ValueError
+            If the format is unknown, or an existing Parquet store is
+            opened for appending
+        """
+        self.filepath = filepath
+        self.fmt = _storeFormat(filepath, fmt)
+        self.buffer_rows = buffer_rows
+        self.compression = compression
+        self.dtype = None
+        self.n_rows = 0
+        self._buffer = []
+        self._n_buffered = 0
+        self._lock = threading.Lock()
+        self._file = None
+        
+        exists = os.path.exists(filepath)
+        if self.fmt == 'hdf5':
+            self._file = h5py.File(filepath, mode)
+            if HDF5_DATASET in self._file:
+                self.dtype = self._file[HDF5_DATASET].dtype
+                self.n_rows = len(self._file[HDF5_DATASET])
+        elif exists and mode == 'a':
+            raise ValueError('Cannot append to existing Parquet store '
+                             '{}'.format(filepath))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+    
+    def append(self, sources, frame_id, ccd=0):
+        """
+        Add the catalogue of one frame to the store
+        
+        Parameters
+        ----------
+        sources : Catalogue, astropy Table or structured array
+            Sources detected in the frame
+        frame_id : str or int
+            Identifier of the frame, e.g. the file name
+        ccd : int, optional
+            CCD number of the frame
+            Default = 0
+        
+        Returns
+        -------
+        None
+        
+        Raises
+        ------
+        ValueError
+            If frame_id is longer than FRAME_ID_WIDTH bytes
+        """
+        data = _structured(sources)
+        frame_id = _frameId(frame_id)
+        
+        with self._lock:
+            if self.dtype is None:
+                self.dtype = np.dtype(data.dtype.descr + 
+                                      [(n, np.dtype(t).str) 
+                                       for n, t in STORE_COLUMNS])
+            
+            rows = _conform(data, self.dtype)
+            rows['frame_id'] = frame_id
+            rows['ccd'] = ccd
+            
+            self._buffer.append(rows)
+            self._n_buffered += len(rows)
+            if self._n_buffered >= self.buffer_rows:
+                self._flush()
+        
+        return None
+    
+    def flush(self):
+        """
+        Write any buffered rows to the store
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._flush()
+        
+        return None
+    
+    def _flush(self):
+        """
+        Write the buffer, with the lock held
+        """
+        if not self._buffer:
+            return None
+        
+        rows = np.concatenate(self._buffer)
+        self._buffer = []
+        self._n_buffered = 0
+        
+        if self.fmt == 'hdf5':
+            if HDF5_DATASET not in self._file:
+                self._file.create_dataset(HDF5_DATASET, 
+                                          shape=(0,), 
+                                          maxshape=(None,), 
+                                          dtype=self.dtype,
+                                          chunks=(min(self.buffer_rows, 
+                                                      65536),),
+                                          compression=self.compression)
+            dset = self._file[HDF5_DATASET]
+            dset.resize((self.n_rows + len(rows),))
+            dset[self.n_rows:] = rows
+            self._file.flush()
+        else:
+            table = _arrowTable(rows)
+            if self._file is None:
+                self._file = pq.ParquetWriter(self.filepath, 
+                                              table.schema,
+                                              compression=self.compression 
+                                              or 'none')
+            self._file.write_table(table, row_group_size=len(rows))
+        
+        self.n_rows += len(rows)
+        
+        return None
+    
+    def close(self):
+        """
+        Flush the buffer and close the store
+        
+        Parameters
+        ----------
+        None
+        
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        
+        return None
+
+def readCatalogue(filepath, columns=None, frame_id=None, ccd=None, 
+                  fmt=None):
+    """
+    Read sources from a store written by CatalogueWriter, loading only
+    the requested columns and frames
+    
+    HDF5 stores are read field by field from the chunked dataset, and
+    Parquet stores are memory-mapped with only the selected columns
+    decoded and row groups skipped using their statistics
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the store
+    columns : list, optional
+        Names of the columns to read
+        Default = None, all columns
+    frame_id : str or int, optional
+        Only read sources from this frame
+        Default = None
+    ccd : int, optional
+        Only read sources from this CCD
+        Default = None
+    fmt : str, optional
+        Storage format - 'hdf5' or 'parquet'
+        Default = None, from the file extension
+    
+    Returns
+    -------
+    sources : Catalogue object
+        Selected columns for the selected sources
+    
+    Raises
+    ------
+    ValueError
+        If frame_id is longer than FRAME_ID_WIDTH bytes
+    """
+    fmt = _storeFormat(filepath, fmt)
+    if frame_id is not None:
+        frame_id = _frameId(frame_id)
+    
+    if fmt == 'hdf5':
+        with h5py.File(filepath, 'r') as f:
+            dset = f[HDF5_DATASET]
+            names = list(dset.dtype.names) if columns is None else columns
+            
+            sel = slice(None)
+            if frame_id is not None or ccd is not None:
+                keep = np.ones(len(dset), dtype=bool)
+                if frame_id is not None:
+                    keep &= dset.fields('frame_id')[:] == frame_id
+                if ccd is not None:
+                    keep &= dset.fields('ccd')[:] == ccd
+                sel = np.nonzero(keep)[0]
+            
+            if isinstance(sel, slice) or len(sel):
+                data = dset.fields(names)[sel]
+            else:
+                data = np.empty(0, dtype=[(n, dset.dtype[n]) for n in names])
+            if len(names) == 1:
+                data = np.rec.fromarrays([data], names=names)
+        
+        return Catalogue(np.asarray(data))
+    
+    filters = []
+    if frame_id is not None:
+        filters.append(('frame_id', '=', frame_id.decode('utf-8')))
+    if ccd is not None:
+        filters.append(('ccd', '=', ccd))
+    table = pq.read_table(filepath, 
+                          columns=columns, 
+                          filters=filters or None,
+                          memory_map=True)
+    
+    dtype = []
+    arrays = []
+    for name in table.column_names:
+        values = table.column(name).to_numpy(zero_copy_only=False)
+        if name == 'frame_id':
+            values = values.astype('S{}'.format(FRAME_ID_WIDTH))
+        dtype.append((name, values.dtype))
+        arrays.append(values)
+    data = np.empty(table.num_rows, dtype=dtype)
+    for name, values in zip(table.column_names, arrays):
+        data[name] = values
+    
+    return Catalogue(data)
+
+def _storeFormat(filepath, fmt):
+    """
+    Determine the store format and check its library is available
+    """
+    if fmt is None:
+        ext = os.path.splitext(filepath)[1].lower()
+        fmt = {'.h5': 'hdf5', 
+               '.hdf5': 'hdf5', 
+               '.parquet': 'parquet', 
+               '.pq': 'parquet'}.get(ext)
+    
+    if fmt == 'hdf5':
+        if h5py is None:
+            raise ImportError('h5py is required for HDF5 catalogue stores')
+    elif fmt == 'parquet':
+        if pq is None:
+            raise ImportError('pyarrow is required for Parquet catalogue '
+                              'stores')
+    else:
+        raise ValueError('Unknown catalogue store format for '
+                         '{}'.format(filepath))
+    
+    return fmt
+
+def _frameId(frame_id):
+    """
+    Frame identifier as stored, rejecting any too long for the column
+    rather than truncating it into another frame's identifier
+    """
+    encoded = str(frame_id).encode('utf-8')
+    if len(encoded) > FRAME_ID_WIDTH:
+        raise ValueError('Frame identifier longer than {} bytes: '
+                         '{}'.format(FRAME_ID_WIDTH, frame_id))
+    
+    return encoded
+
+def _structured(sources):
+    """
+    Structured array for a Catalogue, Table or structured array
+    """
+    if isinstance(sources, Catalogue):
+        return sources.data
+    if isinstance(sources, Table):
+        return sources.as_array()
+    
+    return np.asarray(sources)
+
+def _conform(data, dtype):
+    """
+    Copy a structured array into the store schema, filling missing 
+    columns with nan (or 0) and rejecting unknown ones
+    """
+    unknown = set(data.dtype.names) - set(dtype.names)
+    if unknown:
+        raise ValueError('Columns not in the store: {}'.format(
+            ', '.join(sorted(unknown))))
+    
+    rows = np.empty(len(data), dtype=dtype)
+    for name in dtype.names:
+        if name in data.dtype.names:
+            rows[name] = data[name]
+        elif dtype[name].kind in 'fc':
+            rows[name] = np.nan
+        else:
+            rows[name] = 0
+    
+    return rows
+
+def _arrowTable(rows):
+    """
+    Arrow table from a structured array, with frame_id as a string
+    """
+    arrays = []
+    for name in rows.dtype.names:
+        values = rows[name]
+        if name == 'frame_id':
+            values = np.char.decode(values, 'utf-8')
+        arrays.append(pa.array(values))
+    
+    return pa.Table.from_arrays(arrays, names=list(rows.dtype.names))
@@ -0,0 +1,406 @@
+"""
+Functions for cross-matching source catalogues across epochs
+-Persistent sky index of sources partitioned into sky tiles
+-KD-tree per tile on unit vectors, rebuilt only where sources change
+-Vectorised nearest neighbour and radius queries
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+from wcs import convertToDetector, convertToWCS, _unitVector
+
+class SkyIndex(object):
+    """
+    Index of source positions from many frames, for matching new
+    catalogues against everything seen before
+    
+    The sky is cut into declination bands of height tile_size, each
+    split into RA cells at least tile_size across. Every tile keeps its
+    own KD-trees of unit vectors, so inserting a frame only touches the
+    handful of tiles it covers. New sources go into a small extra tree
+    per tile, built the next time a query reaches it, and are only 
+    merged into the tile's main tree once they make up a sizeable 
+    fraction of it.
+    
+    Stored sources are identified by their insertion order, with the
+    frame id and row of each kept in the frame and row attributes.
+    """
+    
+    def __init__(self, tile_size=1., merge_fraction=0.25, max_runs=8):
+        """
+        Parameters
+        ----------
+        tile_size : float, optional
+            Height of the declination bands in degrees - queries are
+            fastest for radii well below this
+            Default = 1.
+        merge_fraction : float, optional
+            Size, relative to the main tree, above which new sources in
+            a tile are merged into the main tree
+            Default = 0.25
+        max_runs : int, optional
+            Maximum number of trees kept per tile before merging
+            Default = 8
+        """
+        self.tile_size = float(tile_size)
+        self.merge_fraction = merge_fraction
+        self.max_runs = max_runs
+        self.n_bands = int(np.ceil(180. / self.tile_size))
+        
+        # number of RA cells per band, keeping cells >= tile_size wide
+        edges = -90. + self.tile_size*np.arange(self.n_bands + 1)
+        low = np.minimum(np.abs(edges[:-1]), np.abs(edges[1:]))
+        low[(edges[:-1] < 0) & (edges[1:] > 0)] = 0.
+        self.n_cells = np.maximum(
+            (360.*np.cos(np.radians(low)) / self.tile_size).astype(int), 1)
+        
+        self._chunks = []
+        self._ra = np.empty(0)
+        self._dec = np.empty(0)
+        self._frame = np.empty(0, dtype=np.int64)
+        self._row = np.empty(0, dtype=np.int64)
+        self._size = 0
+        
+        # tile key -> [pending id chunks, [(ids, tree), ...]]
+        self._tiles = {}
+    
+    def __len__(self):
+        return self._size
+    
+    def _tileKeys(self, ra, dec):
+        """
+        Flat tile numbers for world coords in degrees
+        """
+        band = np.clip(((dec + 90.) / self.tile_size).astype(int),
+                       0, self.n_bands - 1)
+        n = self.n_cells[band]
+        cell = np.minimum(((ra % 360.) / 360. * n).astype(int), n - 1)
+        
+        return band.astype(np.int64) * self.n_cells.max() + cell
+    
+    def insert(self, ra, dec, frame_id=0, rows=None):
+        """
+        Add the sources of a frame to the index
+        
+        Parameters
+        ----------
+        ra, dec : array-like
+            World coords of the sources in degrees
+        frame_id : int, optional
+            Identifier of the frame the sources came from
+            Default = 0
+        rows : array-like, optional
+            Row of each source in its catalogue
+            Default = None, 0 to n-1
+        
+        Returns
+        -------
+        ids : array-like
+            Index ids given to the sources
+        """
+        ra = np.asarray(ra, dtype=np.float64).ravel()
+        dec = np.asarray(dec, dtype=np.float64).ravel()
+        if rows is None:
+            rows = np.arange(len(ra))
+        ids = np.arange(self._size, self._size + len(ra))
+        
+        self._chunks.append((ra,
+                             dec,
+                             np.full(len(ra), frame_id, dtype=np.int64),
+                             np.asarray(rows, dtype=np.int64)))
+        self._size += len(ra)
+        
+        # hand the new ids to their tiles without touching the rest
+        keys = self._tileKeys(ra, dec)
+        order = np.argsort(keys, kind='stable')
+        keys, starts = np.unique(keys[order], return_index=True)
+        for key, group in zip(keys, np.split(ids[order], starts[1:])):
+            self._tiles.setdefault(int(key), [[], []])[0].append(group)
+        
+        return ids
+    
+    def insertCatalogue(self, sources, hdr, wcs_hdr, frame_id=0):
+        """
+        Add a sourceExtract catalogue to the index
+        
+        Parameters
+        ----------
+        sources : astropy Table object
+            Catalogue with pixel coords x, y (zero-based, as from sep)
+        hdr : astropy Header object
+            FITS header for the HDU, containing transformation 
+            coefficients to detector coordinates
+        wcs_hdr : astropy Header object
+            FITS header containing the WCS solution for the frame
+        frame_id : int, optional
+            Identifier of the frame
+            Default = 0
+        
+        Returns
+        -------
+        ids : array-like
+            Index ids given to the sources
+        """
+        x_det, y_det = convertToDetector(np.asarray(sources['x']) + 1,
+                                         np.asarray(sources['y']) + 1,
+                                         hdr)
+        ra, dec = convertToWCS(x_det, y_det, wcs_hdr)
+        
+        return self.insert(ra, dec, frame_id=frame_id)
+    
+    def _consolidate(self):
+        """
+        Fold newly inserted chunks into the flat coordinate arrays
+        """
+        if self._chunks:
+            ra, dec, frame, row = zip(*self._chunks)
+            self._ra = np.concatenate((self._ra,) + ra)
+            self._dec = np.concatenate((self._dec,) + dec)
+            self._frame = np.concatenate((self._frame,) + frame)
+            self._row = np.concatenate((self._row,) + row)
+            self._chunks = []
+        
+        return None
+    
+    @property
+    def ra(self):
+        self._consolidate()
+        return self._ra
+    
+    @property
+    def dec(self):
+        self._consolidate()
+        return self._dec
+    
+    @property
+    def frame(self):
+        self._consolidate()
+        return self._frame
+    
+    @property
+    def row(self):
+        self._consolidate()
+        return self._row
+    
+    def _trees(self, key):
+        """
+        List of (ids, KD-tree) for a tile, indexing any sources added 
+        since the last query
+        """
+        pending, runs = self._tiles[key]
+        if pending:
+            self._consolidate()
+            new = np.concatenate(pending)
+            del pending[:]
+            
+            # small additions get their own tree, large ones a rebuild
+            if (runs and 
+                len(runs) < self.max_runs and
+                len(new) + sum(len(r[0]) for r in runs[1:]) <= 
+                self.merge_fraction*len(runs[0][0])):
+                runs.append((new, self._buildTree(new)))
+            else:
+                new = np.concatenate([r[0] for r in runs] + [new])
+                runs[:] = [(new, self._buildTree(new))]
+        
+        return runs
+    
+    def _buildTree(self, ids):
+        """
+        KD-tree of unit vectors for stored sources
+        """
+        return cKDTree(_unitVector(self._ra[ids], self._dec[ids]))
+    
+    def _candidateTiles(self, ra, dec, radius):
+        """
+        Pairs of (query index, tile key) for every existing tile that a
+        circle of the given radius about each query may overlap
+        """
+        band_lo = np.clip(((dec - radius + 90.) /
+                           self.tile_size).astype(int), 0, self.n_bands - 1)
+        band_hi = np.clip(((dec + radius + 90.) /
+                           self.tile_size).astype(int), 0, self.n_bands - 1)
+        
+        # half-width in RA of the circle, whole circle near the poles
+        top = np.minimum(np.abs(dec) + radius, 90.)
+        cos_top = np.cos(np.radians(top))
+        half = np.where(cos_top > 1e-6,
+                        radius / np.maximum(cos_top, 1e-6),
+                        180.)
+        half = np.minimum(half, 180.)
+        
+        idx, keys = [], []
+        width = self.n_cells.max()
+        for offset in range(int((band_hi - band_lo).max()) + 1):
+            band = band_lo + offset
+            inside = np.nonzero(band <= band_hi)[0]
+            band = band[inside]
+            n = self.n_cells[band]
+            lo = np.floor((ra[inside] - half[inside]) / 360. * n).astype(int)
+            hi = np.floor((ra[inside] + half[inside]) / 360. * n).astype(int)
+            span = np.minimum(hi - lo, n - 1)
+            for step in range(int(span.max()) + 1):
+                use = step <= span
+                cell = (lo[use] + step) % n[use]
+                idx.append(inside[use])
+                keys.append(band[use].astype(np.int64) * width + cell)
+        
+        idx, keys = np.concatenate(idx), np.concatenate(keys)
+        known = np.isin(keys, np.fromiter(self._tiles, dtype=np.int64,
+                                          count=len(self._tiles)))
+        
+        return idx[known], keys[known]
+    
+    def queryRadius(self, ra, dec, radius):
+        """
+        Find all stored sources within a radius of each query position
+        
+        Parameters
+        ----------
+        ra, dec : array-like
+            World coords of the query positions in degrees
+        radius : float
+            Search radius in degrees
+        
+        Returns
+        -------
+        query_idx : array-like
+            Index into the query positions of each match
+        ids : array-like
+            Index id of each matched stored source
+        sep : array-like
+            Separation of each match in degrees
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        vec = _unitVector(ra, dec)
+        chord = 2.*np.sin(np.radians(radius) / 2.)
+        
+        query_idx, ids, dist = [], [], []
+        if len(ra) and self._tiles:
+            idx, keys = self._candidateTiles(ra, dec, radius)
+            for key in np.unique(keys):
+                q = idx[keys == key]
+                for tile_ids, tree in self._trees(int(key)):
+                    hits = tree.query_ball_point(vec[q], chord)
+                    counts = np.array([len(h) for h in hits])
+                    if not counts.sum():
+                        continue
+                    found = np.concatenate(hits).astype(np.intp)
+                    rep = np.repeat(q, counts)
+                    query_idx.append(rep)
+                    ids.append(tile_ids[found])
+                    dist.append(np.linalg.norm(vec[rep] - tree.data[found], 
+                                               axis=1))
+        
+        if not query_idx:
+            return (np.empty(0, dtype=np.intp),
+                    np.empty(0, dtype=np.int64),
+                    np.empty(0))
+        
+        dist = np.concatenate(dist)
+        
+        return (np.concatenate(query_idx),
+                np.concatenate(ids),
+                np.degrees(2.*np.arcsin(np.minimum(dist / 2., 1.))))
+    
+    def match(self, ra, dec, radius):
+        """
+        Find the nearest stored source within a radius of each query
+        position
+        
+        Parameters
+        ----------
+        ra, dec : array-like
+            World coords of the query positions in degrees
+        radius : float
+            Matching radius in degrees
+        
+        Returns
+        -------
+        ids : array-like
+            Index id of the nearest stored source for each query, -1
+            where there is none within the radius
+        sep : array-like
+            Separation of the nearest source in degrees, inf where
+            there is none
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        vec = _unitVector(ra, dec)
+        chord = 2.*np.sin(np.radians(radius) / 2.)
+        
+        ids = np.full(len(ra), -1, dtype=np.int64)
+        best = np.full(len(ra), np.inf)
+        if len(ra) and self._tiles:
+            idx, keys = self._candidateTiles(ra, dec, radius)
+            for key in np.unique(keys):
+                q = idx[keys == key]
+                for tile_ids, tree in self._trees(int(key)):
+                    dist, nearest = tree.query(vec[q],
+                                               distance_upper_bound=chord)
+                    better = dist < best[q]
+                    best[q[better]] = dist[better]
+                    ids[q[better]] = tile_ids[nearest[better]]
+        
+        sep = np.full(len(ra), np.inf)
+        found = ids >= 0
+        sep[found] = np.degrees(2.*np.arcsin(np.minimum(best[found] / 2.,
+                                                        1.)))
+        
+        return ids, sep
+    
+    def save(self, filepath):
+        """
+        Save the index to a numpy .npz file
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the output file
+        
+        Returns
+        -------
+        None
+        """
+        self._consolidate()
+        np.savez(filepath,
+                 tile_size=self.tile_size,
+                 ra=self._ra,
+                 dec=self._dec,
+                 frame=self._frame,
+                 row=self._row)
+        
+        return None
+    
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load an index saved with save - KD-trees are rebuilt lazily as
+        queries reach each tile
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the .npz file
+        
+        Returns
+        -------
+        index : SkyIndex object
+            Restored index
+        """
+        with np.load(filepath) as f:
+            index = cls(tile_size=float(f['tile_size']))
+            ra, dec = f['ra'], f['dec']
+            frame, row = f['frame'], f['row']
+        
+        # insert frame by frame to restore ids and frame labels
+        if len(ra):
+            breaks = np.nonzero(np.diff(frame))[0] + 1
+            for part in np.split(np.arange(len(ra)), breaks):
+                index.insert(ra[part],
+                             dec[part],
+                             frame_id=int(frame[part[0]]),
+                             rows=row[part])
+        
+        return index
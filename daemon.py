@@ -0,0 +1,618 @@
+"""
+Long-running service processing CCD frames as they land on disk
+-asyncio watch of an incoming directory, with a bounded job queue
+-Extraction, WCS and subtraction on a pool of worker processes
+-Bad pixel masks, reference frames, parsed WCS and background models
+ kept warm in the workers between frames
+"""
+
+from image_subtract import alignAndSubtract
+from frames import loadFrame, loadHeader, ccdNumber
+from extract import subtractBackground, sourceExtract, _imageHDUs
+from background import BackgroundCache
+from masks import MaskCache
+from catalogue import CatalogueWriter
+from wcs import solveField
+from instrument import stage, enable
+import os
+import glob
+import time
+import signal
+import asyncio
+import argparse as ap
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from astropy.io import fits
+
+# name of the file in the output directory listing frames processed
+# without error
+JOURNAL = 'processed.txt'
+
+# per-process state of the workers, filled by _initWorker
+_config = {}
+_warm = {}
+
+def argParse():
+    """
+    Argument parser settings
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    args : array-like
+        Array of command line arguments
+    """
+    parser = ap.ArgumentParser()
+    
+    parser.add_argument('incoming',
+                        help='directory watched for new frames',
+                        type=str)
+    
+    parser.add_argument('out',
+                        help='directory for catalogues, difference '
+                             'images and the journal of processed frames',
+                        type=str)
+    
+    parser.add_argument('--pattern',
+                        help='glob pattern of the frames to process',
+                        type=str,
+                        default='*.fits')
+    
+    parser.add_argument('--hdus',
+                        help='HDUs (index or EXTNAME) to process',
+                        nargs='+',
+                        default=None)
+    
+    parser.add_argument('--mask',
+                        help='bad pixel mask with the same HDU layout as '
+                             'the frames',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--mask_grow',
+                        help='pixels by which bad pixels are grown',
+                        type=int,
+                        default=0)
+    
+    parser.add_argument('--mask_bleed',
+                        help='further pixels by which bad pixels are '
+                             'extended along their column',
+                        type=int,
+                        default=0)
+    
+    parser.add_argument('--mask_edge',
+                        help='width of the frame border masked',
+                        type=int,
+                        default=0)
+    
+    parser.add_argument('--reference',
+                        help='reference frame subtracted from each frame',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--reference_wcs',
+                        help='WCS solution for the reference frame',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--solve',
+                        help='solve frames without a .wcs file with '
+                             'solve-field?',
+                        action='store_true')
+    
+    parser.add_argument('--catalogue',
+                        help='name of the source store in the output '
+                             'directory',
+                        type=str,
+                        default='sources.h5')
+    
+    parser.add_argument('--workers',
+                        help='number of worker processes',
+                        type=int,
+                        default=None)
+    
+    parser.add_argument('--queue_size',
+                        help='jobs queued before the watcher waits',
+                        type=int,
+                        default=16)
+    
+    parser.add_argument('--poll',
+                        help='interval between scans in seconds',
+                        type=float,
+                        default=0.5)
+    
+    parser.add_argument('--bkg_window',
+                        help='length of the time windows sharing a '
+                             'background model, in seconds',
+                        type=float,
+                        default=1800.)
+    
+    parser.add_argument('--trace',
+                        help='file to which per-stage timings are '
+                             'written as JSON lines (- for stderr)',
+                        type=str,
+                        default=None)
+    
+    return parser.parse_args()
+
+def _initWorker(config):
+    """
+    Set up the warm state of a worker process
+    """
+    _config.clear()
+    _config.update(config)
+    _warm.clear()
+    _warm['masks'] = None
+    if config.get('mask_path') is not None:
+        _warm['masks'] = MaskCache(config['mask_path'],
+                                   grow=config.get('mask_grow', 0),
+                                   bleed=config.get('mask_bleed', 0),
+                                   edge=config.get('mask_edge', 0))
+    _warm['references'] = {}
+    _warm['backgrounds'] = BackgroundCache(
+        window=config.get('bkg_window', 1800.),
+        cache_dir=config.get('bkg_cache_dir'))
+    
+    # leave shutting down to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _mask(hdu):
+    """
+    Dilated bad pixel mask for an HDU, loaded on first use
+    """
+    if _warm['masks'] is None:
+        return None
+    
+    return _warm['masks'].get(hdu=hdu, dilated=True)
+
+def _reference(hdu):
+    """
+    Reference frame, header, WCS and sources for an HDU, loaded and
+    extracted on first use
+    """
+    if _config.get('reference_path') is None:
+        return None
+    if hdu not in _warm['references']:
+        with stage('load_reference', hdu=hdu):
+            data, hdr = loadFrame(_config['reference_path'],
+                                  hdu=hdu,
+                                  dtype=np.float32)
+            wcs_hdr = fits.getheader(_config['reference_wcs'])
+            mask = _mask(hdu)
+            data_sub, bkg_rms = subtractBackground(data, mask=mask)
+            sources = sourceExtract(data_sub, bkg_rms=bkg_rms, mask=mask)
+        _warm['references'][hdu] = (data, hdr, wcs_hdr, sources)
+    
+    return _warm['references'][hdu]
+
+def frameTime(filepath):
+    """
+    Time at which a frame was taken, for keying background models
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    
+    Returns
+    -------
+    time : float
+        MJD-OBS of the primary header in seconds, or the modification
+        time of the file if there is none
+    """
+    mjd = loadHeader(filepath, hdu=0).get('MJD-OBS')
+    if mjd is None:
+        return os.path.getmtime(filepath)
+    
+    return float(mjd) * 86400.
+
+def frameWCS(filepath, hdu, out_dir, solve=False, timeout=120.):
+    """
+    Find (or solve for) the WCS solution of a frame
+    
+    Looks for <name>_<hdu>.wcs and then <name>.wcs next to the frame
+    and in the output directory
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str
+        HDU of the frame
+    out_dir : str
+        Output directory, also searched for solutions
+    solve : bool, optional
+        Toggle to run solve-field on the HDU if no solution is found
+        Default = False
+    timeout : float, optional
+        Time in seconds after which solve-field is abandoned
+        Default = 120.
+    
+    Returns
+    -------
+    wcs_hdr : astropy Header object
+        Header containing the WCS solution, or None
+    """
+    in_dir, name = os.path.split(filepath)
+    stem = os.path.splitext(name)[0]
+    for directory in (in_dir, out_dir):
+        for prefix in ('{}_{}'.format(stem, hdu), stem):
+            path = os.path.join(directory, prefix + '.wcs')
+            if os.path.exists(path):
+                return fits.getheader(path)
+    
+    if not solve:
+        return None
+    
+    # solve-field reads the primary HDU, so solve a copy of the frame
+    data, hdr = loadFrame(filepath, hdu=hdu)
+    prefix = '{}_{}'.format(stem, hdu)
+    fits.writeto(os.path.join(out_dir, prefix + '_solve.fits'),
+                 data,
+                 hdr,
+                 overwrite=True)
+    wcs_path = solveField(prefix + '_solve.fits',
+                          prefix,
+                          bintable=False,
+                          input_dir=out_dir,
+                          nx=data.shape[1],
+                          ny=data.shape[0],
+                          timeout=timeout)
+    if wcs_path is None:
+        return None
+    
+    return fits.getheader(wcs_path)
+
+def processFrame(filepath, hdu):
+    """
+    Worker task - subtract the background from and extract sources in
+    one HDU of a frame, then align it to and subtract the reference
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str
+        HDU of the frame
+    
+    Returns
+    -------
+    result : dict
+        file, hdu, ccd (CCD number), sources (Catalogue object), 
+        difference (path to the difference image, or None), seconds 
+        and error (message, or None) of the job
+    """
+    start = time.perf_counter()
+    result = {'file': filepath,
+              'hdu': hdu,
+              'ccd': None,
+              'sources': None,
+              'difference': None,
+              'error': None}
+    try:
+        with stage('load_frame', file=filepath, hdu=hdu):
+            data, hdr = loadFrame(filepath, hdu=hdu, dtype=np.float32)
+        result['ccd'] = ccdNumber(hdr, hdu)
+        mask = _mask(hdu)
+        
+        data_sub, bkg_rms = _warm['backgrounds'].subtract(
+            data,
+            ccd=hdu,
+            time=frameTime(filepath),
+            mask=mask)
+        result['sources'] = sourceExtract(data_sub,
+                                          bkg_rms=bkg_rms,
+                                          mask=mask)
+        del data_sub
+        
+        reference = _reference(hdu)
+        if reference is not None:
+            wcs_hdr = frameWCS(filepath,
+                               hdu,
+                               _config['out_dir'],
+                               solve=_config.get('solve', False))
+            if wcs_hdr is None:
+                raise ValueError('no WCS solution')
+            result['difference'] = _subtractReference(filepath,
+                                                      hdu,
+                                                      data,
+                                                      hdr,
+                                                      wcs_hdr,
+                                                      mask,
+                                                      reference)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    
+    return result
+
+def _subtractReference(filepath, hdu, data, hdr, wcs_hdr, mask, reference):
+    """
+    Align a frame to the reference and write their PSF-matched
+    difference, on the pixel grid of the reference
+    """
+    ref, ref_hdr, ref_wcs, ref_sources = reference
+    difference, _ = alignAndSubtract(ref,
+                                     ref_hdr,
+                                     ref_wcs,
+                                     data,
+                                     hdr,
+                                     wcs_hdr,
+                                     _mask(hdu),
+                                     mask_2=mask,
+                                     sources_1=ref_sources,
+                                     verbose=False)
+    
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    outpath = os.path.join(_config['out_dir'],
+                           '{}_{}_diff.fits'.format(stem, hdu))
+    with stage('write_difference', file=outpath):
+        fits.writeto(outpath, difference, ref_hdr, overwrite=True)
+    
+    return outpath
+
+class FrameDaemon(object):
+    """
+    Watch a directory for new frames and process them on a pool of
+    worker processes, writing their sources to a single store
+    
+    The watcher puts (file, HDU) jobs on a bounded asyncio queue, so
+    when the workers fall behind it waits rather than piling up work -
+    frames arriving meanwhile are picked up by the next scan. Files
+    are queued once their size has stopped changing between scans.
+    Successful jobs are recorded in a journal, so a restarted daemon
+    carries on where it stopped and retries any that failed.
+    """
+    
+    def __init__(self, incoming_dir, out_dir, pattern='*.fits', hdus=None,
+                 n_workers=None, queue_size=16, poll_interval=0.5,
+                 catalogue='sources.h5', **worker_config):
+        """
+        Parameters
+        ----------
+        incoming_dir : str
+            Directory watched for new frames
+        out_dir : str
+            Directory for the source store, difference images and
+            journal, created if needed
+        pattern : str, optional
+            Glob pattern of the frames to process
+            Default = '*.fits'
+        hdus : list, optional
+            HDUs processed in every frame
+            Default = None, all image HDUs containing 2D data
+        n_workers : int, optional
+            Number of worker processes
+            Default = None, one per CPU
+        queue_size : int, optional
+            Number of jobs queued before the watcher waits
+            Default = 16
+        poll_interval : float, optional
+            Interval between scans of the directory in seconds
+            Default = 0.5
+        catalogue : str, optional
+            Name of the source store in the output directory
+            Default = 'sources.h5'
+        **worker_config
+            Settings of the workers - mask_path, mask_grow, mask_bleed,
+            mask_edge, reference_path, reference_wcs, solve, bkg_window,
+            bkg_cache_dir
+        """
+        self.incoming_dir = incoming_dir
+        self.out_dir = out_dir
+        self.pattern = pattern
+        self.hdus = hdus
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.catalogue = os.path.join(out_dir, catalogue)
+        self.worker_config = dict(worker_config, out_dir=out_dir)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        
+        # jobs already done, and file sizes seen on the previous scan
+        self.done = set()
+        self._sizes = {}
+        self._queued = set()
+        
+        # pool of worker processes, started by run
+        self.pool = None
+        journal = os.path.join(out_dir, JOURNAL)
+        if os.path.exists(journal):
+            with open(journal) as f:
+                for line in f:
+                    filepath, hdu = line.rstrip('\n').split('\t')
+                    self.done.add((filepath, hdu))
+    
+    def _ready(self):
+        """
+        New files whose size has not changed since the last scan
+        """
+        ready = []
+        sizes = {}
+        for filepath in sorted(glob.glob(os.path.join(self.incoming_dir,
+                                                      self.pattern))):
+            if filepath in self._queued:
+                continue
+            try:
+                sizes[filepath] = os.path.getsize(filepath)
+            except OSError:
+                continue
+            if sizes[filepath] > 0 and \
+               self._sizes.get(filepath) == sizes[filepath]:
+                ready.append(filepath)
+        self._sizes = sizes
+        
+        return ready
+    
+    async def watch(self, queue):
+        """
+        Scan the incoming directory and queue jobs for new frames
+        """
+        while True:
+            for filepath in self._ready():
+                try:
+                    hdus = _imageHDUs(filepath) if self.hdus is None \
+                        else self.hdus
+                except OSError as e:
+                    print('Skipping {}: {}'.format(filepath, e))
+                    self._queued.add(filepath)
+                    continue
+                self._queued.add(filepath)
+                for hdu in hdus:
+                    if (filepath, str(hdu)) in self.done:
+                        continue
+                    # waits here while the queue is full
+                    await queue.put((filepath, hdu))
+            await asyncio.sleep(self.poll_interval)
+    
+    def _newPool(self):
+        """
+        Start a pool of worker processes with warm state
+        """
+        return ProcessPoolExecutor(max_workers=self.n_workers,
+                                   initializer=_initWorker,
+                                   initargs=(self.worker_config,))
+    
+    async def work(self, queue, writer, journal):
+        """
+        Take jobs from the queue and run them on the process pool
+        
+        A job that cannot be run, or whose result cannot be recorded, 
+        is reported as failed rather than stopping the worker. If a 
+        worker process dies the pool is broken for every job on it, so
+        it is replaced with a new one.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            filepath, hdu = await queue.get()
+            try:
+                pool = self.pool
+                try:
+                    result = await loop.run_in_executor(pool,
+                                                        processFrame,
+                                                        filepath,
+                                                        hdu)
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool) and \
+                       self.pool is pool:
+                        print('Worker pool broken, restarting it...')
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        self.pool = self._newPool()
+                    result = {'file': filepath,
+                              'hdu': hdu,
+                              'ccd': None,
+                              'sources': None,
+                              'difference': None,
+                              'seconds': 0.,
+                              'error': '{}: {}'.format(type(e).__name__, 
+                                                       e)}
+                try:
+                    self.report(result, writer, journal)
+                except Exception as e:
+                    print('{} [{}] could not be recorded - {}: {}'.format(
+                        os.path.basename(filepath), 
+                        hdu, 
+                        type(e).__name__, 
+                        e))
+            finally:
+                queue.task_done()
+    
+    def report(self, result, writer, journal):
+        """
+        Store the sources of a finished job and record it as done
+        
+        Nothing is kept of a failed job, so it is run again from 
+        scratch when the daemon restarts
+        """
+        name = os.path.basename(result['file'])
+        try:
+            latency = time.time() - os.path.getmtime(result['file'])
+        except OSError:
+            latency = np.nan
+        
+        if result['error'] is not None:
+            status = 'failed - {}'.format(result['error'])
+        else:
+            writer.append(result['sources'], name, ccd=result['ccd'])
+            writer.flush()
+            status = '{} sources'.format(len(result['sources']))
+            if result['difference'] is not None:
+                status += ', difference written'
+        print('{} [{}] {} ({:.1f} s, {:.1f} s after landing)'.format(
+            name, result['hdu'], status, result['seconds'], latency))
+        if result['error'] is not None:
+            return
+        
+        self.done.add((result['file'], str(result['hdu'])))
+        journal.write('{}\t{}\n'.format(result['file'], result['hdu']))
+        journal.flush()
+    
+    async def run(self):
+        """
+        Process frames until interrupted (SIGINT or SIGTERM)
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.pool = self._newPool()
+        writer = CatalogueWriter(self.catalogue)
+        journal = open(os.path.join(self.out_dir, JOURNAL), 'a')
+        tasks = [asyncio.ensure_future(self.watch(queue))]
+        tasks += [asyncio.ensure_future(self.work(queue, writer, journal))
+                  for _ in range(self.n_workers)]
+        print('Watching {} with {} workers...'.format(self.incoming_dir,
+                                                      self.n_workers))
+        try:
+            await stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            writer.close()
+            journal.close()
+            print('Stopped')
+
+if __name__ == "__main__":
+	
+	args = argParse()
+	if args.trace is not None:
+		enable(args.trace)
+	
+	if args.reference is not None and args.reference_wcs is None:
+		print('A WCS solution is needed for the reference frame...')
+		quit()
+	
+	hdus = None
+	if args.hdus is not None:
+		hdus = [int(h) if h.isdigit() else h for h in args.hdus]
+	
+	daemon = FrameDaemon(args.incoming,
+	                     args.out,
+	                     pattern=args.pattern,
+	                     hdus=hdus,
+	                     n_workers=args.workers,
+	                     queue_size=args.queue_size,
+	                     poll_interval=args.poll,
+	                     catalogue=args.catalogue,
+	                     mask_path=args.mask,
+	                     mask_grow=args.mask_grow,
+	                     mask_bleed=args.mask_bleed,
+	                     mask_edge=args.mask_edge,
+	                     reference_path=args.reference,
+	                     reference_wcs=args.reference_wcs,
+	                     solve=args.solve,
+	                     bkg_window=args.bkg_window,
+	                     bkg_cache_dir=os.path.join(args.out, 'background'))
+	asyncio.run(daemon.run())
@@ -1,12 +1,141 @@
 """
 Diagnostic functions for pyCCD scripts
+-Interactive plots of sources and markers on a frame
+-Headless PNG quicklooks, rendered without a display
+-Batch rendering of a directory of frames on a process pool
 """
 
+from extract import subtractBackground, sourceExtract, _imageHDUs
+from frames import loadFrame
+from masks import loadMask
+import os
+import glob
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.patches import Circle, Ellipse
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection
+from astropy.visualization import ZScaleInterval
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+    )
 
-def plotSources(data, sources, circle=False):
+def downsample(data, max_size=2048):
+    """
+    Block average a frame so that neither side exceeds max_size pixels
+    
+    Parameters
+    ----------
+    data : array-like
+        Image data for the CCD frame
+    max_size : int, optional
+        Largest side of the output in pixels
+        Default = 2048
+    
+    Returns
+    -------
+    binned : array-like
+        Block averaged frame - any rows or columns left over from the
+        last whole block are cropped
+    factor : int
+        Side of the blocks averaged over
+    """
+    factor = max(int(np.ceil(max(data.shape) / float(max_size))), 1)
+    if factor == 1:
+        return data, 1
+    
+    ny, nx = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    
+    return blocks.mean(axis=(1, 3), dtype=np.float32), factor
+
+def zscaleLimits(data, n_samples=10000, contrast=0.25):
+    """
+    Display limits of a frame from the zscale algorithm, applied to a
+    regular subsample of its pixels
+    
+    Parameters
+    ----------
+    data : array-like
+        Image data for the CCD frame
+    n_samples : int, optional
+        Approximate number of pixels sampled
+        Default = 10000
+    contrast : float, optional
+        Scaling factor applied to the slope of the sorted pixel values
+        Default = 0.25
+    
+    Returns
+    -------
+    vmin, vmax : float
+        Lower and upper display limits
+    """
+    step = max(int(np.sqrt(data.size / float(n_samples))), 1)
+    sample = data[::step, ::step]
+    
+    return ZScaleInterval(n_samples=n_samples,
+                          contrast=contrast).get_limits(sample)
+
+def _drawFrame(ax, data, max_size=2048):
+    """
+    Show a downsampled frame on a set of axes, keeping the pixel coords
+    of the full frame, and return the shape displayed
+    """
+    binned, factor = downsample(data, max_size=max_size)
+    vmin, vmax = zscaleLimits(data)
+    
+    # extent of the blocks in zero-based pixel coords of the full frame
+    ny, nx = binned.shape[0]*factor, binned.shape[1]*factor
+    ax.imshow(binned, interpolation='nearest', cmap='gray',
+              vmin=vmin, vmax=vmax, origin='lower',
+              extent=(-0.5, nx - 0.5, -0.5, ny - 0.5))
+    ax.set_xlabel('x')
+    ax.set_ylabel('y')
+    
+    return binned.shape
+
+def _drawMarkers(ax, x, y, widths, heights, angles, color='red'):
+    """
+    Draw every marker as one collection of unfilled ellipses, sized in
+    pixels
+    """
+    offsets = np.column_stack([x, y])
+    markers = EllipseCollection(widths,
+                                heights,
+                                angles,
+                                units='xy',
+                                offsets=offsets,
+                                offset_transform=ax.transData,
+                                facecolors='none',
+                                edgecolors=color,
+                                linewidths=0.5)
+    ax.add_collection(markers)
+    
+    return None
+
+def _drawSources(ax, sources, circle=False):
+    """
+    Draw sources detected by SEP as ellipses (or circles) on a set of
+    axes
+    """
+    if sources is None or len(sources) == 0:
+        return None
+    
+    x = np.asarray(sources['x'])
+    y = np.asarray(sources['y'])
+    if circle:
+        _drawMarkers(ax, x, y, 6., 6., 0.)
+    else:
+        _drawMarkers(ax, x, y,
+                     6*np.asarray(sources['a']),
+                     6*np.asarray(sources['b']),
+                     np.degrees(np.asarray(sources['theta'])))
+    
+    return None
+
+def plotSources(data, sources, circle=False, max_size=2048):
     """
     Plot sources detected by SEP on top of an image
     
@@ -14,43 +143,28 @@ def plotSources(data, sources, circle=False):
     ----------
     data : array-like
         Image data for the CCD frame
-    sources : astropy Table object
+    sources : astropy Table or Catalogue object
         Source catalog outputted by SEP for the frame
     circle : bool, optional
         Toggle to switch to circular indicator
         Default = False [elliptical apertures used]
+    max_size : int, optional
+        Largest side of the displayed image - larger frames are block
+        averaged
+        Default = 2048
     
     Returns
     -------
     None
     """
     fig, ax = plt.subplots()
-    m, s = np.mean(data), np.std(data)
-    im = ax.imshow(data, interpolation='nearest', cmap='gray',
-                   vmin=m-s, vmax=m+s, origin='lower')
-
-    for i in range(len(sources)):
-        if circle:
-            c = Circle(xy=(sources['x'][i], sources['y'][i]),
-                       radius=3)
-            c.set_facecolor('none')
-            c.set_edgecolor('red')
-            ax.add_artist(c)
-        else:
-            e = Ellipse(xy=(sources['x'][i], sources['y'][i]),
-                        width=6*sources['a'][i],
-                        height=6*sources['b'][i],
-                        angle=sources['theta'][i] * 180. / np.pi)
-            e.set_facecolor('none')
-            e.set_edgecolor('red')
-            ax.add_artist(e)
-        
-    plt.xlabel('x')
-    plt.ylabel('y')
+    _drawFrame(ax, data, max_size=max_size)
+    _drawSources(ax, sources, circle=circle)
+    
     plt.show()
     plt.close(fig)
 
-def plotXY(data, x, y):
+def plotXY(data, x, y, max_size=2048):
     """
     Plot xy markers on top of an image
     
@@ -60,23 +174,195 @@ def plotXY(data, x, y):
         Image data for the CCD
     x, y : array-like
         xy coords for the markers to be placed
+    max_size : int, optional
+        Largest side of the displayed image - larger frames are block
+        averaged
+        Default = 2048
     
     Returns
     -------
     None
     """
     fig, ax = plt.subplots()
-    m, s = np.mean(data), np.std(data)
-    im = ax.imshow(data, interpolation='nearest', cmap='gray',
-                   vmin=m-s, vmax=m+s, origin='lower')
-    
-    for (i, j) in zip(x, y):
-        c = Circle(xy=(i, j), radius=3)
-        c.set_facecolor('none')
-        c.set_edgecolor('red')
-        ax.add_artist(c)
-    
-    plt.xlabel('x')
-    plt.ylabel('y')
+    _drawFrame(ax, data, max_size=max_size)
+    _drawMarkers(ax, np.asarray(x), np.asarray(y), 6., 6., 0.)
+    
     plt.show()
     plt.close(fig)
+
+def renderQuicklook(data, outpath, sources=None, x=None, y=None,
+                    circle=False, max_size=2048, dpi=100, title=None):
+    """
+    Render a frame, with optional sources or markers, to a PNG file
+    without a display
+    
+    The figure is drawn with the Agg canvas directly rather than
+    through pyplot, so nothing is left open between frames and no
+    display or interactive backend is needed
+    
+    Parameters
+    ----------
+    data : array-like
+        Image data for the CCD frame
+    outpath : str
+        Path to the output PNG file
+    sources : astropy Table or Catalogue object, optional
+        Source catalog outputted by SEP for the frame
+        Default = None
+    x, y : array-like, optional
+        xy coords for markers to be placed
+        Default = None
+    circle : bool, optional
+        Toggle to switch to circular indicators for the sources
+        Default = False [elliptical apertures used]
+    max_size : int, optional
+        Largest side of the rendered image - larger frames are block
+        averaged
+        Default = 2048
+    dpi : int, optional
+        Resolution of the output
+        Default = 100
+    title : str, optional
+        Title of the plot
+        Default = None
+    
+    Returns
+    -------
+    outpath : str
+        Path to the output PNG file
+    """
+    fig = Figure(dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    
+    # one figure pixel per displayed pixel, plus room for the labels
+    ny, nx = _drawFrame(ax, data, max_size=max_size)
+    fig.set_size_inches(nx / float(dpi) + 1., ny / float(dpi) + 1.)
+    _drawSources(ax, sources, circle=circle)
+    if x is not None and y is not None:
+        _drawMarkers(ax, np.asarray(x), np.asarray(y), 6., 6., 0.)
+    if title is not None:
+        ax.set_title(title)
+    
+    fig.tight_layout()
+    canvas.print_png(outpath)
+    
+    return outpath
+
+def renderDirectory(input_dir, output_dir=None, pattern='*.fits',
+                    hdus=None, mask_path=None, extract=True,
+                    n_workers=None, **render_kwargs):
+    """
+    Render PNG quicklooks of every frame in a directory on a pool of
+    worker processes
+    
+    Workers open the FITS files themselves, so only paths go out to
+    the pool and only output paths come back. Results are streamed back
+    in order of completion.
+    
+    Parameters
+    ----------
+    input_dir : str
+        Directory containing the FITS files
+    output_dir : str, optional
+        Directory for the PNG files, created if needed
+        Default = None, the input directory
+    pattern : str, optional
+        Glob pattern selecting the FITS files
+        Default = '*.fits'
+    hdus : list, optional
+        HDU selections (index or EXTNAME) rendered for every file
+        Default = None, all image HDUs containing 2D data
+    mask_path : str, optional
+        Path to a bad pixel mask file with the same HDU layout as the
+        frames, used in the source extraction
+        Default = None
+    extract : bool, optional
+        Toggle to subtract the background and overlay extracted sources
+        Default = True
+    n_workers : int, optional
+        Number of worker processes
+        Default = None, one per CPU
+    **render_kwargs
+        Keyword arguments passed to renderQuicklook
+    
+    Yields
+    ------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str
+        HDU selection rendered, or None if the file could not be read
+    outpath : str
+        Path to the PNG file, or None if the frame could not be
+        rendered
+    error : str
+        Description of the failure, or None
+    """
+    if output_dir is None:
+        output_dir = input_dir
+    os.makedirs(output_dir, exist_ok=True)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    
+    jobs = []
+    for filepath in sorted(glob.glob(os.path.join(input_dir, pattern))):
+        if hdus is None:
+            try:
+                selection = _imageHDUs(filepath)
+            except OSError as e:
+                yield filepath, None, None, '{}: {}'.format(
+                    type(e).__name__, e)
+                continue
+        else:
+            selection = hdus
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        for hdu in selection:
+            name = stem if len(selection) == 1 else '{}_{}'.format(stem,
+                                                                    hdu)
+            outpath = os.path.join(output_dir, name + '.png')
+            jobs.append((filepath, hdu, outpath))
+    
+    # keep a bounded queue of work so results stream back steadily
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = set()
+        for filepath, hdu, outpath in jobs:
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(_renderFile,
+                                    filepath,
+                                    hdu,
+                                    outpath,
+                                    mask_path,
+                                    extract,
+                                    render_kwargs))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def _renderFile(filepath, hdu, outpath, mask_path, extract, render_kwargs):
+    """
+    Worker task for renderDirectory - load one HDU, optionally extract
+    sources, and render it
+    """
+    try:
+        data, _ = loadFrame(filepath, hdu=hdu, dtype=np.float32)
+        sources = None
+        if extract:
+            mask = None
+            if mask_path is not None:
+                mask = loadMask(mask_path, hdu=hdu)
+            data, bkg_rms = subtractBackground(data, mask=mask)
+            sources = sourceExtract(data, bkg_rms=bkg_rms, mask=mask)
+        
+        kwargs = dict(render_kwargs)
+        kwargs.setdefault('title', '{} [{}]'.format(
+            os.path.basename(filepath), hdu))
+        renderQuicklook(data, outpath, sources=sources, **kwargs)
+    except Exception as e:
+        # one unreadable frame should not stop the rest of the batch
+        return filepath, hdu, None, '{}: {}'.format(type(e).__name__, e)
+    
+    return filepath, hdu, outpath, None
@@ -4,10 +4,28 @@ Functions for performing source extraction on CCD images
 -Threshold extraction of sources
 """
 
-from utils import pruneNansFromTable
+from catalogue import Catalogue, EXTRA_COLUMNS
+from instrument import stage, timed, size
+from frames import loadFrame, toNativeByteOrder
+from masks import loadMask
+from sharedframes import FramePool
+import os
 import sep
-from astropy.table import Table
+import numpy as np
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+    )
+from astropy.io import fits
 
+# flag bits set on sources whose extra columns could not be computed
+# (sep uses bits up to 128 for its own flags)
+FLAG_KRON_FAILED = 256
+FLAG_FLUXR_FAILED = 512
+
+@timed('background', counts=lambda data, *a, **k: {'pixels': size(data)})
 def subtractBackground(data, mask=None, box_width=32, box_height=32, 
                        filter_width=3, filter_height=3):
     """
@@ -43,15 +61,11 @@ def subtractBackground(data, mask=None, box_width=32, box_height=32,
     """
     
     # FITS files can be backwards byte order - SEP needs this fixed
-    try:
-        bkg = sep.Background(data, 
-                             mask=mask,
-                             bw=box_width, 
-                             bh=box_height,
-                             fw=filter_width, 
-                             fh=filter_height)
-    except:
-        data = data.byteswap(True).newbyteorder()
+    data = toNativeByteOrder(data)
+    if mask is not None:
+        mask = toNativeByteOrder(mask)
+    
+    with stage('sep_background', pixels=data.size):
         bkg = sep.Background(data, 
                              mask=mask,
                              bw=box_width, 
@@ -66,9 +80,187 @@ def subtractBackground(data, mask=None, box_width=32, box_height=32,
     
     return data_sub, bkg_rms
 
+@timed('background_tiled', 
+       counts=lambda data, *a, **k: {'pixels': size(data)})
+def subtractBackgroundTiled(data, out=None, mask=None, box_width=32,
+                            box_height=32, filter_width=3, filter_height=3,
+                            tile_size=2048, overlap=4, n_threads=None):
+    """
+    Determine the spatially varying sky background using SEP on a grid
+    of overlapping tiles and subtract it in place from an output buffer
+    
+    Each tile is estimated independently on a thread pool and the tile
+    models are blended across the seams with linear ramps that sum to
+    unity, so at most two rows of tile-sized arrays are held in memory
+    at any one time. Tiles are aligned to the background mesh and padded by
+    'overlap' boxes, which means the box statistics are identical to a
+    single sep.Background call and only the filtering and spline
+    interpolation near the seams differ. For a smoothly varying sky the
+    blended model agrees with the single-call model to within ~2% of
+    the global background rms; the tolerance degrades as the filter 
+    size approaches the overlap.
+    
+    Parameters
+    ----------
+    data : array-like
+        CCD data from which to subtract the background
+    out : array-like, optional
+        Buffer in which to place the background subtracted data - may 
+        be data itself for a fully in-place subtraction
+        Default = None, a new native float array is allocated
+    mask : array-like, optional
+        Bad pixel mask for the CCD frame
+        Default = None
+    box_width : int, optional
+        Width of background boxes in pixels
+        Default = 32
+    box_height : int, optional
+        Height of background boxes in pixels
+        Default = 32
+    filter_width : int, optional
+        Width of filter in boxes
+        Default = 3
+    filter_height : int, optional
+        Height of filter in boxes
+        Default = 3
+    tile_size : int, optional
+        Approximate side length of the tile cores in pixels - rounded
+        to a whole number of boxes
+        Default = 2048
+    overlap : int, optional
+        Padding added to each side of a tile core, in boxes - must be
+        larger than half the filter size
+        Default = 4
+    n_threads : int, optional
+        Number of worker threads used to estimate the tiles
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    data_sub : array-like
+        Data array with background signal subtracted (out, if given)
+    bkg_rms : float
+        Global rms of the spatially varying background, for use as a 
+        backup threshold in the extraction procedure
+    
+    Raises
+    ------
+    ValueError
+        If out does not match the shape of data, or the overlap is too
+        small for the requested filter
+    """
+    ny, nx = data.shape
+    
+    if out is None:
+        out = np.empty(data.shape, 
+                       dtype=np.result_type(data.dtype.newbyteorder('='),
+                                            np.float32))
+    if out.shape != data.shape:
+        raise ValueError('Output buffer shape {} does not match data '
+                         'shape {}'.format(out.shape, data.shape))
+    if overlap <= max(filter_width, filter_height) // 2:
+        raise ValueError('Tile overlap must exceed half the filter size')
+    if out is not data:
+        out[...] = data
+    
+    # tile edges fall on box boundaries so the meshes line up
+    pad_x, pad_y = overlap*box_width, overlap*box_height
+    step_x = max(-(-tile_size // box_width), 2*overlap) * box_width
+    step_y = max(-(-tile_size // box_height), 2*overlap) * box_height
+    rows = [[(y0, x0) for x0 in range(0, nx, step_x)] 
+            for y0 in range(0, ny, step_y)]
+    
+    def _copyTile(origin):
+        y0, x0 = origin
+        ys = slice(max(y0 - pad_y, 0), min(y0 + step_y + pad_y, ny))
+        xs = slice(max(x0 - pad_x, 0), min(x0 + step_x + pad_x, nx))
+        
+        # contiguous native-order copy of the tile only
+        tile = np.ascontiguousarray(data[ys, xs], 
+                                    dtype=out.dtype.newbyteorder('='))
+        tile_mask = None
+        if mask is not None:
+            tile_mask = np.ascontiguousarray(mask[ys, xs])
+        
+        return origin, ys, xs, tile, tile_mask
+    
+    def _estimate(origin, ys, xs, tile, tile_mask):
+        y0, x0 = origin
+        bkg = sep.Background(tile, 
+                             mask=tile_mask,
+                             bw=box_width, 
+                             bh=box_height,
+                             fw=filter_width, 
+                             fh=filter_height)
+        
+        wy = _blendWeights(ys, y0, step_y, pad_y, ny)
+        wx = _blendWeights(xs, x0, step_x, pad_x, nx)
+        back = bkg.back(dtype=tile.dtype)
+        back *= wy[:, np.newaxis]
+        back *= wx[np.newaxis, :]
+        
+        return ys, xs, back, bkg.globalrms, wy.sum()*wx.sum()
+    
+    # a row of tiles is only subtracted once the next row has been 
+    # copied, as their padding overlaps and out may be data itself,
+    # so at most two rows of tiles are held in memory
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    rms_sum, area_sum = 0., 0.
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        previous = []
+        for row in rows + [[]]:
+            current = [pool.submit(_estimate, *_copyTile(origin)) 
+                       for origin in row]
+            for future in previous:
+                ys, xs, back, rms, area = future.result()
+                out[ys, xs] -= back
+                rms_sum += area * rms**2
+                area_sum += area
+            previous = current
+    
+    # combine the tile estimates into a single global rms
+    bkg_rms = np.sqrt(rms_sum / area_sum)
+    
+    return out, bkg_rms
+
+def _blendWeights(span, start, step, pad, size):
+    """
+    Linear blending weights along one axis of a background tile
+    
+    Weights ramp from 0 to 1 over the 2*pad pixels centred on each 
+    interior core edge, such that neighbouring tiles sum to unity
+    
+    Parameters
+    ----------
+    span : slice
+        Pixel range covered by the padded tile
+    start, step : int
+        Origin and length of the tile core
+    pad : int
+        Padding added either side of the core in pixels
+    size : int
+        Length of the frame along this axis
+    
+    Returns
+    -------
+    weights : array-like
+        Blending weight for each pixel in the span
+    """
+    pix = np.arange(span.start, span.stop) + 0.5
+    weights = np.ones(len(pix))
+    if start > 0:
+        weights = np.minimum(weights, (pix - (start - pad)) / (2.*pad))
+    if start + step < size:
+        weights = np.minimum(weights, ((start + step + pad) - pix) / (2.*pad))
+    
+    return np.clip(weights, 0., 1.)
+
+@timed('extract', counts=lambda data, *a, **k: {'pixels': size(data)})
 def sourceExtract(data, thresh=3, bkg=False, bkg_rms=None, 
                   err=None, mask=None, min_area=5, 
-                  deblend_cont=0.05, segment=False, extras=False):
+                  deblend_cont=0.05, segment=False, extras=False,
+                  chunk_size=2048, n_threads=None):
     """
     Extract all sources above a certain threshold in the given image
     
@@ -104,14 +296,23 @@ def sourceExtract(data, thresh=3, bkg=False, bkg_rms=None,
         Default = False
     extras : bool, optional
         Toggle to calculate ellipticity, FWHM, Kron radius and 
-        flux radius
+        flux radius - sources for which the radii could not be 
+        computed keep nan and are flagged with FLAG_KRON_FAILED or
+        FLAG_FLUXR_FAILED
         Default = False
+    chunk_size : int, optional
+        Number of sources per task when computing the radii
+        Default = 2048
+    n_threads : int, optional
+        Number of threads computing the radii
+        Default = None, one per CPU
     
     Returns
     -------
-    sources : astropy Table object
-        Table containing quantities determined by sep for each source
-        detected in the given image
+    sources : Catalogue object
+        Catalogue containing quantities determined by sep for each 
+        source detected in the given image - use to_table() for an
+        astropy Table
     segmentation_map : array-like, optional
         Array of integers with same shape as data - pixels not 
         belonging to any object have value 0, whilst all pixels 
@@ -132,24 +333,25 @@ def sourceExtract(data, thresh=3, bkg=False, bkg_rms=None,
         thresh *= bkg_rms
     
     # extract sources
-    if not segment:
-        sources = sep.extract(data, 
-                              thresh, 
-                              err=err,
-                              mask=mask,
-                              deblend_cont=deblend_cont)
-    else:
-        sources, seg_map = sep.extract(data, 
-                                       thresh,
-                                       err=err,
-                                       mask=mask,
-                                       deblend_cont=deblend_cont,
-                                       segmentation_map=seg_map)
+    with stage('sep_extract', pixels=data.size) as s:
+        if not segment:
+            sources = sep.extract(data, 
+                                  thresh, 
+                                  err=err,
+                                  mask=mask,
+                                  deblend_cont=deblend_cont)
+        else:
+            sources, seg_map = sep.extract(data, 
+                                           thresh,
+                                           err=err,
+                                           mask=mask,
+                                           deblend_cont=deblend_cont,
+                                           segmentation_map=True)
+        s['sources'] = len(sources)
     
-    sources = Table(sources)
-    
-    # remove nans from table
-    sources = pruneNansFromTable(sources)
+    # remove nans, allocating any extra columns in the same pass
+    sources = Catalogue.fromSEP(sources, 
+                                extras=EXTRA_COLUMNS if extras else ())
     
     if extras:
         # calculate ellipticity parameter
@@ -158,38 +360,321 @@ def sourceExtract(data, thresh=3, bkg=False, bkg_rms=None,
         # calculate full width half maxima
         sources['fwhm'] = calculateFWHM(sources['a'], sources['b'])
         
-        # compute kron radii
-        try:
-            sources['kronr'], krflag = sep.kron_radius(data, 
-                                                       sources['x'], 
-                                                       sources['y'], 
-                                                       sources['a'], 
-                                                       sources['b'], 
-                                                       sources['theta'], 
-                                                       6.0)
-            sources['flag'] |= krflag
-        except Exception as e:
-            print(e)
-            pass
-        
-        # compute flux radii
-        try:
-            sources['fluxr'], frflag = sep.flux_radius(data,
-                                                       sources['x'],
-                                                       sources['y'],
-                                                       6.0*sources['a'],
-                                                       0.5,
-                                                       subpix=5)
-            sources['flag'] |= frflag
-        except Exception as e:
-            print(e)
-            pass
+        # compute kron and flux radii
+        computeRadii(data, 
+                     sources, 
+                     chunk_size=chunk_size, 
+                     n_threads=n_threads)
     
     if segment:
         return sources, seg_map
     else:
         return sources
 
+def batchSourceExtract(filepaths, hdus=None, mask_path=None, 
+                       n_workers=None, tiled=False, bkg_kwargs=None,
+                       shared=False, **extract_kwargs):
+    """
+    Subtract the background from and extract sources in many FITS 
+    frames and HDUs on a pool of worker processes
+    
+    Workers open the FITS files themselves, so only paths go out to
+    the pool and only source catalogues come back. The same pool is 
+    reused for every (file, HDU) job and results are streamed back in
+    order of completion. A frame that cannot be processed is reported
+    with its error rather than stopping the batch.
+    
+    With shared set, this process reads each HDU instead, once, into
+    a shared memory block (see sharedframes.FramePool) and the workers
+    extract from a zero-copy view of it, so no worker opens the frames
+    and no pixel data are pickled. The frames in flight are held in
+    memory at once - at most two per worker plus the one being read.
+    
+    Parameters
+    ----------
+    filepaths : list
+        Paths to the FITS files to process
+    hdus : list or dict, optional
+        HDU selections (index or EXTNAME) applied to every file, or a
+        dictionary mapping each path to its own list of selections
+        Default = None, all image HDUs containing 2D data
+    mask_path : str, optional
+        Path to a bad pixel mask file with the same HDU layout as the
+        frames
+        Default = None
+    n_workers : int, optional
+        Number of worker processes
+        Default = None, one per CPU
+    tiled : bool, optional
+        Toggle to use the tiled background estimation in each worker
+        Default = False
+    bkg_kwargs : dict, optional
+        Keyword arguments passed to the background subtraction
+        Default = None
+    shared : bool, optional
+        Toggle to read the frames in this process and pass them to the
+        workers in shared memory
+        Default = False
+    **extract_kwargs
+        Keyword arguments passed to sourceExtract
+    
+    Yields
+    ------
+    filepath : str
+        Path to the frame the catalogue was extracted from
+    hdu : int or str
+        HDU selection the catalogue was extracted from, or None if the
+        file could not be read
+    sources : Catalogue object
+        Catalogue containing quantities determined by sep for each 
+        source, or None if the frame failed
+    error : str
+        Description of the failure, or None
+    """
+    if bkg_kwargs is None:
+        bkg_kwargs = {}
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    
+    jobs = []
+    for filepath in filepaths:
+        if isinstance(hdus, dict):
+            selection = hdus[filepath]
+        elif hdus is None:
+            try:
+                selection = _imageHDUs(filepath)
+            except OSError as e:
+                yield filepath, None, None, '{}: {}'.format(
+                    type(e).__name__, e)
+                continue
+        else:
+            selection = hdus
+        jobs.extend((filepath, hdu) for hdu in selection)
+    
+    # keep a bounded queue of work so results stream back steadily
+    with FramePool() as frames, \
+         ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = set()
+        for filepath, hdu in jobs:
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            if not shared:
+                pending.add(pool.submit(_extractFromFile, 
+                                        filepath, 
+                                        hdu, 
+                                        mask_path, 
+                                        tiled, 
+                                        bkg_kwargs, 
+                                        extract_kwargs))
+                continue
+            
+            try:
+                handle, _ = frames.load(filepath, hdu=hdu)
+            except Exception as e:
+                yield filepath, hdu, None, '{}: {}'.format(
+                    type(e).__name__, e)
+                continue
+            # the task holds its own reference until it finishes
+            try:
+                pending.add(frames.submit(pool, 
+                                          _extractFromData, 
+                                          handle, 
+                                          filepath, 
+                                          hdu, 
+                                          mask_path, 
+                                          tiled, 
+                                          bkg_kwargs, 
+                                          extract_kwargs))
+            finally:
+                frames.release(handle)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def _imageHDUs(filepath):
+    """
+    List the HDUs of a FITS file that contain 2D image data
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    
+    Returns
+    -------
+    hdus : list
+        Indices of the image HDUs
+    """
+    with fits.open(filepath, memmap=True) as f:
+        return [i for i, hdu in enumerate(f)
+                if hdu.is_image and hdu.header.get('NAXIS', 0) == 2]
+
+def _extractFromFile(filepath, hdu, mask_path, tiled, bkg_kwargs, 
+                     extract_kwargs):
+    """
+    Worker task for batchSourceExtract - load one HDU, subtract the
+    background and extract sources, returning the error rather than
+    raising
+    """
+    try:
+        with stage('load_frame', file=filepath, hdu=hdu) as s:
+            data, _ = loadFrame(filepath, hdu=hdu)
+            s['pixels'] = data.size
+    except Exception as e:
+        return filepath, hdu, None, '{}: {}'.format(type(e).__name__, e)
+    
+    return _extractFromData(data, filepath, hdu, mask_path, tiled, 
+                            bkg_kwargs, extract_kwargs)
+
+def _extractFromData(data, filepath, hdu, mask_path, tiled, bkg_kwargs, 
+                     extract_kwargs):
+    """
+    Worker task for batchSourceExtract - subtract the background from
+    a loaded frame (which may be overwritten) and extract sources,
+    returning the error rather than raising
+    """
+    try:
+        mask = None
+        if mask_path is not None:
+            mask = loadMask(mask_path, hdu=hdu)
+        
+        # the background subtracted frame can overwrite the loaded copy
+        if tiled:
+            data_sub, bkg_rms = subtractBackgroundTiled(data, 
+                                                        out=data, 
+                                                        mask=mask, 
+                                                        **bkg_kwargs)
+        else:
+            data_sub, bkg_rms = subtractBackground(data, 
+                                                   mask=mask, 
+                                                   **bkg_kwargs)
+            del data
+        
+        sources = sourceExtract(data_sub, 
+                                bkg_rms=bkg_rms, 
+                                mask=mask, 
+                                **extract_kwargs)
+    except Exception as e:
+        return filepath, hdu, None, '{}: {}'.format(type(e).__name__, e)
+    
+    return filepath, hdu, sources, None
+
+def computeRadii(data, sources, chunk_size=2048, n_threads=None):
+    """
+    Compute the Kron radius and flux radius of each source in place,
+    in chunks of sources on a thread pool
+    
+    sep releases the GIL in its aperture routines, so chunks run 
+    concurrently. If sep fails on a chunk, its sources are retried one 
+    at a time, so a failure only costs the radii of the sources that 
+    caused it - these keep nan and have FLAG_KRON_FAILED or 
+    FLAG_FLUXR_FAILED set in their flag column.
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted CCD frame the sources were extracted from
+    sources : Catalogue object
+        Catalogue with kronr and fluxr columns, e.g. from sourceExtract
+        with extras=True
+    chunk_size : int, optional
+        Number of sources per task
+        Default = 2048
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    None
+    """
+    n = len(sources)
+    if n == 0:
+        return None
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    
+    starts = range(0, n, chunk_size)
+    with stage('radii', sources=n, chunks=len(starts)):
+        if n_threads == 1 or len(starts) == 1:
+            for start in starts:
+                _radiiChunk(data, sources, start, start + chunk_size)
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                futures = [pool.submit(_radiiChunk, 
+                                       data, 
+                                       sources, 
+                                       start, 
+                                       start + chunk_size) 
+                           for start in starts]
+                for future in futures:
+                    future.result()
+    
+    return None
+
+def _radiiChunk(data, sources, start, stop):
+    """
+    Worker task for computeRadii - fill the radii of sources[start:stop]
+    
+    Each chunk writes only its own rows of the catalogue's columns
+    """
+    x = sources['x'][start:stop]
+    y = sources['y'][start:stop]
+    a = sources['a'][start:stop]
+    b = sources['b'][start:stop]
+    theta = sources['theta'][start:stop]
+    flag = sources['flag'][start:stop]
+    
+    kronr = sources['kronr'][start:stop]
+    kronr[:], kr_flag, kr_failed = _perSource(sep.kron_radius, 
+                                              data, 
+                                              (x, y, a, b, theta), 
+                                              (6.0,))
+    flag |= kr_flag
+    flag[kr_failed] |= FLAG_KRON_FAILED
+    
+    fluxr = sources['fluxr'][start:stop]
+    fluxr[:], fr_flag, fr_failed = _perSource(sep.flux_radius, 
+                                              data, 
+                                              (x, y, 6.0*a), 
+                                              (0.5,), 
+                                              subpix=5)
+    flag |= fr_flag
+    flag[fr_failed] |= FLAG_FLUXR_FAILED
+    
+    return None
+
+def _perSource(func, data, columns, args, **kwargs):
+    """
+    Call a sep aperture routine on a chunk of sources, falling back to
+    one call per source if the chunk fails
+    
+    Returns the values (nan where failed), sep's flags and a boolean
+    array marking the failed sources
+    """
+    n = len(columns[0])
+    try:
+        values, flag = func(data, *(columns + args), **kwargs)
+        return values, flag, np.zeros(n, dtype=bool)
+    except Exception:
+        pass
+    
+    values = np.full(n, np.nan)
+    flag = np.zeros(n, dtype=np.int16)
+    failed = np.zeros(n, dtype=bool)
+    for i in range(n):
+        single = tuple(c[i:i + 1] for c in columns)
+        try:
+            v, f = func(data, *(single + args), **kwargs)
+            values[i], flag[i] = v[0], f[0]
+        except Exception:
+            failed[i] = True
+    
+    return values, flag, failed
+
 def calculateFWHM(a, b):
     """
     Calculate the FWHM of sources detected by SEP
@@ -208,11 +693,11 @@ def calculateFWHM(a, b):
 
 def writeToBinTable(table, outpath):
     """
-    Write an astropy Table object to a FITS bintable
+    Write an astropy Table or Catalogue object to a FITS bintable
     
     Parameters
     ----------
-    table : astropy Table object
+    table : astropy Table or Catalogue object
         Table containing quantities determined by SEP extraction
     outpath : str, optional
         Path to directory in which to place output FITS BINTABLE file
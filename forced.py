@@ -0,0 +1,659 @@
+"""
+Forced photometry at fixed sky positions across many CCD frames
+-Sky positions projected into each frame through its WCS solution
+-Circular or elliptical aperture sums with SEP, in chunks of positions
+-Frames measured in parallel on a pool of worker processes
+-Light curves written to a columnar HDF5 or Parquet store
+"""
+
+from frames import loadFrame, loadHeader, ccdNumber
+from masks import loadMask
+from extract import subtractBackground, sourceExtract
+from wcs import (
+    convertToPixels,
+    convertToDetector,
+    convertToWCS,
+    skyFootprint,
+    _unitVector,
+    )
+from catalogue import CatalogueWriter, readCatalogue
+from instrument import stage, enable
+import os
+import csv
+import time
+import argparse as ap
+import numpy as np
+import sep
+from astropy.io import fits
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+    )
+
+# columns measured for each position in each frame - CatalogueWriter
+# adds frame_id and ccd
+PHOT_COLUMNS = (('id', np.int64),
+                ('mjd', np.float64),
+                ('x', np.float32),
+                ('y', np.float32),
+                ('flux', np.float32),
+                ('fluxerr', np.float32),
+                ('flag', np.int16))
+
+# per-process positions, sent once to each worker by _initWorker
+_positions = {}
+
+def argParse():
+    """
+    Argument parser settings
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    args : array-like
+        Array of command line arguments
+    """
+    parser = ap.ArgumentParser()
+    
+    parser.add_argument('frames',
+                        help='CSV file listing the frames (img, wcs and '
+                             'optionally hdu columns)',
+                        type=str)
+    
+    parser.add_argument('store',
+                        help='light curve store (.h5 or .parquet)',
+                        type=str)
+    
+    parser.add_argument('--positions',
+                        help='CSV file of positions (ra, dec and '
+                             'optionally id columns)',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--reference',
+                        help='frame whose extracted sources are used as '
+                             'positions, if none are given',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--reference_wcs',
+                        help='WCS solution for the reference frame',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--reference_hdu',
+                        help='HDU (index or EXTNAME) of the reference '
+                             'frame',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--radius',
+                        help='aperture radius in pixels',
+                        type=float,
+                        default=5.)
+    
+    parser.add_argument('--ellipse',
+                        help='use elliptical apertures shaped like the '
+                             'reference sources, radius in units of '
+                             'their a and b?',
+                        action='store_true')
+    
+    parser.add_argument('--mask',
+                        help='bad pixel mask with the same HDU layout as '
+                             'the frames',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--workers',
+                        help='number of worker processes',
+                        type=int,
+                        default=None)
+    
+    parser.add_argument('--chunk_size',
+                        help='positions measured per call to SEP',
+                        type=int,
+                        default=10000)
+    
+    parser.add_argument('--trace',
+                        help='file to which per-stage timings are '
+                             'written as JSON lines (- for stderr)',
+                        type=str,
+                        default=None)
+    
+    return parser.parse_args()
+
+def _hduValue(value):
+    """
+    HDU selection from a string - an index if it contains only digits,
+    otherwise an EXTNAME
+    """
+    if value is None or str(value).strip() == '':
+        return None
+    value = str(value).strip()
+    
+    return int(value) if value.isdigit() else value
+
+def readPositions(filepath):
+    """
+    Read the sky positions to be measured from a CSV file
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to a CSV file with ra and dec columns (degrees), and
+        optionally an integer id column
+    
+    Returns
+    -------
+    ids : array-like
+        Identifier of each position - the row number if there is no id
+        column
+    ra, dec : array-like
+        World coords of the positions
+    
+    Raises
+    ------
+    ValueError
+        If the ra or dec column is missing
+    """
+    with open(filepath, newline='') as f:
+        rows = [row for row in csv.DictReader(f)]
+    if rows and not ('ra' in rows[0] and 'dec' in rows[0]):
+        raise ValueError('{} has no ra and dec columns'.format(filepath))
+    
+    ra = np.array([float(row['ra']) for row in rows])
+    dec = np.array([float(row['dec']) for row in rows])
+    if rows and rows[0].get('id'):
+        ids = np.array([int(row['id']) for row in rows], dtype=np.int64)
+    else:
+        ids = np.arange(len(rows), dtype=np.int64)
+    
+    return ids, ra, dec
+
+def readFrameList(filepath):
+    """
+    Read the frames to be measured from a CSV file
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to a CSV file with img and wcs columns, and optionally an
+        hdu column holding an index, an EXTNAME, or a ';'-separated list
+        of them - paths may contain {hdu}, filled in for each HDU
+    
+    Returns
+    -------
+    frames : list
+        (filepath, hdu, wcs_path) of each CCD frame
+    
+    Raises
+    ------
+    ValueError
+        If the img or wcs column is missing from a row
+    """
+    with open(filepath, newline='') as f:
+        rows = [row for row in csv.DictReader(f)]
+    
+    frames = []
+    for i, row in enumerate(rows):
+        if not row.get('img') or not row.get('wcs'):
+            raise ValueError('Frame list entry {} needs img and '
+                             'wcs'.format(i))
+        for hdu in (row.get('hdu') or '').split(';'):
+            hdu = _hduValue(hdu)
+            frames.append((row['img'].replace('{hdu}', str(hdu)),
+                           hdu,
+                           row['wcs'].replace('{hdu}', str(hdu))))
+    
+    return frames
+
+def catalogPositions(sources, hdr, wcs_hdr):
+    """
+    Sky positions of the sources in a sourceExtract catalogue, e.g.
+    from a first-epoch frame
+    
+    Parameters
+    ----------
+    sources : Catalogue or astropy Table object
+        Catalogue with pixel coords x, y (zero-based, as from sep)
+    hdr : astropy Header object
+        FITS header for the HDU, containing transformation coefficients
+        to detector coordinates
+    wcs_hdr : astropy Header object
+        FITS header containing the WCS solution
+    
+    Returns
+    -------
+    ra, dec : array-like
+        World coords of the sources
+    """
+    x_det, y_det = convertToDetector(np.asarray(sources['x']) + 1,
+                                     np.asarray(sources['y']) + 1,
+                                     hdr)
+    
+    return convertToWCS(x_det, y_det, wcs_hdr)
+
+def skyToFrame(ra, dec, hdr, wcs_hdr, margin=0.):
+    """
+    Project sky positions into the pixel coords of a CCD frame, keeping
+    those that land on it
+    
+    Positions are first culled with a cone around the footprint of the
+    frame, so only those nearby go through the (iterative) inverse
+    transforms
+    
+    Parameters
+    ----------
+    ra, dec : array-like
+        World coords of the positions
+    hdr : astropy Header object
+        FITS header for the HDU, containing transformation coefficients
+        to detector coordinates
+    wcs_hdr : astropy Header object
+        FITS header containing the WCS solution
+    margin : float, optional
+        Pixels by which positions must lie inside the frame edges
+        Default = 0.
+    
+    Returns
+    -------
+    index : array-like
+        Indices of the positions landing on the frame
+    x, y : array-like
+        Zero-based pixel coords (as used by sep) of those positions
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    nx, ny = hdr['NAXIS1'], hdr['NAXIS2']
+    
+    # cone through the centre of the footprint, slightly enlarged
+    corners = _unitVector(*skyFootprint(hdr, wcs_hdr, n_edge=4))
+    centre = corners.sum(axis=0)
+    centre /= np.linalg.norm(centre)
+    cos_radius = np.cos(1.05*np.arccos(np.clip(corners.dot(centre).min(),
+                                                -1.,
+                                                1.)))
+    index = np.nonzero(_unitVector(ra, dec).dot(centre) >= cos_radius)[0]
+    
+    x_det, y_det = convertToPixels(ra[index], dec[index], wcs_hdr)
+    x, y = convertToPixels(x_det, y_det, hdr)
+    x -= 1
+    y -= 1
+    inside = ((x >= margin - 0.5) & (x <= nx - 0.5 - margin) &
+              (y >= margin - 0.5) & (y <= ny - 0.5 - margin))
+    
+    return index[inside], x[inside], y[inside]
+
+def photometer(data, x, y, radius=5., shapes=None, err=None, mask=None,
+               gain=None, chunk_size=10000, subpix=5):
+    """
+    Sum the flux in apertures at many positions, a chunk of positions
+    per call to SEP
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted image data for the CCD frame
+    x, y : array-like
+        Zero-based pixel coords of the aperture centres
+    radius : float, optional
+        Aperture radius in pixels, or in units of a and b if shapes are
+        given
+        Default = 5.
+    shapes : tuple, optional
+        (a, b, theta) arrays of ellipse parameters, as from sep, for
+        elliptical apertures
+        Default = None, circular apertures
+    err : float or array-like, optional
+        Background noise per pixel
+        Default = None
+    mask : array-like, optional
+        Bad pixel mask, True for bad pixels
+        Default = None
+    gain : float, optional
+        Gain in electrons per count, to add Poisson noise to the errors
+        Default = None
+    chunk_size : int, optional
+        Positions measured per call
+        Default = 10000
+    subpix : int, optional
+        Subpixel sampling of the aperture edges
+        Default = 5
+    
+    Returns
+    -------
+    flux, fluxerr : array-like
+        Sum and its uncertainty for each aperture
+    flag : array-like
+        SEP aperture flags for each aperture
+    """
+    n = len(x)
+    flux = np.zeros(n, dtype=np.float64)
+    fluxerr = np.zeros(n, dtype=np.float64)
+    flag = np.zeros(n, dtype=np.int16)
+    kwargs = {'err': err, 'mask': mask, 'gain': gain, 'subpix': subpix}
+    
+    with stage('forced_photometry', positions=n):
+        for start in range(0, n, chunk_size):
+            s = slice(start, start + chunk_size)
+            if shapes is None:
+                result = sep.sum_circle(data, x[s], y[s], radius, **kwargs)
+            else:
+                a, b, theta = shapes
+                result = sep.sum_ellipse(data, x[s], y[s], a[s], b[s],
+                                         theta[s], r=radius, **kwargs)
+            flux[s], fluxerr[s], flag[s] = result
+    
+    return flux, fluxerr, flag
+
+def measureFrame(filepath, hdu, wcs_path, ids, ra, dec, radius=5.,
+                 shapes=None, mask_path=None, chunk_size=10000,
+                 bkg_kwargs=None):
+    """
+    Forced photometry of one CCD frame at every position landing on it
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str
+        HDU selection (index or EXTNAME) of the frame
+    wcs_path : str
+        Path to the WCS solution for the frame
+    ids : array-like
+        Identifier of each position
+    ra, dec : array-like
+        World coords of the positions
+    radius : float, optional
+        Aperture radius (see photometer)
+        Default = 5.
+    shapes : tuple, optional
+        (a, b, theta) arrays for elliptical apertures
+        Default = None
+    mask_path : str, optional
+        Path to a bad pixel mask file with the same HDU layout as the
+        frame
+        Default = None
+    chunk_size : int, optional
+        Positions measured per call to SEP
+        Default = 10000
+    bkg_kwargs : dict, optional
+        Keyword arguments passed to the background subtraction
+        Default = None
+    
+    Returns
+    -------
+    rows : array-like
+        Structured array with PHOT_COLUMNS for each position measured
+    """
+    if bkg_kwargs is None:
+        bkg_kwargs = {}
+    
+    hdr = loadHeader(filepath, hdu=hdu)
+    wcs_hdr = fits.getheader(wcs_path)
+    index, x, y = skyToFrame(ra, dec, hdr, wcs_hdr)
+    rows = np.zeros(len(index), dtype=list(PHOT_COLUMNS))
+    if len(index) == 0:
+        return rows
+    
+    mjd = hdr.get('MJD-OBS')
+    if mjd is None:
+        mjd = loadHeader(filepath, hdu=0).get('MJD-OBS', np.nan)
+    
+    with stage('load_frame', file=filepath, hdu=hdu) as s:
+        data, _ = loadFrame(filepath, hdu=hdu, dtype=np.float32)
+        mask = None
+        if mask_path is not None:
+            mask = loadMask(mask_path, hdu=hdu)
+        s['pixels'] = data.size
+    data_sub, bkg_rms = subtractBackground(data, mask=mask, **bkg_kwargs)
+    del data
+    
+    if shapes is not None:
+        shapes = tuple(np.asarray(p)[index] for p in shapes)
+    flux, fluxerr, flag = photometer(data_sub,
+                                     x,
+                                     y,
+                                     radius=radius,
+                                     shapes=shapes,
+                                     err=bkg_rms,
+                                     mask=mask,
+                                     gain=hdr.get('GAIN'),
+                                     chunk_size=chunk_size)
+    
+    rows['id'] = np.asarray(ids)[index]
+    rows['mjd'] = mjd
+    rows['x'] = x
+    rows['y'] = y
+    rows['flux'] = flux
+    rows['fluxerr'] = fluxerr
+    rows['flag'] = flag
+    
+    return rows
+
+def _initWorker(ids, ra, dec, shapes):
+    """
+    Hold the positions in a worker process, so they are sent once per
+    worker rather than once per frame
+    """
+    _positions.clear()
+    _positions.update(ids=ids, ra=ra, dec=dec, shapes=shapes)
+
+def _measureJob(filepath, hdu, wcs_path, options):
+    """
+    Worker task for forcedPhotometry - measure one frame, returning its
+    CCD number, or the error rather than raising
+    """
+    try:
+        ccd = ccdNumber(loadHeader(filepath, hdu=hdu), hdu)
+        rows = measureFrame(filepath,
+                            hdu,
+                            wcs_path,
+                            _positions['ids'],
+                            _positions['ra'],
+                            _positions['dec'],
+                            shapes=_positions['shapes'],
+                            **options)
+    except Exception as e:
+        return filepath, hdu, None, None, '{}: {}'.format(
+            type(e).__name__, e)
+    
+    return filepath, hdu, ccd, rows, None
+
+def forcedPhotometry(frames, ra, dec, store, ids=None, shapes=None,
+                     n_workers=None, **options):
+    """
+    Measure fixed sky positions in many CCD frames on a pool of worker
+    processes, appending the results to a light curve store
+    
+    Parameters
+    ----------
+    frames : list
+        (filepath, hdu, wcs_path) of each CCD frame, e.g. from
+        readFrameList
+    ra, dec : array-like
+        World coords of the positions
+    store : str
+        Path to the light curve store (.h5 or .parquet), appended to
+        if it exists
+    ids : array-like, optional
+        Integer identifier of each position
+        Default = None, the index of the position
+    shapes : tuple, optional
+        (a, b, theta) arrays for elliptical apertures
+        Default = None, circular apertures
+    n_workers : int, optional
+        Number of worker processes
+        Default = None, one per CPU
+    **options
+        Keyword arguments for measureFrame (radius, mask_path,
+        chunk_size, bkg_kwargs)
+    
+    Yields
+    ------
+    filepath : str
+        Path to the frame measured
+    hdu : int or str
+        HDU selection measured
+    n_measured : int
+        Number of positions measured in the frame, or None if it failed
+    error : str
+        Description of the failure, or None
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    if ids is None:
+        ids = np.arange(len(ra), dtype=np.int64)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    
+    def _record(future):
+        filepath, hdu, ccd, rows, error = future.result()
+        if rows is None:
+            return filepath, hdu, None, error
+        if len(rows):
+            writer.append(rows, os.path.basename(filepath), ccd=ccd)
+        return filepath, hdu, len(rows), None
+    
+    # keep a bounded queue of work so results stream back steadily
+    with CatalogueWriter(store) as writer, \
+         ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_initWorker,
+                             initargs=(np.asarray(ids), ra, dec,
+                                       shapes)) as pool:
+        pending = set()
+        for filepath, hdu, wcs_path in frames:
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _record(future)
+            pending.add(pool.submit(_measureJob,
+                                    filepath,
+                                    hdu,
+                                    wcs_path,
+                                    options))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield _record(future)
+
+def readLightCurves(filepath, ids=None, columns=('flux', 'fluxerr', 'flag')):
+    """
+    Read light curves from a store written by forcedPhotometry, as
+    arrays of positions by epochs
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the light curve store
+    ids : array-like, optional
+        Identifiers of the positions to read
+        Default = None, every position
+    columns : tuple, optional
+        Measured columns to read
+        Default = ('flux', 'fluxerr', 'flag')
+    
+    Returns
+    -------
+    curves : dict
+        ids of the positions, frame_id and mjd of the epochs (in time
+        order), and a (positions, epochs) array for each column - nan,
+        or -1 for flags, where a position was not measured
+    """
+    rows = readCatalogue(filepath,
+                         columns=['id', 'mjd', 'frame_id'] + list(columns))
+    keep = np.ones(len(rows), dtype=bool)
+    if ids is not None:
+        keep = np.isin(rows['id'], ids)
+    
+    row_ids = np.asarray(rows['id'])[keep]
+    frame_ids = np.asarray(rows['frame_id'])[keep]
+    mjds = np.asarray(rows['mjd'])[keep]
+    
+    # epochs are frames, ordered by time
+    epochs, first, epoch = np.unique(frame_ids,
+                                     return_index=True,
+                                     return_inverse=True)
+    order = np.argsort(mjds[first], kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    epoch = rank[epoch]
+    
+    position_ids, position = np.unique(row_ids, return_inverse=True)
+    curves = {'id': position_ids,
+              'frame_id': epochs[order],
+              'mjd': mjds[first][order]}
+    shape = (len(position_ids), len(epochs))
+    for name in columns:
+        values = np.asarray(rows[name])[keep]
+        if name == 'flag':
+            curve = np.full(shape, -1, dtype=np.int16)
+        else:
+            curve = np.full(shape, np.nan, dtype=np.float64)
+        curve[position, epoch] = values
+        curves[name] = curve
+    
+    return curves
+
+if __name__ == "__main__":
+	
+	args = argParse()
+	if args.trace is not None:
+		enable(args.trace)
+	
+	shapes = None
+	if args.positions is not None:
+		ids, ra, dec = readPositions(args.positions)
+	elif args.reference is not None and args.reference_wcs is not None:
+		hdu = _hduValue(args.reference_hdu)
+		data, hdr = loadFrame(args.reference, hdu=hdu, dtype=np.float32)
+		mask = None
+		if args.mask is not None:
+			mask = loadMask(args.mask, hdu=hdu)
+		data_sub, bkg_rms = subtractBackground(data, mask=mask)
+		sources = sourceExtract(data_sub, bkg_rms=bkg_rms, mask=mask)
+		ra, dec = catalogPositions(sources,
+		                           hdr,
+		                           fits.getheader(args.reference_wcs))
+		ids = np.arange(len(ra), dtype=np.int64)
+		if args.ellipse:
+			shapes = (np.asarray(sources['a']),
+			          np.asarray(sources['b']),
+			          np.asarray(sources['theta']))
+		print('{} sources extracted from {}'.format(len(ra),
+		                                            args.reference))
+	else:
+		print('Give --positions, or --reference and --reference_wcs...')
+		quit()
+	
+	frames = readFrameList(args.frames)
+	start = time.perf_counter()
+	n_rows, n_failed = 0, 0
+	for filepath, hdu, n, error in forcedPhotometry(
+			frames,
+			ra,
+			dec,
+			args.store,
+			ids=ids,
+			shapes=shapes,
+			n_workers=args.workers,
+			radius=args.radius,
+			mask_path=args.mask,
+			chunk_size=args.chunk_size):
+		if error is None:
+			n_rows += n
+			print('{} [{}] {} positions measured'.format(filepath, hdu, n))
+		else:
+			n_failed += 1
+			print('{} [{}] failed: {}'.format(filepath, hdu, error))
+	
+	print('{} frames ({} failed), {} measurements in {:.1f} s - written '
+	      'to {}'.format(len(frames),
+	                     n_failed,
+	                     n_rows,
+	                     time.perf_counter() - start,
+	                     args.store))
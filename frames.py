@@ -0,0 +1,277 @@
+"""
+Functions for loading CCD frames from FITS files
+-Memory-mapped HDU access
+-HDU selection by index, EXTNAME or CCD number
+-Conversion to native byte order
+"""
+
+import numpy as np
+from astropy.io import fits
+
+# header keywords identifying the CCD of a mosaic extension (INT WFC)
+CCD_KEYWORDS = ('IMAGEID', 'CCDNUM', 'CCD_NUM')
+
+def selectHDU(hdulist, hdu=None, extname=None, ccd=None):
+    """
+    Determine the index of an HDU in a FITS file
+    
+    Parameters
+    ----------
+    hdulist : astropy HDUList object
+        Opened FITS file
+    hdu : int or str, optional
+        Index of the HDU - a string is treated as an EXTNAME, or as an
+        index if it contains only digits
+        Default = None
+    extname : str, optional
+        EXTNAME of the HDU (case insensitive)
+        Default = None
+    ccd : int, optional
+        CCD number of the HDU, matched against CCD_KEYWORDS
+        Default = None
+    
+    Returns
+    -------
+    index : int
+        Index of the selected HDU
+    
+    Raises
+    ------
+    KeyError
+        If no HDU matches the selection
+    """
+    if isinstance(hdu, str):
+        if hdu.strip().isdigit():
+            hdu = int(hdu)
+        else:
+            hdu, extname = None, hdu
+    
+    if hdu is not None:
+        if not -len(hdulist) <= hdu < len(hdulist):
+            raise KeyError('HDU {} not in range 0--{}'.format(hdu,
+                                                              len(hdulist)-1))
+        return hdu % len(hdulist)
+    
+    if extname is not None:
+        for i, h in enumerate(hdulist):
+            if h.name.upper() == extname.strip().upper():
+                return i
+        raise KeyError('No HDU with EXTNAME {}'.format(extname))
+    
+    if ccd is not None:
+        for i, h in enumerate(hdulist):
+            for key in CCD_KEYWORDS:
+                if key in h.header and str(h.header[key]) == str(ccd):
+                    return i
+        raise KeyError('No HDU for CCD {}'.format(ccd))
+    
+    # default to the first HDU containing data
+    for i, h in enumerate(hdulist):
+        if h.header.get('NAXIS', 0) > 0:
+            return i
+    raise KeyError('No HDU containing data')
+
+def ccdNumber(header, hdu=None):
+    """
+    Determine the CCD number of an HDU, for tagging its sources
+    
+    Parameters
+    ----------
+    header : astropy Header object
+        Header of the HDU
+    hdu : int or str, optional
+        Index or EXTNAME the HDU was selected with, used when the 
+        header has none of CCD_KEYWORDS
+        Default = None
+    
+    Returns
+    -------
+    ccd : int
+        Value of the first of CCD_KEYWORDS in the header, else the HDU
+        index, else 0
+    """
+    for key in CCD_KEYWORDS:
+        if key in header:
+            try:
+                return int(header[key])
+            except (TypeError, ValueError):
+                pass
+    
+    if isinstance(hdu, str) and hdu.strip().isdigit():
+        hdu = int(hdu)
+    if isinstance(hdu, (int, np.integer)):
+        return int(hdu)
+    
+    return 0
+
+def toNativeByteOrder(data, dtype=None, inplace=False):
+    """
+    Convert an array to native byte order, optionally changing type
+    
+    Parameters
+    ----------
+    data : array-like
+        Array to convert - FITS data are big-endian
+    dtype : data-type, optional
+        Output data type, forced to native byte order
+        Default = None, keep the input type
+    inplace : bool, optional
+        Toggle to byteswap the input buffer in place where possible,
+        rather than allocating a converted copy - only use on arrays
+        nothing else refers to
+        Default = False
+    
+    Returns
+    -------
+    data : array-like
+        C-contiguous native byte order array - the input itself if no
+        conversion was needed
+    """
+    data = np.asanyarray(data)
+    if dtype is None:
+        dtype = data.dtype
+    dtype = np.dtype(dtype).newbyteorder('=')
+    
+    if data.dtype == dtype and data.flags.c_contiguous:
+        return data
+    
+    # a pure byteswap can be done in the existing buffer
+    if (inplace and
+        data.dtype != dtype and
+        data.flags.writeable and
+        data.flags.c_contiguous and
+        data.dtype.newbyteorder('=') == dtype):
+        data.byteswap(True)
+        return data.view(dtype)
+    
+    return np.ascontiguousarray(data, dtype=dtype)
+
+def loadFrame(filepath, hdu=None, extname=None, ccd=None, dtype=None,
+              memmap=True):
+    """
+    Load the data and header of a CCD frame from a FITS file
+    
+    The file is memory-mapped copy-on-write, so only the selected HDU
+    is read, and the data are converted to native byte order once, in
+    place when no change of type is requested. FITS data are big-endian,
+    so the swap writes every page of the HDU and the whole frame ends 
+    up resident as a private copy - what is saved is the second, 
+    converted copy (and any upcast to float64), not the frame itself. 
+    Use loadSection to hold only part of a frame in memory.
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str, optional
+        Index or EXTNAME of the HDU
+        Default = None
+    extname : str, optional
+        EXTNAME of the HDU
+        Default = None
+    ccd : int, optional
+        CCD number of the HDU
+        Default = None
+    dtype : data-type, optional
+        Output data type - e.g. np.float32 to halve memory relative to
+        float64
+        Default = None, keep the type stored in the file
+    memmap : bool, optional
+        Toggle to memory-map the file
+        Default = True
+    
+    Returns
+    -------
+    data : array-like
+        Native byte order image data for the HDU
+    header : astropy Header object
+        Header for the HDU
+    
+    Raises
+    ------
+    FileNotFoundError
+        If the file does not exist
+    KeyError
+        If no HDU matches the selection
+    """
+    mode = 'copyonwrite' if memmap else 'readonly'
+    with fits.open(filepath, memmap=memmap, mode=mode) as f:
+        index = selectHDU(f, hdu=hdu, extname=extname, ccd=ccd)
+        header = f[index].header
+        data = toNativeByteOrder(f[index].data, dtype=dtype, inplace=True)
+    
+    return data, header
+
+def loadHeader(filepath, hdu=None, extname=None, ccd=None):
+    """
+    Load only the header of a CCD frame from a FITS file
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    hdu : int or str, optional
+        Index or EXTNAME of the HDU
+        Default = None
+    extname : str, optional
+        EXTNAME of the HDU
+        Default = None
+    ccd : int, optional
+        CCD number of the HDU
+        Default = None
+    
+    Returns
+    -------
+    header : astropy Header object
+        Header for the HDU
+    """
+    with fits.open(filepath, memmap=True) as f:
+        index = selectHDU(f, hdu=hdu, extname=extname, ccd=ccd)
+        return f[index].header
+
+
+def loadSection(filepath, x_range, y_range, hdu=None, extname=None, 
+                ccd=None, dtype=None):
+    """
+    Load a rectangular section of a CCD frame from a FITS file, reading
+    only the rows and columns required from disk
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    x_range, y_range : tuple
+        Zero-based (start, stop) array bounds of the section, with stop
+        exclusive - e.g. from wcs.overlapBoundingBox
+    hdu : int or str, optional
+        Index or EXTNAME of the HDU
+        Default = None
+    extname : str, optional
+        EXTNAME of the HDU
+        Default = None
+    ccd : int, optional
+        CCD number of the HDU
+        Default = None
+    dtype : data-type, optional
+        Output data type
+        Default = None, keep the type stored in the file
+    
+    Returns
+    -------
+    data : array-like
+        Native byte order image data for the section
+    header : astropy Header object
+        Header for the full HDU
+    offset : tuple
+        (x0, y0) zero-based position of the section in the full frame,
+        to be subtracted from full frame pixel coordinates
+    """
+    x0, x1 = x_range
+    y0, y1 = y_range
+    with fits.open(filepath, memmap=True) as f:
+        index = selectHDU(f, hdu=hdu, extname=extname, ccd=ccd)
+        header = f[index].header
+        data = f[index].section[y0:y1, x0:x1]
+        data = toNativeByteOrder(data, dtype=dtype, inplace=True)
+    
+    return data, header, (x0, y0)
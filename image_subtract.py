@@ -4,27 +4,40 @@ Align and subtract two overlapping INT WFC FITS CCD images
 """
 
 from wcs import (
-    convertToDetector,
-    convertToWCS,
     convertToPixels,
+    pixelToPixel,
+    overlapBoundingBox,
+    footprintOverlap,
+    pointsInPolygon,
+    polygonArea,
     )
+from frames import (
+    loadFrame,
+    loadHeader,
+    loadSection,
+    selectHDU,
+    )
+from align import fitWarp, alignImage
+from masks import loadMask
+from extract import subtractBackground, sourceExtract
+from psfmatch import subtractImages, selectStamps, stampWidth
 from diagnostics import plotXY
+from instrument import stage, enable
 import argparse as ap
 import numpy as np
 import cv2
-import random
 import warnings
 from astropy.io import fits
-from astropy.table import Table
-from astropy import units as u
 from astropy.utils.exceptions import AstropyWarning
-from astropy.coordinates import SkyCoord, match_coordinates_sky
 
 try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
 
+# largest grid laid over the overlap bounding box, per control point
+MAX_CELLS_PER_POINT = 100
+
 # disable astropy warnings - INT WCS is deprecated
 warnings.simplefilter('ignore', category=AstropyWarning)
 
@@ -63,150 +76,446 @@ def argParse():
                         help='path to bad pixel mask for the frames',
                         type=str)
     
+    parser.add_argument('--hdu_1',
+                        help='HDU (index or EXTNAME) of CCD frame 1 - '
+                             'asked for if not given',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--hdu_2',
+                        help='HDU (index or EXTNAME) of CCD frame 2 - '
+                             'asked for if not given',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--mask_hdu',
+                        help='HDU (index or EXTNAME) of the bad pixel '
+                             'mask - asked for if not given',
+                        type=str,
+                        default=None)
+    
+    parser.add_argument('--float32',
+                        help='load frames as float32 to save memory?',
+                        action='store_true')
+    
+    parser.add_argument('--roi',
+                        help='only read the section of frame 2 that '
+                             'overlaps frame 1?',
+                        action='store_true')
+    
+    parser.add_argument('--warp',
+                        help='model used to align frame 2 to frame 1',
+                        choices=['homography', 'polynomial'],
+                        default='homography')
+    
+    parser.add_argument('--out',
+                        help='path for the output difference image',
+                        type=str,
+                        default='difference.fits')
+    
     parser.add_argument('--diagnostics',
                         help='include sanity checks?',
                         action='store_true')
     
+    parser.add_argument('--trace',
+                        help='file to which per-stage timings are '
+                             'written as JSON lines (- for stderr)',
+                        type=str,
+                        default=None)
+    
     return parser.parse_args()
 
+def promptHDU(filepath):
+    """
+    Ask the user which HDU of a FITS file to use
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the FITS file
+    
+    Returns
+    -------
+    hdu : int
+        Index of the selected HDU
+    
+    Raises
+    ------
+    FileNotFoundError
+        If the file does not exist
+    """
+    with fits.open(filepath, memmap=True) as f:
+        names = ['{}:{}'.format(i, h.name) for i, h in enumerate(f)]
+        while True:
+            check = input('Please specify relevant HDU (index or EXTNAME): ')
+            try:
+                hdu = selectHDU(f, hdu=check)
+            except KeyError:
+                print('Invalid selection...\n'
+                      'Options: {}'.format(', '.join(names)))
+                continue
+            print('Proceeding with HDU {}...'.format(hdu))
+            return hdu
+
+def sampleOverlap(hdr_1, wcs_1, wcs_2, hdr_2, n_points=1000, seed=0,
+                  shape_2=None, offset_2=(0, 0), n_edge=16):
+    """
+    Generate control points spread evenly over the region in which two
+    CCD frames overlap on the sky
+    
+    The footprints of the two frames are intersected on the sky and a
+    stratified (jittered grid) sample of points is drawn inside the 
+    overlap, in the pixel coordinates of frame 1, and then mapped into
+    frame 2
+    
+    Parameters
+    ----------
+    hdr_1, hdr_2 : astropy Header object
+        FITS headers for the HDUs, containing transformation 
+        coefficients to detector coordinates
+    wcs_1, wcs_2 : astropy Header object
+        FITS headers containing the WCS solutions
+    n_points : int, optional
+        Approximate number of control points to generate
+        Default = 1000
+    seed : int, optional
+        Seed for the random jitter, for reproducible samples
+        Default = 0
+    shape_2 : tuple, optional
+        (ny, nx) shape of the loaded image 2, if only a section was read
+        Default = None, full frame from hdr_2
+    offset_2 : tuple, optional
+        (x0, y0) position of the loaded section in the full frame 2
+        Default = (0, 0)
+    n_edge : int, optional
+        Number of vertices along each edge of the frame footprints
+        Default = 16
+    
+    Returns
+    -------
+    x_1, y_1 : array-like
+        Pixel coords of the control points in frame 1
+    x_2, y_2 : array-like
+        Pixel coords of the control points in frame 2 (or the loaded
+        section of it)
+    """
+    empty = np.array([])
+    
+    ra, dec = footprintOverlap(hdr_1, wcs_1, wcs_2, hdr_2, n_edge=n_edge)
+    if len(ra) == 0:
+        return empty, empty, empty, empty
+    
+    # overlap polygon in the pixel coords of frame 1
+    x_det, y_det = convertToPixels(ra, dec, wcs_1)
+    poly_x, poly_y = convertToPixels(x_det, y_det, hdr_1)
+    
+    x_min = max(poly_x.min(), 0.5)
+    x_max = min(poly_x.max(), hdr_1['NAXIS1'] + 0.5)
+    y_min = max(poly_y.min(), 0.5)
+    y_max = min(poly_y.max(), hdr_1['NAXIS2'] + 0.5)
+    area = abs(polygonArea(poly_x, poly_y))
+    if x_min >= x_max or y_min >= y_max or area == 0:
+        return empty, empty, empty, empty
+    
+    # one jittered point per cell of the overlap area, so ~n_points
+    # land inside - the grid over the bounding box is capped for thin or
+    # corner overlaps that fill little of it
+    box_area = (x_max - x_min) * (y_max - y_min)
+    cell = max(np.sqrt(area / n_points),
+               np.sqrt(box_area / (MAX_CELLS_PER_POINT * n_points)))
+    n_x = max(int(np.ceil((x_max - x_min) / cell)), 1)
+    n_y = max(int(np.ceil((y_max - y_min) / cell)), 1)
+    
+    rng = np.random.RandomState(seed)
+    i, j = np.meshgrid(np.arange(n_x), np.arange(n_y))
+    i = i.ravel() + rng.uniform(size=i.size)
+    j = j.ravel() + rng.uniform(size=j.size)
+    x_1 = x_min + i * (x_max - x_min) / n_x
+    y_1 = y_min + j * (y_max - y_min) / n_y
+    
+    inside = pointsInPolygon(x_1, y_1, poly_x, poly_y)
+    x_1, y_1 = x_1[inside], y_1[inside]
+    
+    # map into frame 2 and drop any that miss the loaded pixels
+    x_2, y_2 = pixelToPixel(x_1, y_1, hdr_1, wcs_1, wcs_2, hdr_2)
+    x_2 -= offset_2[0]
+    y_2 -= offset_2[1]
+    if shape_2 is None:
+        shape_2 = (hdr_2['NAXIS2'], hdr_2['NAXIS1'])
+    keep = ((x_2 >= 0.5) & (x_2 <= shape_2[1] + 0.5) &
+            (y_2 >= 0.5) & (y_2 <= shape_2[0] + 0.5))
+    
+    return x_1[keep], y_1[keep], x_2[keep], y_2[keep]
+
+def alignAndSubtract(img_1, hdr_1, wcs_1, img_2, hdr_2, wcs_2, mask, 
+                     mask_2=None, offset_2=(0, 0), sources_1=None, 
+                     warp_model='homography', diagnostics=False, 
+                     verbose=True):
+    """
+    Align frame 2 to frame 1 and subtract the PSF-matched frames
+    
+    Parameters
+    ----------
+    img_1, img_2 : array-like
+        Image data for the CCD frames - img_2 may be a section of the
+        frame, placed by offset_2
+    hdr_1, hdr_2 : astropy Header object
+        FITS headers for the HDUs, containing transformation 
+        coefficients to detector coordinates
+    wcs_1, wcs_2 : astropy Header object
+        FITS headers containing the WCS solutions
+    mask : array-like
+        Bad pixel mask for frame 1, or None
+    mask_2 : array-like, optional
+        Bad pixel mask for the loaded part of frame 2
+        Default = None, the same section of mask
+    offset_2 : tuple, optional
+        (x0, y0) position of the loaded section in the full frame 2
+        Default = (0, 0)
+    sources_1 : Catalogue object, optional
+        Sources extracted from frame 1, used to fit the PSF-matching
+        kernel
+        Default = None, extracted here
+    warp_model : str, optional
+        Model used to align frame 2 to frame 1, 'homography' or 
+        'polynomial'
+        Default = 'homography'
+    diagnostics : bool, optional
+        Toggle to plot the control points on the frames
+        Default = False
+    verbose : bool, optional
+        Toggle to print progress
+        Default = True
+    
+    Returns
+    -------
+    difference : array-like
+        Difference image on the pixel grid of frame 1
+    info : dict
+        Number of control points (points), warp rms residual 
+        (warp_rms) and number of sources in frame 1 (sources)
+    
+    Raises
+    ------
+    ValueError
+        If the frames do not overlap, or the alignment or PSF-matching
+        fails
+    """
+    # sample control points over the overlap of the two images
+    with stage('sample_overlap') as s:
+        x_1, y_1, x_2, y_2 = sampleOverlap(hdr_1, 
+                                           wcs_1, 
+                                           wcs_2, 
+                                           hdr_2, 
+                                           n_points=1000,
+                                           shape_2=img_2.shape,
+                                           offset_2=offset_2)
+        s['points'] = len(x_1)
+    if len(x_1) == 0:
+        raise ValueError('Images do not overlap')
+    
+    if diagnostics:
+        plotXY(img_1, x_1, y_1)
+        plotXY(img_2, x_2, y_2)
+    
+    if verbose:
+        print('Aligning image 2 to image 1...')
+    
+    # bad pixel mask covering the loaded part of image 2
+    if mask_2 is None and mask is not None:
+        mask_2 = mask[offset_2[1]:offset_2[1] + img_2.shape[0],
+                      offset_2[0]:offset_2[0] + img_2.shape[1]]
+    
+    with stage('fit_warp', points=len(x_1)):
+        warp = fitWarp(x_1, y_1, x_2, y_2, model=warp_model)
+    if verbose:
+        print('Warp rms residual: {:.3f} pixels'.format(warp.rms))
+    with stage('align', pixels=img_1.size):
+        aligned_2, aligned_mask_2 = alignImage(img_2, 
+                                               warp, 
+                                               img_1.shape, 
+                                               mask=mask_2)
+    
+    if sources_1 is None:
+        if verbose:
+            print('Extracting sources from image 1...')
+        data_1, bkg_rms_1 = subtractBackground(img_1, mask=mask)
+        sources_1 = sourceExtract(data_1, bkg_rms=bkg_rms_1, mask=mask)
+        del data_1
+    
+    # the frame with the better seeing is convolved to match the other
+    bad = aligned_mask_2 if mask is None else mask | aligned_mask_2
+    x_s, y_s = selectStamps(sources_1, img_1.shape, mask=bad)
+    if stampWidth(img_1, x_s, y_s) < stampWidth(aligned_2, x_s, y_s):
+        image, template, sign = aligned_2, img_1, -1
+    else:
+        image, template, sign = img_1, aligned_2, 1
+    
+    if verbose:
+        print('Subtracting PSF-matched images...')
+    with stage('psf_subtract', pixels=image.size, sources=len(sources_1)):
+        difference, kernel = subtractImages(image, 
+                                            template, 
+                                            sources_1, 
+                                            mask=bad)
+    if sign < 0:
+        difference *= -1
+    
+    info = {'points': len(x_1), 
+            'warp_rms': float(warp.rms), 
+            'sources': len(sources_1)}
+    
+    return difference, info
+
+def subtractPair(img_1, img_2, wcs_1, wcs_2, bp_mask, out, hdu_1=None, 
+                 hdu_2=None, mask_hdu=None, dtype=np.float64, roi=False, 
+                 warp_model='homography', diagnostics=False, verbose=True):
+    """
+    Align and subtract two overlapping CCD frames read from FITS files,
+    writing the difference image on the pixel grid of frame 1
+    
+    Parameters
+    ----------
+    img_1, img_2 : str
+        Paths to the CCD frames
+    wcs_1, wcs_2 : str
+        Paths to the WCS solutions for the frames
+    bp_mask : str
+        Path to the bad pixel mask for the frames
+    out : str
+        Path for the output difference image
+    hdu_1, hdu_2, mask_hdu : int or str, optional
+        HDU (index or EXTNAME) of each frame and of the mask
+        Default = None, the first HDU containing data
+    dtype : data-type, optional
+        Type in which the frames are loaded
+        Default = np.float64
+    roi : bool, optional
+        Toggle to read only the section of frame 2 that overlaps frame 1
+        Default = False
+    warp_model : str, optional
+        Model used to align frame 2 to frame 1
+        Default = 'homography'
+    diagnostics : bool, optional
+        Toggle to plot the control points on the frames
+        Default = False
+    verbose : bool, optional
+        Toggle to print progress
+        Default = True
+    
+    Returns
+    -------
+    info : dict
+        As for alignAndSubtract, plus the path of the difference image
+        (out)
+    
+    Raises
+    ------
+    FileNotFoundError
+        If a frame, WCS solution or the mask does not exist
+    KeyError
+        If an HDU selection does not match the file
+    ValueError
+        If the frames do not overlap, or the subtraction fails
+    """
+    if verbose:
+        print('Loading image 1...')
+    with stage('load_image_1', file=img_1) as s:
+        data_1, hdr_1 = loadFrame(img_1, hdu=hdu_1, dtype=dtype)
+        s['pixels'] = data_1.size
+    
+    if verbose:
+        print('Loading wcs information...')
+    with fits.open(wcs_1) as w1:
+        wcs_hdr_1 = w1[0].header
+    with fits.open(wcs_2) as w2:
+        wcs_hdr_2 = w2[0].header
+    
+    if verbose:
+        print('Loading image 2...')
+    with stage('load_image_2', file=img_2) as s:
+        if roi:
+            # read only the part of frame 2 that overlaps frame 1
+            hdr_2 = loadHeader(img_2, hdu=hdu_2)
+            bbox = overlapBoundingBox(hdr_1, 
+                                      wcs_hdr_1, 
+                                      wcs_hdr_2, 
+                                      hdr_2, 
+                                      margin=8)
+            if bbox is None:
+                raise ValueError('Images do not overlap')
+            data_2, hdr_2, offset_2 = loadSection(img_2,
+                                                  bbox[:2],
+                                                  bbox[2:],
+                                                  hdu=hdu_2,
+                                                  dtype=dtype)
+        else:
+            data_2, hdr_2 = loadFrame(img_2, hdu=hdu_2, dtype=dtype)
+            offset_2 = (0, 0)
+        s['pixels'] = data_2.size
+    
+    if verbose:
+        print('Loading bad pixel mask...')
+    mask = loadMask(bp_mask, hdu=mask_hdu)
+    
+    difference, info = alignAndSubtract(data_1, 
+                                        hdr_1, 
+                                        wcs_hdr_1, 
+                                        data_2, 
+                                        hdr_2, 
+                                        wcs_hdr_2, 
+                                        mask, 
+                                        offset_2=offset_2,
+                                        warp_model=warp_model,
+                                        diagnostics=diagnostics,
+                                        verbose=verbose)
+    
+    with stage('write_difference', file=out):
+        fits.writeto(out, difference, hdr_1, overwrite=True)
+    if verbose:
+        print('Difference image written to {}'.format(out))
+    info['out'] = out
+    
+    return info
+
 if __name__ == "__main__":
 	
 	args = argParse()
+	if args.trace is not None:
+		enable(args.trace)
 	
-	####################################################################
-	######### load the images, WCS headers and bad pixel mask ##########
-	####################################################################
-	print('Loading image 1...')
-	try:
-		with fits.open(args.img_1) as f1:
-			success = np.arange(0, len(f1))
-			while True:
-				check = input('Please specify relevant HDU: ')
-				if int(check) in success:
-					print('Proceeding with HDU {}...'.format(check))
-					break
-				else:
-					print('Invalid selection...\n'
-						  'Options: {}--{}'.format(str(min(success)),
-												   str(max(success))))
-			
-			img_1 = f1[int(check)].data.astype(np.float64)
-			hdr_1 = f1[int(check)].header
-			primhdr_1 = f1[0].header
-		
-	except FileNotFoundError:
-		print('Image 1 not found...')
-		quit()
-	
-	print('Loading image 2...')
-	try:
-		with fits.open(args.img_2) as f2:
-			success = np.arange(0, len(f2))
-			while True:
-				check = input('Please specify relevant HDU: ')
-				if int(check) in success:
-					print('Proceeding with HDU {}...'.format(check))
-					break
-				else:
-					print('Invalid selection...\n'
-						  'Options: {}--{}'.format(str(min(success)),
-												   str(max(success))))
-		
-			img_2 = f2[int(check)].data.astype(np.float64)
-			hdr_2 = f2[int(check)].header
-			primhdr_2 = f2[0].header
-		
-	except FileNotFoundError:
-		print('Image 2 not found...')
-		quit()
+	# HDUs not given on the command line are asked for
+	hdus = []
+	for filepath, hdu, name in ((args.img_1, args.hdu_1, 'Image 1'),
+	                            (args.img_2, args.hdu_2, 'Image 2'),
+	                            (args.bp_mask, args.mask_hdu, 
+	                             'Bad pixel mask')):
+		if hdu is None:
+			try:
+				print('{}: {}'.format(name, filepath))
+				hdu = promptHDU(filepath)
+			except FileNotFoundError:
+				print('{} not found...'.format(name))
+				quit()
+		hdus.append(hdu)
 	
-	print('Loading wcs information...')
 	try:
-		with fits.open(args.wcs_1) as w1:
-			wcs_1 = w1[0].header
-	except FileNotFoundError:
-		print('No WCS information for image 1...')
+		subtractPair(args.img_1, 
+		             args.img_2, 
+		             args.wcs_1, 
+		             args.wcs_2, 
+		             args.bp_mask, 
+		             args.out, 
+		             hdu_1=hdus[0], 
+		             hdu_2=hdus[1], 
+		             mask_hdu=hdus[2],
+		             dtype=np.float32 if args.float32 else np.float64,
+		             roi=args.roi,
+		             warp_model=args.warp,
+		             diagnostics=args.diagnostics)
+	except FileNotFoundError as e:
+		print('File not found: {}...'.format(e.filename or e))
 		quit()
-	try:
-		with fits.open(args.wcs_2) as w2:
-			wcs_2 = w2[0].header
-	except FileNotFoundError:
-		print('No WCS information for image 2...')
+	except (KeyError, ValueError) as e:
+		print('{}...'.format(e))
 		quit()
-	
-	print('Loading bad pixel mask...')
-	try:
-		with fits.open(args.bp_mask) as bpm:
-			success = np.arange(0, len(bpm))
-			while True:
-				check = input('Please specify relevant HDU: ')
-				if int(check) in success:
-					print('Proceeding with HDU {}...'.format(check))
-					break
-				else:
-					print('Invalid selection...\n'
-						  'Options: {}--{}'.format(str(min(success)),
-												   str(max(success))))
-		
-			mask = bpm[int(check)].data.astype(np.bool)
-		
-	except FileNotFoundError:
-		print('Bad pixel mask not found...')
-		quit()
-	
-	####################################################################
-	################# feature extraction and matching ##################
-	####################################################################
-	# inject random sampling points into image 1
-	x_1 = []
-	y_1 = []
-	while len(x_1) < 1000:
-		x_1.append(random.uniform(0, hdr_1['NAXIS1']))
-		y_1.append(random.uniform(0, hdr_1['NAXIS2']))
-	
-	if args.diagnostics:
-		plotXY(img_1, x_1, y_1)
-	
-	# convert xy to radec
-	xdet_1, ydet_1 = convertToDetector(x_1, 
-	                                   y_1, 
-	                                   hdr_1)
-	ra_1, dec_1 = convertToWCS(xdet_1, 
-	                           ydet_1, 
-	                           wcs_1)
-	
-	# match with image 2
-	xdet_2, ydet_2 = convertToPixels(ra_1,
-	                                 dec_1,
-	                                 wcs_2)
-	x_2, y_2 = convertToPixels(xdet_2,
-	                           ydet_2,
-	                           hdr_2)
-	matches = Table([x_1, y_1, 
-	                 xdet_1, ydet_1, 
-	                 ra_1, dec_1, 
-	                 xdet_2, ydet_2, 
-	                 x_2, y_2],
-	                 names=['x_1', 'y_1',
-	                        'xdet_1', 'ydet_1',
-	                        'ra_1', 'dec_1',
-	                        'xdet_2', 'ydet_2',
-	                        'x_2', 'y_2'])
-	
-	# filter out points that don't overlap between the images
-	remove_idx = []
-	for m, match in enumerate(matches):
-		if (match['x_2'] < 0 or
-		    match['x_2'] > hdr_2['NAXIS1'] or
-		    match['y_2'] < 0 or
-		    match['y_2'] > hdr_2['NAXIS2']):
-			   remove_idx.append(m)
-	matches.remove_rows(remove_idx)
-	
-	if args.diagnostics:
-		plotXY(img_2, matches['x_2'], matches['y_2'])
-	
-	####################################################################
-	#################### alignment and subtraction #####################
-	####################################################################
-	
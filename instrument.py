@@ -0,0 +1,274 @@
+"""
+Lightweight instrumentation of pipeline stages
+-Wall time, CPU time and peak RSS growth per stage
+-Item counts (pixels, sources, points) attached to each record
+-JSON lines output, enabled with enable() or the PYCCD_TRACE variable
+
+Disabled by default, in which case stage() and timed functions cost a
+single check of a module global.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# environment variable naming the trace file ('-' for stderr) - also
+# picked up by worker processes started by the pipeline
+TRACE_ENV = 'PYCCD_TRACE'
+
+_sink = None
+_sink_lock = threading.Lock()
+_local = threading.local()
+
+def enable(path='-'):
+    """
+    Start writing stage records as JSON lines
+    
+    Parameters
+    ----------
+    path : str, optional
+        File to which records are appended, or '-' for stderr
+        Default = '-'
+    
+    Returns
+    -------
+    None
+    """
+    global _sink
+    
+    disable()
+    with _sink_lock:
+        if path == '-':
+            _sink = sys.stderr
+        else:
+            _sink = open(path, 'a', buffering=1)
+    
+    # worker processes inherit the setting
+    os.environ[TRACE_ENV] = path
+    
+    return None
+
+def disable():
+    """
+    Stop writing stage records
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    None
+    """
+    global _sink
+    
+    with _sink_lock:
+        if _sink is not None and _sink is not sys.stderr:
+            _sink.close()
+        _sink = None
+    os.environ.pop(TRACE_ENV, None)
+    
+    return None
+
+def enabled():
+    """
+    Whether stage records are being written
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    enabled : bool
+        True if instrumentation is on
+    """
+    return _sink is not None
+
+def _peakRSS():
+    """
+    Peak resident set size of the process in MB
+    """
+    if resource is None:
+        return 0.
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # bytes on macOS, kB elsewhere
+    return peak / 1024.**2 if sys.platform == 'darwin' else peak / 1024.
+
+def _emit(record):
+    """
+    Write one record as a JSON line
+    """
+    line = json.dumps(record, default=str) + '\n'
+    with _sink_lock:
+        if _sink is not None:
+            _sink.write(line)
+    
+    return None
+
+class _Stage(object):
+    """
+    Context manager timing one stage, whose counts can be added to as
+    a dictionary inside the block
+    """
+    
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+    
+    def __setitem__(self, key, value):
+        self.counts[key] = value
+    
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        
+        self.rss = _peakRSS()
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _local.stack.pop()
+        
+        record = {'stage': self.name,
+                  'parent': self.parent,
+                  'start': self.start,
+                  'wall': wall,
+                  'cpu': cpu,
+                  'peak_rss_delta_mb': _peakRSS() - self.rss,
+                  'pid': os.getpid(),
+                  'thread': threading.current_thread().name}
+        record.update(self.counts)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        _emit(record)
+        
+        return False
+
+class _NullStage(object):
+    """
+    Stand-in for _Stage when instrumentation is disabled
+    """
+    
+    def __setitem__(self, key, value):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def stage(name, **counts):
+    """
+    Time a block of code as a named stage
+    
+    Counts known before the block can be given as keyword arguments,
+    and others set on the returned object inside it, e.g.
+        
+        with stage('extract', pixels=data.size) as s:
+            sources = sep.extract(...)
+            s['sources'] = len(sources)
+    
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    **counts
+        Item counts recorded with the stage
+    
+    Returns
+    -------
+    stage : context manager
+        Records the stage on exit if instrumentation is enabled
+    """
+    if _sink is None:
+        return _NULL_STAGE
+    
+    return _Stage(name, counts)
+
+def timed(name=None, counts=None):
+    """
+    Decorator timing every call of a function as a stage
+    
+    Parameters
+    ----------
+    name : str, optional
+        Name of the stage
+        Default = None, the function name
+    counts : callable, optional
+        Function of the call arguments returning a dictionary of item
+        counts, e.g. lambda x, y, hdr: {'points': len(x)}
+        Default = None
+    
+    Returns
+    -------
+    decorator : callable
+        Wraps the function
+    """
+    def decorator(func):
+        label = func.__name__ if name is None else name
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return func(*args, **kwargs)
+            
+            extra = {}
+            if counts is not None:
+                try:
+                    extra = counts(*args, **kwargs)
+                except Exception:
+                    pass
+            with _Stage(label, extra):
+                return func(*args, **kwargs)
+        
+        return wrapper
+    
+    return decorator
+
+def size(values):
+    """
+    Number of items in an array or sequence, for use in counts
+    
+    Parameters
+    ----------
+    values : array-like
+        Array, sequence or scalar
+    
+    Returns
+    -------
+    n : int
+        Number of items - 1 for a scalar
+    """
+    n = getattr(values, 'size', None)
+    if n is not None:
+        return int(n)
+    try:
+        return len(values)
+    except TypeError:
+        return 1
+
+# pick up a trace file set for this process or inherited from a parent
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
@@ -0,0 +1,393 @@
+"""
+Bad pixel masks held bit-packed and cached per CCD
+-Masks stored eight pixels to the byte, unpacked on demand
+-Masks loaded once per file and CCD, and reused for every frame
+-Dilations (grown bad pixels, bleed trails, frame edges) precomputed
+ at load time
+"""
+
+from frames import loadFrame
+from instrument import stage
+import os
+import numpy as np
+from collections import OrderedDict
+from scipy import ndimage
+
+# per-process caches used by loadMask, keyed by path and dilations
+_caches = {}
+
+class PackedMask(object):
+    """
+    Boolean mask packed into bits along each row
+    """
+    
+    def __init__(self, bits, shape):
+        """
+        Parameters
+        ----------
+        bits : array-like
+            Packed rows, from np.packbits(mask, axis=1)
+        shape : tuple
+            Shape of the unpacked mask
+        """
+        self.bits = bits
+        self.shape = tuple(int(n) for n in shape)
+    
+    @classmethod
+    def fromArray(cls, mask):
+        """
+        Pack a boolean mask
+        
+        Parameters
+        ----------
+        mask : array-like
+            2D mask, True for bad pixels
+        
+        Returns
+        -------
+        packed : PackedMask object
+            Packed copy of the mask
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            mask = mask != 0
+        
+        return cls(np.packbits(mask, axis=1), mask.shape)
+    
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+    
+    def count(self):
+        """
+        Number of pixels set, counted from the packed bits
+        """
+        if hasattr(np, 'bitwise_count'):
+            return int(np.bitwise_count(self.bits).sum(dtype=np.int64))
+        
+        return int(np.unpackbits(self.bits, axis=1).sum(dtype=np.int64))
+    
+    def unpack(self, x_range=None, y_range=None):
+        """
+        Unpack the mask, or a section of it
+        
+        Parameters
+        ----------
+        x_range, y_range : tuple, optional
+            (start, stop) zero-based columns and rows of the section,
+            stop excluded
+            Default = None, the full width or height
+        
+        Returns
+        -------
+        mask : array-like
+            C-contiguous boolean mask
+        """
+        y0, y1 = (0, self.shape[0]) if y_range is None else y_range
+        x0, x1 = (0, self.shape[1]) if x_range is None else x_range
+        
+        # only the bytes covering the section are unpacked
+        b0 = x0 // 8
+        b1 = min((x1 + 7) // 8, self.bits.shape[1])
+        section = np.unpackbits(self.bits[y0:y1, b0:b1],
+                                axis=1,
+                                count=x1 - b0*8).view(bool)
+        if x0 == b0*8:
+            return section
+        
+        return np.ascontiguousarray(section[:, x0 - b0*8:])
+    
+    def save(self, outpath):
+        """
+        Save the packed mask to a .npz file
+        
+        Parameters
+        ----------
+        outpath : str
+            Path to the output file
+        
+        Returns
+        -------
+        None
+        """
+        np.savez(outpath, bits=self.bits, shape=np.array(self.shape))
+        
+        return None
+    
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a packed mask saved with save
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the .npz file
+        
+        Returns
+        -------
+        packed : PackedMask object
+            The packed mask
+        """
+        with np.load(filepath) as f:
+            return cls(f['bits'], tuple(f['shape']))
+
+def dilateMask(mask, grow=0, bleed=0, edge=0):
+    """
+    Dilate a bad pixel mask
+    
+    Parameters
+    ----------
+    mask : array-like
+        Boolean mask, True for bad pixels
+    grow : int, optional
+        Pixels by which bad pixels are grown in every direction (a
+        square of side 2*grow + 1)
+        Default = 0
+    bleed : int, optional
+        Further pixels by which bad pixels are extended up and down
+        their column, to cover bleed trails from saturated stars
+        Default = 0
+    edge : int, optional
+        Width of the border of the frame masked
+        Default = 0
+    
+    Returns
+    -------
+    dilated : array-like
+        Dilated boolean mask
+    """
+    # the square is separable, so two 1D running maxima replace a 2D
+    # binary dilation, several times faster on a full frame
+    dilated = np.ascontiguousarray(mask, dtype=bool)
+    if grow > 0 or bleed > 0:
+        dilated = ndimage.maximum_filter1d(dilated.view(np.uint8),
+                                           2*(grow + bleed) + 1,
+                                           axis=0)
+        if grow > 0:
+            dilated = ndimage.maximum_filter1d(dilated,
+                                               2*grow + 1,
+                                               axis=1)
+        dilated = dilated.view(bool)
+    elif edge > 0:
+        dilated = dilated.copy()
+    if edge > 0:
+        dilated[:edge] = True
+        dilated[-edge:] = True
+        dilated[:, :edge] = True
+        dilated[:, -edge:] = True
+    
+    return dilated
+
+class MaskCache(object):
+    """
+    Bad pixel masks of every CCD in a mask file, loaded on first use
+    and held bit-packed along with their dilations, so that frames of a
+    CCD after the first cost no mask I/O
+    """
+    
+    def __init__(self, mask_path, grow=0, bleed=0, edge=0,
+                 max_unpacked=1):
+        """
+        Parameters
+        ----------
+        mask_path : str
+            Path to the bad pixel mask file
+        grow, bleed, edge : int, optional
+            Dilations precomputed for each CCD (see dilateMask)
+            Default = 0
+        max_unpacked : int, optional
+            Number of unpacked masks held, least recently used first
+            out - each costs eight times its packed size
+            Default = 1
+        """
+        self.mask_path = mask_path
+        self.dilations = {'grow': grow, 'bleed': bleed, 'edge': edge}
+        self.max_unpacked = max_unpacked
+        self.counts = {'load': 0, 'unpack': 0, 'hit': 0}
+        self._packed = {}
+        self._unpacked = OrderedDict()
+        self._mtime = None
+    
+    @property
+    def nbytes(self):
+        """
+        Memory held by the packed and unpacked masks
+        """
+        # undilated CCDs hold the same packed mask twice
+        packed = {id(p): p.nbytes for pair in self._packed.values()
+                  for p in pair}
+        
+        unpacked = sum(m.nbytes for m in self._unpacked.values())
+        
+        return sum(packed.values()) + unpacked
+    
+    def _check(self):
+        """
+        Drop every mask if the file has changed since it was read
+        """
+        mtime = os.path.getmtime(self.mask_path)
+        if mtime != self._mtime:
+            self._packed.clear()
+            self._unpacked.clear()
+            self._mtime = mtime
+        
+        return None
+    
+    def packed(self, hdu=None, dilated=False):
+        """
+        Packed mask of a CCD, loaded from the file on first use
+        
+        Parameters
+        ----------
+        hdu : int or str, optional
+            Index or EXTNAME of the HDU
+            Default = None, the first HDU containing data
+        dilated : bool, optional
+            Toggle to return the dilated mask
+            Default = False
+        
+        Returns
+        -------
+        packed : PackedMask object
+            The packed mask
+        
+        Raises
+        ------
+        FileNotFoundError
+            If the mask file does not exist
+        KeyError
+            If no HDU matches the selection
+        """
+        self._check()
+        key = str(hdu)
+        if key not in self._packed:
+            with stage('load_mask', file=self.mask_path, hdu=hdu) as s:
+                mask, _ = loadFrame(self.mask_path, hdu=hdu, dtype=bool)
+                bad = PackedMask.fromArray(mask)
+                if any(self.dilations.values()):
+                    grown = PackedMask.fromArray(
+                        dilateMask(mask, **self.dilations))
+                else:
+                    grown = bad
+                s['pixels'] = mask.size
+                del mask
+            self._packed[key] = (bad, grown)
+            self.counts['load'] += 1
+        
+        return self._packed[key][1 if dilated else 0]
+    
+    def get(self, hdu=None, dilated=False):
+        """
+        Unpacked mask of a CCD
+        
+        The array returned is shared with later calls for the same CCD,
+        so must not be modified in place
+        
+        Parameters
+        ----------
+        hdu : int or str, optional
+            Index or EXTNAME of the HDU
+            Default = None, the first HDU containing data
+        dilated : bool, optional
+            Toggle to return the dilated mask
+            Default = False
+        
+        Returns
+        -------
+        mask : array-like
+            Boolean mask, True for bad pixels
+        """
+        packed = self.packed(hdu=hdu, dilated=dilated)
+        key = (str(hdu), dilated)
+        if key in self._unpacked:
+            self._unpacked.move_to_end(key)
+            self.counts['hit'] += 1
+            return self._unpacked[key]
+        
+        mask = packed.unpack()
+        self.counts['unpack'] += 1
+        if self.max_unpacked > 0:
+            self._unpacked[key] = mask
+            while len(self._unpacked) > self.max_unpacked:
+                self._unpacked.popitem(last=False)
+        
+        return mask
+    
+    def section(self, x_range, y_range, hdu=None, dilated=False):
+        """
+        Unpacked section of the mask of a CCD, e.g. for a frame read
+        with frames.loadSection
+        
+        Parameters
+        ----------
+        x_range, y_range : tuple
+            (start, stop) zero-based columns and rows of the section,
+            stop excluded
+        hdu : int or str, optional
+            Index or EXTNAME of the HDU
+            Default = None, the first HDU containing data
+        dilated : bool, optional
+            Toggle to return the dilated mask
+            Default = False
+        
+        Returns
+        -------
+        mask : array-like
+            Boolean mask of the section, True for bad pixels
+        """
+        packed = self.packed(hdu=hdu, dilated=dilated)
+        
+        return packed.unpack(x_range=x_range, y_range=y_range)
+
+def loadMask(mask_path, hdu=None, dilated=False, grow=0, bleed=0, edge=0):
+    """
+    Load the bad pixel mask of a CCD through a cache kept for the life
+    of the process, so repeated calls (e.g. one per frame in a pool
+    worker) read the file only once per CCD
+    
+    Parameters
+    ----------
+    mask_path : str
+        Path to the bad pixel mask file
+    hdu : int or str, optional
+        Index or EXTNAME of the HDU
+        Default = None, the first HDU containing data
+    dilated : bool, optional
+        Toggle to return the dilated mask
+        Default = False
+    grow, bleed, edge : int, optional
+        Dilations of the mask (see dilateMask)
+        Default = 0
+    
+    Returns
+    -------
+    mask : array-like
+        Boolean mask, True for bad pixels - shared between calls, so
+        must not be modified in place
+    
+    Raises
+    ------
+    FileNotFoundError
+        If the mask file does not exist
+    KeyError
+        If no HDU matches the selection
+    """
+    key = (os.path.abspath(mask_path), grow, bleed, edge)
+    if key not in _caches:
+        _caches[key] = MaskCache(mask_path, grow=grow, bleed=bleed,
+                                 edge=edge)
+    
+    return _caches[key].get(hdu=hdu, dilated=dilated)
+
+def clearMaskCache():
+    """
+    Drop every mask cached by loadMask
+    
+    Returns
+    -------
+    None
+    """
+    _caches.clear()
+    
+    return None
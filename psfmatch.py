@@ -0,0 +1,540 @@
+"""
+Functions for PSF-matched difference imaging of aligned CCD frames
+-Selection of kernel stamps from a source catalogue
+-Parallel stamp-by-stamp kernel solutions (Alard & Lupton basis)
+-Low-order spatial variation of the kernel across the frame
+-FFT convolution of the template on overlapping tiles
+"""
+
+import os
+import cv2
+import numpy as np
+from scipy.signal import fftconvolve
+from concurrent.futures import ThreadPoolExecutor
+
+def gaussianBasis(half_width, sigmas=(0.7, 1.5, 3.0), degrees=(6, 4, 2)):
+    """
+    Build the Alard & Lupton kernel basis of Gaussians modified by
+    polynomials
+    
+    The first basis kernel is normalised to unit sum and every other
+    kernel to zero sum, so the first coefficient alone sets the
+    photometric scale
+    
+    Parameters
+    ----------
+    half_width : int
+        Half width of the kernel in pixels - kernels are square with
+        side 2*half_width + 1
+    sigmas : tuple, optional
+        Widths of the Gaussian components in pixels
+        Default = (0.7, 1.5, 3.0)
+    degrees : tuple, optional
+        Maximum polynomial degree multiplying each Gaussian
+        Default = (6, 4, 2)
+    
+    Returns
+    -------
+    basis : array-like
+        (n_basis, 2*half_width + 1, 2*half_width + 1) basis kernels
+    """
+    u, v = np.mgrid[-half_width:half_width + 1,
+                    -half_width:half_width + 1].astype(np.float64)
+    
+    basis = []
+    for sigma, degree in zip(sigmas, degrees):
+        gauss = np.exp(-(u**2 + v**2) / (2. * sigma**2))
+        for i in range(degree + 1):
+            for j in range(degree + 1 - i):
+                basis.append(gauss * u**i * v**j)
+    basis = np.array(basis)
+    
+    # unit sum first kernel, zero sum for the remainder
+    basis[0] /= basis[0].sum()
+    for b in basis[1:]:
+        total = b.sum()
+        if abs(total) > 1e-12:
+            b -= total * basis[0]
+        b /= np.abs(b).max()
+    
+    return basis
+
+def selectStamps(sources, shape, stamp_half=25, n_grid=6, per_cell=4,
+                 mask=None, saturation=None):
+    """
+    Choose bright, isolated, well-behaved sources spread evenly over the
+    frame as stamps for the kernel solution
+    
+    Parameters
+    ----------
+    sources : Table or catalogue
+        Source catalogue for the frame, with SEP columns x, y, flux,
+        peak and flag
+    shape : tuple
+        (ny, nx) shape of the frame
+    stamp_half : int, optional
+        Half width of the stamps in pixels, including the kernel
+        Default = 25
+    n_grid : int, optional
+        Number of cells along each axis of the grid used to spread the
+        stamps over the frame
+        Default = 6
+    per_cell : int, optional
+        Maximum number of stamps taken from each cell
+        Default = 4
+    mask : array-like, optional
+        Bad pixel mask - stamps containing bad pixels are rejected
+        Default = None
+    saturation : float, optional
+        Peak value above which sources are rejected
+        Default = None
+    
+    Returns
+    -------
+    x, y : array-like
+        Integer array coords of the stamp centres
+    """
+    ny, nx = shape
+    x = np.round(np.asarray(sources['x'])).astype(np.intp)
+    y = np.round(np.asarray(sources['y'])).astype(np.intp)
+    flux = np.asarray(sources['flux'], dtype=np.float64)
+    
+    good = ((np.asarray(sources['flag']) == 0) &
+            (x >= stamp_half) & (x < nx - stamp_half) &
+            (y >= stamp_half) & (y < ny - stamp_half) &
+            np.isfinite(flux) & (flux > 0))
+    if saturation is not None:
+        good &= np.asarray(sources['peak']) < saturation
+    
+    # isolated - no other source within a stamp of this one
+    order = np.argsort(x)
+    xs, ys = x[order], y[order]
+    lo = np.searchsorted(xs, xs - 2*stamp_half, side='left')
+    hi = np.searchsorted(xs, xs + 2*stamp_half, side='right')
+    isolated = np.ones(len(x), dtype=bool)
+    for k in np.nonzero(hi - lo > 1)[0]:
+        near = np.abs(ys[lo[k]:hi[k]] - ys[k]) <= 2*stamp_half
+        isolated[order[k]] = near.sum() == 1
+    good &= isolated
+    
+    if mask is not None:
+        for k in np.nonzero(good)[0]:
+            good[k] = not mask[y[k] - stamp_half:y[k] + stamp_half + 1,
+                               x[k] - stamp_half:x[k] + stamp_half + 1].any()
+    
+    # brightest few in each grid cell
+    idx = np.nonzero(good)[0]
+    cell = ((y[idx] * n_grid // ny) * n_grid + (x[idx] * n_grid // nx))
+    idx = idx[np.lexsort((-flux[idx], cell))]
+    cell = np.sort(cell)
+    first = np.searchsorted(cell, cell, side='left')
+    rank = np.arange(len(cell)) - first
+    idx = idx[rank < per_cell]
+    
+    return x[idx], y[idx]
+
+def solveStamp(image, template, x, y, basis, stamp_half=25):
+    """
+    Solve for the kernel coefficients and background that best match
+    the template to the image over a single stamp
+    
+    Parameters
+    ----------
+    image, template : array-like
+        Aligned image and template frames
+    x, y : int
+        Array coords of the stamp centre
+    basis : array-like
+        Kernel basis from gaussianBasis
+    stamp_half : int, optional
+        Half width of the stamp in pixels
+        Default = 25
+    
+    Returns
+    -------
+    coeffs : array-like or None
+        Kernel coefficients followed by the background - None if the
+        stamp contains non-finite values
+    chi : float
+        Ratio of the rms to the robust (MAD) scatter of the residuals -
+        near 1 for a good stamp, large when the residuals have structure
+    normal : tuple or None
+        (matrix, vector) normal equations of the stamp, for the global
+        spatially varying fit
+    """
+    h = basis.shape[1] // 2
+    sci = image[y - stamp_half + h:y + stamp_half - h + 1,
+                x - stamp_half + h:x + stamp_half - h + 1]
+    ref = template[y - stamp_half:y + stamp_half + 1,
+                   x - stamp_half:x + stamp_half + 1]
+    if not (np.isfinite(sci).all() and np.isfinite(ref).all()):
+        return None, np.inf, None
+    
+    ref = ref.astype(np.float64)
+    design = np.empty((sci.size, len(basis) + 1))
+    for n, b in enumerate(basis):
+        design[:, n] = fftconvolve(ref, b, mode='valid').ravel()
+    design[:, -1] = 1.
+    
+    target = sci.astype(np.float64).ravel()
+    matrix = np.dot(design.T, design)
+    vector = np.dot(design.T, target)
+    coeffs = np.linalg.lstsq(matrix, vector, rcond=None)[0]
+    resid = target - np.dot(design, coeffs)
+    
+    # structured residuals (variables, blends) have heavy tails
+    robust = 1.4826 * np.median(np.abs(resid - np.median(resid)))
+    chi = np.sqrt(np.mean(resid**2)) / max(robust, 1e-12)
+    
+    return coeffs, chi, (matrix, vector)
+
+class SpatialKernel(object):
+    """
+    Convolution kernel and differential background varying as low-order
+    polynomials across the frame
+    """
+    
+    def __init__(self, basis, coeffs, shape, order):
+        """
+        Parameters
+        ----------
+        basis : array-like
+            Kernel basis from gaussianBasis
+        coeffs : array-like
+            (n_basis + 1, n_terms) polynomial coefficients of each basis
+            weight and of the background
+        shape : tuple
+            (ny, nx) shape of the frame
+        order : int
+            Order of the spatial polynomials
+        """
+        self.basis = basis
+        self.coeffs = coeffs
+        self.shape = shape
+        self.order = order
+    
+    def _weights(self, x, y):
+        """
+        Basis weights and background at array coords
+        """
+        return np.dot(self.coeffs, _spatialTerms(x, y, self.shape,
+                                                 self.order))
+    
+    def kernelAt(self, x, y):
+        """
+        Evaluate the kernel at a position in the frame
+        
+        Parameters
+        ----------
+        x, y : float
+            Array coords in the frame
+        
+        Returns
+        -------
+        kernel : array-like
+            Convolution kernel at (x, y)
+        """
+        weights = self._weights(np.array([x]), np.array([y]))[:-1, 0]
+        
+        return np.tensordot(weights, self.basis, axes=(0, 0))
+    
+    def backgroundAt(self, x, y):
+        """
+        Evaluate the differential background at positions in the frame
+        
+        Parameters
+        ----------
+        x, y : array-like
+            Array coords in the frame
+        
+        Returns
+        -------
+        background : array-like
+            Background difference between image and template
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        terms = _spatialTerms(x.ravel(), y.ravel(), self.shape, self.order)
+        
+        return np.dot(self.coeffs[-1], terms).reshape(x.shape)
+
+def _spatialTerms(x, y, shape, order):
+    """
+    Monomials of array coords normalised to [-1, 1] over the frame
+    """
+    u = 2. * np.asarray(x, dtype=np.float64) / shape[1] - 1.
+    v = 2. * np.asarray(y, dtype=np.float64) / shape[0] - 1.
+    
+    return np.array([u**i * v**j
+                     for i in range(order + 1)
+                     for j in range(order + 1 - i)])
+
+def fitKernel(image, template, sources, half_width=10, stamp_half=25,
+              spatial_order=2, sigmas=(0.7, 1.5, 3.0), degrees=(6, 4, 2),
+              mask=None, saturation=None, clip=3., n_threads=None):
+    """
+    Fit a spatially varying kernel matching the template to the image
+    
+    Each stamp is solved independently on a thread pool and outlying 
+    stamps are clipped. The normal equations of the remaining stamps 
+    are then combined to fit the basis weights as polynomials in 
+    position. The photometric scale is held constant across the frame.
+    
+    Parameters
+    ----------
+    image, template : array-like
+        Aligned image and template frames
+    sources : Table or catalogue
+        Source catalogue from sourceExtract used to choose stamps
+    half_width : int, optional
+        Half width of the kernel in pixels
+        Default = 10
+    stamp_half : int, optional
+        Half width of the stamps in pixels, must exceed half_width
+        Default = 25
+    spatial_order : int, optional
+        Order of the spatial variation of the kernel and background
+        Default = 2
+    sigmas, degrees : tuple, optional
+        Gaussian widths and polynomial degrees of the kernel basis
+        Default = (0.7, 1.5, 3.0), (6, 4, 2)
+    mask : array-like, optional
+        Bad pixel mask shared by both frames
+        Default = None
+    saturation : float, optional
+        Peak value above which sources are not used as stamps
+        Default = None
+    clip : float, optional
+        Number of MADs above the median fit quality at which stamps are
+        rejected
+        Default = 3.
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    kernel : SpatialKernel object
+        Fitted kernel and differential background
+    
+    Raises
+    ------
+    ValueError
+        If too few usable stamps are found for the spatial fit
+    """
+    if stamp_half <= half_width:
+        raise ValueError('Stamps must be larger than the kernel')
+    
+    basis = gaussianBasis(half_width, sigmas=sigmas, degrees=degrees)
+    x, y = selectStamps(sources, image.shape, stamp_half=stamp_half,
+                        mask=mask, saturation=saturation)
+    
+    def _solve(xy):
+        return solveStamp(image, template, xy[0], xy[1], basis,
+                          stamp_half=stamp_half)
+    
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        solutions = list(pool.map(_solve, zip(x, y)))
+    
+    solutions = [(i, j, q, normal) 
+                 for i, j, (c, q, normal) in zip(x, y, solutions)
+                 if c is not None]
+    
+    # reject stamps (variables, residual blends) that fit badly
+    if solutions:
+        chi = np.array([q for _, _, q, _ in solutions])
+        med = np.median(chi)
+        mad = 1.4826 * np.median(np.abs(chi - med))
+        limit = med + clip * max(mad, 1e-3 * med)
+        solutions = [sol for sol in solutions if sol[2] <= limit]
+    
+    n_terms = (spatial_order + 1) * (spatial_order + 2) // 2
+    if len(solutions) < 2 * n_terms:
+        raise ValueError('Only {} usable stamps, at least {} are needed '
+                         'for the spatial fit'.format(len(solutions),
+                                                      2 * n_terms))
+    
+    # combine the stamp normal equations into one system for the 
+    # polynomial coefficients of every basis weight (Alard 2000)
+    n_weights = len(basis) + 1
+    matrix = np.zeros((n_terms*n_weights, n_terms*n_weights))
+    vector = np.zeros(n_terms*n_weights)
+    for i, j, _, (m, v) in solutions:
+        terms = _spatialTerms(i, j, image.shape, spatial_order)
+        matrix += np.kron(np.outer(terms, terms), m)
+        vector += np.kron(terms, v)
+    
+    # photometric scale is constant over the frame
+    free = np.ones((n_terms, n_weights), dtype=bool)
+    free[1:, 0] = False
+    free = free.ravel()
+    
+    spatial = np.zeros(n_terms*n_weights)
+    spatial[free] = np.linalg.lstsq(matrix[np.ix_(free, free)], 
+                                    vector[free], 
+                                    rcond=None)[0]
+    spatial = spatial.reshape(n_terms, n_weights).T
+    
+    return SpatialKernel(basis, spatial, image.shape, spatial_order)
+
+def convolveTiled(data, kernel, tile_size=512, out=None, n_threads=None):
+    """
+    Convolve a frame with a spatially varying kernel, using FFTs on
+    overlapping tiles with the kernel evaluated at each tile centre
+    
+    Non-finite input pixels are treated as zero and every output pixel
+    they (or the area beyond the frame edges) contribute to is set to 
+    nan
+    
+    Parameters
+    ----------
+    data : array-like
+        Frame to convolve
+    kernel : SpatialKernel object
+        Kernel to convolve with
+    tile_size : int, optional
+        Side length of the output tiles in pixels
+        Default = 512
+    out : array-like, optional
+        Buffer in which to place the convolved frame
+        Default = None, a new float32 array is allocated
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    convolved : array-like
+        Convolved frame
+    """
+    ny, nx = data.shape
+    h = kernel.basis.shape[1] // 2
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    footprint = np.ones((2*h + 1, 2*h + 1), dtype=np.uint8)
+    
+    def _convolveTile(origin):
+        y0, x0 = origin
+        y1, x1 = min(y0 + tile_size, ny), min(x0 + tile_size, nx)
+        
+        # padded input, missing beyond the frame edges
+        tile = np.full((y1 - y0 + 2*h, x1 - x0 + 2*h), np.nan)
+        ys = slice(max(y0 - h, 0), min(y1 + h, ny))
+        xs = slice(max(x0 - h, 0), min(x1 + h, nx))
+        tile[ys.start - (y0 - h):ys.stop - (y0 - h),
+             xs.start - (x0 - h):xs.stop - (x0 - h)] = data[ys, xs]
+        
+        bad = ~np.isfinite(tile)
+        tile[bad] = 0.
+        k = kernel.kernelAt((x0 + x1 - 1) / 2., (y0 + y1 - 1) / 2.)
+        result = fftconvolve(tile, k, mode='valid')
+        if bad.any():
+            spread = cv2.dilate(bad.view(np.uint8), footprint)
+            result[spread[h:-h, h:-h] > 0] = np.nan
+        out[y0:y1, x0:x1] = result
+        
+        return None
+    
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    tiles = [(y0, x0)
+             for y0 in range(0, ny, tile_size)
+             for x0 in range(0, nx, tile_size)]
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(_convolveTile, tiles))
+    
+    return out
+
+def stampWidth(data, x, y, radius=8):
+    """
+    Median flux-weighted rms radius of the sources on a set of stamps,
+    for deciding which of two frames has the better seeing
+    
+    Parameters
+    ----------
+    data : array-like
+        Frame containing the stamps
+    x, y : array-like
+        Integer array coords of the stamp centres, from selectStamps
+    radius : int, optional
+        Radius within which the width is measured in pixels
+        Default = 8
+    
+    Returns
+    -------
+    width : float
+        Median rms radius in pixels
+    """
+    # local background from an annulus just outside the radius
+    u, v = np.mgrid[-2*radius:2*radius + 1, -2*radius:2*radius + 1]
+    r2 = (u**2 + v**2).ravel()
+    outer = r2 > radius**2
+    
+    widths = []
+    for i, j in zip(x, y):
+        stamp = data[j - 2*radius:j + 2*radius + 1,
+                     i - 2*radius:i + 2*radius + 1].ravel()
+        if stamp.size != r2.size or not np.isfinite(stamp).all():
+            continue
+        weight = np.clip(stamp - np.median(stamp[outer]), 0., None)
+        weight[outer] = 0.
+        if weight.sum() > 0:
+            widths.append(np.sqrt(np.sum(weight * r2) / weight.sum()))
+    
+    return float(np.median(widths)) if widths else np.nan
+
+def subtractImages(image, template, sources, mask=None, tile_size=512,
+                   n_threads=None, **kernel_kwargs):
+    """
+    PSF-matched difference of two aligned frames - the template is
+    convolved to match the image and subtracted along with the
+    differential background
+    
+    The template should be the frame with the better seeing
+    
+    Parameters
+    ----------
+    image, template : array-like
+        Aligned image and template frames
+    sources : Table or catalogue
+        Source catalogue from sourceExtract used to choose stamps
+    mask : array-like, optional
+        Bad pixel mask shared by both frames - masked pixels are nan in
+        the difference image
+        Default = None
+    tile_size : int, optional
+        Side length of the convolution tiles in pixels
+        Default = 512
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    **kernel_kwargs
+        Keyword arguments passed to fitKernel
+    
+    Returns
+    -------
+    difference : array-like
+        Difference image, image - template * kernel - background
+    kernel : SpatialKernel object
+        Fitted kernel and differential background
+    """
+    kernel = fitKernel(image, template, sources, mask=mask,
+                       n_threads=n_threads, **kernel_kwargs)
+    
+    difference = convolveTiled(template, kernel, tile_size=tile_size,
+                               n_threads=n_threads)
+    np.subtract(image, difference, out=difference, casting='unsafe')
+    
+    # differential background, evaluated one block of rows at a time
+    x = np.arange(image.shape[1])
+    for y0 in range(0, image.shape[0], tile_size):
+        y1 = min(y0 + tile_size, image.shape[0])
+        xx, yy = np.meshgrid(x, np.arange(y0, y1))
+        difference[y0:y1] -= kernel.backgroundAt(xx, yy)
+    
+    if mask is not None:
+        difference[mask] = np.nan
+    
+    return difference, kernel
@@ -0,0 +1,546 @@
+"""
+Shared memory frame buffers for passing CCD frames between processes
+-Frames written once into named shared memory blocks by the owner
+-Small picklable handles sent to workers in place of the pixel data
+-Zero-copy numpy views of the frames in the workers
+-Reference counting in the owner, which frees each block when released
+
+Typical use, with the background subtracted in place in the shared
+frame and sources then extracted from it, both on a process pool:
+    
+    with FramePool() as frames, ProcessPoolExecutor() as pool:
+        handle, hdr = frames.load(filepath, hdu=1, dtype=np.float32)
+        _, bkg_rms = frames.submit(pool, 
+                                   subtractBackgroundTiled, 
+                                   handle, 
+                                   out=handle).result()
+        future = frames.submit(pool, sourceExtract, handle, 
+                               bkg_rms=bkg_rms)
+        frames.release(handle)
+        sources = future.result()
+
+The block is unlinked once the owner and every task it was passed to
+have released it.
+"""
+
+from frames import selectHDU
+from instrument import stage
+import uuid
+import threading
+import contextlib
+import numpy as np
+from astropy.io import fits
+from multiprocessing import shared_memory, resource_tracker
+
+_attach_lock = threading.Lock()
+
+class FrameHandle(object):
+    """
+    Picklable reference to a frame held in a shared memory block
+    """
+    
+    def __init__(self, name, shape, dtype, readonly=False):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block
+        shape : tuple
+            Shape of the frame
+        dtype : data-type
+            Data type of the frame
+        readonly : bool, optional
+            Toggle to make views of the frame read-only, so a stage
+            cannot change the data another stage sees - not for frames
+            passed to SEP, which needs writeable buffers
+            Default = False
+        """
+        self.name = name
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype).str
+        self.readonly = readonly
+    
+    def __repr__(self):
+        return 'FrameHandle({!r}, {}, {})'.format(self.name,
+                                                  self.shape,
+                                                  self.dtype)
+    
+    def __eq__(self, other):
+        return isinstance(other, FrameHandle) and self.name == other.name
+    
+    def __hash__(self):
+        return hash(self.name)
+    
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+    
+    def view(self, shm):
+        """
+        Numpy view of the frame in an attached shared memory block
+        
+        Parameters
+        ----------
+        shm : SharedMemory object
+            Block named by the handle
+        
+        Returns
+        -------
+        data : array-like
+            Frame data, sharing memory with the block
+        """
+        data = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        if self.readonly:
+            data.flags.writeable = False
+        
+        return data
+
+def attachBlock(name):
+    """
+    Attach to an existing shared memory block without registering it
+    with the resource tracker
+    
+    Before Python 3.13 every process attaching to a block registers it
+    with a resource tracker, which then unlinks it when that process
+    exits (or warns about a leak), even though the block belongs to
+    another process. Unregistering afterwards is no fix for pool workers,
+    which share the tracker of the owner and would cancel its own
+    registration, so registration is skipped while attaching instead.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory block
+    
+    Returns
+    -------
+    shm : SharedMemory object
+        Attached block, to be closed (not unlinked) after use
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _closeBlock(shm):
+    """
+    Close an attached block - views still referenced elsewhere keep the
+    mapping alive until they are garbage collected
+    """
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    
+    return None
+
+@contextlib.contextmanager
+def openFrame(handle):
+    """
+    Open a frame by handle in a worker process
+    
+    Parameters
+    ----------
+    handle : FrameHandle object
+        Handle to the frame
+    
+    Yields
+    ------
+    data : array-like
+        Zero-copy view of the frame, valid until the context exits
+    """
+    shm = attachBlock(handle.name)
+    try:
+        yield handle.view(shm)
+    finally:
+        _closeBlock(shm)
+
+def callWithFrames(func, *args, **kwargs):
+    """
+    Call a function with every FrameHandle among its arguments replaced
+    by a view of the frame
+    
+    Used as the task submitted to a process pool, so the stage function
+    itself (e.g. extract.sourceExtract) needs no knowledge of shared
+    memory. Arrays returned that are whole frames passed in (e.g. an
+    out buffer) are returned as their handles rather than pickled.
+    
+    Parameters
+    ----------
+    func : callable
+        Function to call, importable by worker processes
+    *args, **kwargs
+        Arguments for the function, any of which may be FrameHandles
+    
+    Returns
+    -------
+    result : object
+        Result of the function, or a tuple of results, with shared
+        frames replaced by their handles
+    """
+    blocks = {}
+    views = {}
+    
+    def _resolve(value):
+        if not isinstance(value, FrameHandle):
+            return value
+        if value.name not in blocks:
+            blocks[value.name] = attachBlock(value.name)
+        data = value.view(blocks[value.name])
+        views[value] = data
+        return data
+    
+    def _unresolve(value):
+        if not isinstance(value, np.ndarray):
+            return value
+        address = value.__array_interface__['data'][0]
+        for handle, data in views.items():
+            if (address == data.__array_interface__['data'][0] and
+                value.shape == data.shape and
+                value.dtype == data.dtype):
+                return handle
+        return value
+    
+    try:
+        result = func(*[_resolve(a) for a in args],
+                      **{k: _resolve(v) for k, v in kwargs.items()})
+        if isinstance(result, tuple):
+            result = tuple(_unresolve(r) for r in result)
+        else:
+            result = _unresolve(result)
+    finally:
+        views.clear()
+        for shm in blocks.values():
+            _closeBlock(shm)
+    
+    return result
+
+class FramePool(object):
+    """
+    Shared memory blocks holding CCD frames, owned by one process and
+    freed by reference count
+    
+    Each block starts with one reference, held by the caller that
+    created it. Passing a handle to a task with submit takes another
+    reference for the duration of the task. The block is unlinked when
+    the count reaches zero, and any left are unlinked on close.
+    """
+    
+    def __init__(self, prefix='pyccd'):
+        """
+        Parameters
+        ----------
+        prefix : str, optional
+            Prefix of the block names, to identify blocks left behind
+            by a crashed owner (in /dev/shm on Linux)
+            Default = 'pyccd'
+        """
+        self.prefix = prefix
+        self._blocks = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+        return False
+    
+    def __len__(self):
+        return len(self._blocks)
+    
+    def __contains__(self, handle):
+        return handle.name in self._blocks
+    
+    @property
+    def nbytes(self):
+        """
+        Total size of the frames held
+        """
+        with self._lock:
+            return sum(shm.size for shm in self._blocks.values())
+    
+    def allocate(self, shape, dtype=np.float64):
+        """
+        Create an empty frame, e.g. an output buffer for a task
+        
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the frame
+        dtype : data-type, optional
+            Data type of the frame
+            Default = np.float64
+        
+        Returns
+        -------
+        handle : FrameHandle object
+            Handle to the frame, holding one reference
+        data : array-like
+            View of the frame in this process
+        """
+        name = '{}_{}'.format(self.prefix, uuid.uuid4().hex[:16])
+        handle = FrameHandle(name, shape, dtype)
+        shm = shared_memory.SharedMemory(name=name,
+                                         create=True,
+                                         size=max(handle.nbytes, 1))
+        with self._lock:
+            self._blocks[name] = shm
+            self._refs[name] = 1
+        
+        return handle, handle.view(shm)
+    
+    def put(self, data, readonly=False):
+        """
+        Copy a frame into shared memory
+        
+        Parameters
+        ----------
+        data : array-like
+            Frame data
+        readonly : bool, optional
+            Toggle to make views of the frame read-only
+            Default = False
+        
+        Returns
+        -------
+        handle : FrameHandle object
+            Handle to the frame, holding one reference
+        """
+        data = np.asarray(data)
+        handle, view = self.allocate(data.shape, dtype=data.dtype)
+        view[...] = data
+        handle.readonly = readonly
+        
+        return handle
+    
+    def load(self, filepath, hdu=None, extname=None, ccd=None, dtype=None,
+             readonly=False):
+        """
+        Load a frame from a FITS file straight into shared memory
+        
+        The file is memory-mapped, so the frame is read from disk and
+        written into its block once, with no private copy in between
+        (unlike frames.loadFrame, which converts the byte order in a
+        copy-on-write mapping)
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the FITS file
+        hdu : int or str, optional
+            Index or EXTNAME of the HDU
+            Default = None
+        extname : str, optional
+            EXTNAME of the HDU
+            Default = None
+        ccd : int, optional
+            CCD number of the HDU
+            Default = None
+        dtype : data-type, optional
+            Data type of the frame in shared memory
+            Default = None, the type stored in the file
+        readonly : bool, optional
+            Toggle to make views of the frame read-only
+            Default = False
+        
+        Returns
+        -------
+        handle : FrameHandle object
+            Handle to the frame, holding one reference
+        header : astropy Header object
+            Header for the HDU
+        
+        Raises
+        ------
+        FileNotFoundError
+            If the file does not exist
+        KeyError
+            If no HDU matches the selection
+        """
+        with stage('load_frame', file=filepath, hdu=hdu) as s:
+            with fits.open(filepath, memmap=True) as f:
+                index = selectHDU(f, hdu=hdu, extname=extname, ccd=ccd)
+                header = f[index].header
+                data = f[index].data
+                if dtype is None:
+                    dtype = data.dtype.newbyteorder('=')
+                # byte order and type are converted while copying from
+                # the mapped file into the block
+                handle, view = self.allocate(data.shape, dtype=dtype)
+                np.copyto(view, data, casting='unsafe')
+                handle.readonly = readonly
+                s['pixels'] = data.size
+                del data, view
+        
+        return handle, header
+    
+    def view(self, handle):
+        """
+        View of a frame in the owner process
+        
+        Parameters
+        ----------
+        handle : FrameHandle object
+            Handle to the frame
+        
+        Returns
+        -------
+        data : array-like
+            Frame data, sharing memory with the block - not to be used
+            after the last reference is released
+        
+        Raises
+        ------
+        KeyError
+            If the frame has been released
+        """
+        with self._lock:
+            shm = self._blocks[handle.name]
+        
+        return handle.view(shm)
+    
+    def acquire(self, handle):
+        """
+        Take another reference to a frame
+        
+        Parameters
+        ----------
+        handle : FrameHandle object
+            Handle to the frame
+        
+        Returns
+        -------
+        handle : FrameHandle object
+            The same handle
+        
+        Raises
+        ------
+        KeyError
+            If the frame has been released
+        """
+        with self._lock:
+            if handle.name not in self._refs:
+                raise KeyError('Frame {} has been released'.format(
+                    handle.name))
+            self._refs[handle.name] += 1
+        
+        return handle
+    
+    def release(self, handle):
+        """
+        Drop a reference to a frame, freeing its block with the last
+        
+        Parameters
+        ----------
+        handle : FrameHandle object
+            Handle to the frame
+        
+        Returns
+        -------
+        refs : int
+            Number of references left
+        
+        Raises
+        ------
+        KeyError
+            If the frame has already been released
+        """
+        with self._lock:
+            if handle.name not in self._refs:
+                raise KeyError('Frame {} has been released'.format(
+                    handle.name))
+            self._refs[handle.name] -= 1
+            refs = self._refs[handle.name]
+            if refs == 0:
+                del self._refs[handle.name]
+                shm = self._blocks.pop(handle.name)
+            else:
+                shm = None
+        
+        if shm is not None:
+            _closeBlock(shm)
+            shm.unlink()
+        
+        return refs
+    
+    def refs(self, handle):
+        """
+        Number of references held to a frame, zero once released
+        """
+        with self._lock:
+            return self._refs.get(handle.name, 0)
+    
+    def submit(self, executor, func, *args, **kwargs):
+        """
+        Submit a task to an executor with frames passed by handle
+        
+        Every FrameHandle among the arguments gains a reference until
+        the task finishes, so the caller may release its own as soon as
+        the task is submitted
+        
+        Parameters
+        ----------
+        executor : Executor object
+            Pool to submit the task to, e.g. a ProcessPoolExecutor
+        func : callable
+            Function to call, importable by worker processes
+        *args, **kwargs
+            Arguments for the function, any of which may be FrameHandles
+        
+        Returns
+        -------
+        future : Future object
+            Future for the result of callWithFrames
+        """
+        handles = [a for a in list(args) + list(kwargs.values())
+                   if isinstance(a, FrameHandle)]
+        for handle in handles:
+            self.acquire(handle)
+        
+        try:
+            future = executor.submit(callWithFrames, func, *args, **kwargs)
+        except Exception:
+            for handle in handles:
+                self.release(handle)
+            raise
+        
+        def _done(future):
+            for handle in handles:
+                try:
+                    self.release(handle)
+                except KeyError:
+                    # the pool was closed before the task finished
+                    pass
+        
+        future.add_done_callback(_done)
+        
+        return future
+    
+    def close(self):
+        """
+        Free every block still held, whatever its reference count
+        
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            blocks = list(self._blocks.values())
+            self._blocks.clear()
+            self._refs.clear()
+        
+        for shm in blocks:
+            _closeBlock(shm)
+            shm.unlink()
+        
+        return None
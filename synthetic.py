@@ -0,0 +1,528 @@
+"""
+Functions for generating synthetic CCD frames for testing/benchmarking
+-Sky gradient, Gaussian or Moffat stars and Poisson/read noise
+-Satellite trails sized with utils.getTrailLength
+-Bad columns and matching bad pixel masks
+-WCS and detector headers, single frames and multi-extension mosaics
+"""
+
+import os
+import numpy as np
+from astropy.io import fits
+from utils import getTrailLength
+
+# INT WFC defaults
+FRAME_SHAPE = (6132, 8176)
+PLATESCALE = 0.333
+
+def wcsHeader(ra, dec, shape=FRAME_SHAPE, platescale=PLATESCALE, rot=0.,
+              crpix=None, sip=True):
+    """
+    Build a celestial WCS header like those written by solve-field
+    
+    Parameters
+    ----------
+    ra, dec : float
+        World coords of the reference pixel in degrees
+    shape : tuple, optional
+        (ny, nx) shape of the frame
+        Default = FRAME_SHAPE
+    platescale : float, optional
+        Pixel scale in arcsec per pixel
+        Default = PLATESCALE
+    rot : float, optional
+        Rotation of the frame in degrees
+        Default = 0.
+    crpix : tuple, optional
+        (x, y) reference pixel
+        Default = None, the centre of the frame
+    sip : bool, optional
+        Toggle to include a small second order SIP distortion
+        Default = True
+    
+    Returns
+    -------
+    hdr : astropy Header object
+        Header containing the WCS
+    """
+    ny, nx = shape
+    if crpix is None:
+        crpix = ((nx + 1) / 2., (ny + 1) / 2.)
+    scale = platescale / 3600.
+    c, s = np.cos(np.radians(rot)), np.sin(np.radians(rot))
+    
+    hdr = fits.Header()
+    hdr['NAXIS'] = 2
+    hdr['NAXIS1'] = nx
+    hdr['NAXIS2'] = ny
+    hdr['IMAGEW'] = nx
+    hdr['IMAGEH'] = ny
+    hdr['CTYPE1'] = 'RA---TAN-SIP' if sip else 'RA---TAN'
+    hdr['CTYPE2'] = 'DEC--TAN-SIP' if sip else 'DEC--TAN'
+    hdr['CRPIX1'], hdr['CRPIX2'] = crpix
+    hdr['CRVAL1'] = ra
+    hdr['CRVAL2'] = dec
+    hdr['CD1_1'] = -scale*c
+    hdr['CD1_2'] = scale*s
+    hdr['CD2_1'] = scale*s
+    hdr['CD2_2'] = scale*c
+    if sip:
+        # a few pixels of distortion at the corners of a full frame
+        hdr['A_ORDER'] = 2
+        hdr['B_ORDER'] = 2
+        hdr['A_2_0'] = 2e-7
+        hdr['A_0_2'] = -1e-7
+        hdr['A_1_1'] = 1e-7
+        hdr['B_2_0'] = -1e-7
+        hdr['B_0_2'] = 2e-7
+        hdr['B_1_1'] = 1.5e-7
+    
+    return hdr
+
+def detectorHeader(shape=FRAME_SHAPE, x_offset=0., y_offset=0.):
+    """
+    Build an HDU header mapping CCD pixels to mosaic detector coords,
+    as used by wcs.convertToDetector
+    
+    Parameters
+    ----------
+    shape : tuple, optional
+        (ny, nx) shape of the CCD
+        Default = FRAME_SHAPE
+    x_offset, y_offset : float, optional
+        Position of the CCD origin in the detector plane in pixels
+        Default = 0.
+    
+    Returns
+    -------
+    hdr : astropy Header object
+        Header containing the linear detector transformation
+    """
+    hdr = fits.Header()
+    hdr['CTYPE1'] = 'LINEAR'
+    hdr['CTYPE2'] = 'LINEAR'
+    hdr['CRPIX1'] = 1.
+    hdr['CRPIX2'] = 1.
+    hdr['CRVAL1'] = 1. + x_offset
+    hdr['CRVAL2'] = 1. + y_offset
+    hdr['CD1_1'] = 1.
+    hdr['CD1_2'] = 0.
+    hdr['CD2_1'] = 0.
+    hdr['CD2_2'] = 1.
+    
+    return hdr
+
+def randomStars(n_stars, shape=FRAME_SHAPE, flux_range=(1e3, 1e6),
+                slope=-1.5, seed=0):
+    """
+    Draw star positions uniformly over a frame, with a power law
+    distribution of fluxes
+    
+    Parameters
+    ----------
+    n_stars : int
+        Number of stars
+    shape : tuple, optional
+        (ny, nx) shape of the frame
+        Default = FRAME_SHAPE
+    flux_range : tuple, optional
+        Minimum and maximum total flux in counts
+        Default = (1e3, 1e6)
+    slope : float, optional
+        Power law index of the flux distribution, dN/dF ~ F^slope
+        Default = -1.5
+    seed : int, optional
+        Seed for the random number generator
+        Default = 0
+    
+    Returns
+    -------
+    x, y : array-like
+        Pixel coords of the stars (FITS 1-based convention)
+    flux : array-like
+        Total flux of each star
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    x = rng.uniform(0.5, nx + 0.5, n_stars)
+    y = rng.uniform(0.5, ny + 0.5, n_stars)
+    
+    # inverse transform sampling of the power law
+    lo, hi = flux_range
+    k = slope + 1.
+    u = rng.uniform(0., 1., n_stars)
+    flux = (lo**k + u*(hi**k - lo**k))**(1. / k)
+    
+    return x, y, flux
+
+def renderStars(data, x, y, flux, psf='gaussian', fwhm=3., beta=3.,
+                half_width=None, chunk=4096):
+    """
+    Add stars to an image in place
+    
+    Stamps are evaluated for many stars at once and accumulated with a
+    scatter-add, rather than one slice update per star
+    
+    Parameters
+    ----------
+    data : array-like
+        Image to which the stars are added
+    x, y : array-like
+        Pixel coords of the stars (FITS 1-based convention)
+    flux : array-like
+        Total flux of each star
+    psf : str, optional
+        Profile of the stars - 'gaussian' or 'moffat'
+        Default = 'gaussian'
+    fwhm : float, optional
+        Full width half maximum of the profile in pixels
+        Default = 3.
+    beta : float, optional
+        Moffat power index
+        Default = 3.
+    half_width : int, optional
+        Half width of the stamp evaluated for each star
+        Default = None, 4 x fwhm
+    chunk : int, optional
+        Number of stars rendered at once
+        Default = 4096
+    
+    Returns
+    -------
+    data : array-like
+        Image with the stars added
+    
+    Raises
+    ------
+    ValueError
+        If the profile is unknown
+    """
+    ny, nx = data.shape
+    if half_width is None:
+        half_width = int(np.ceil(4*fwhm))
+    
+    # zero-based centres, dropping stars whose stamps miss the frame
+    x = np.asarray(x, dtype=np.float64) - 1
+    y = np.asarray(y, dtype=np.float64) - 1
+    flux = np.asarray(flux, dtype=np.float64)
+    near = ((x > -half_width) & (x < nx + half_width) &
+            (y > -half_width) & (y < ny + half_width))
+    x, y, flux = x[near], y[near], flux[near]
+    
+    offsets = np.arange(-half_width, half_width + 1)
+    
+    # chunks of stars keep the stamp arrays to a few tens of MB
+    for i in range(0, len(x), chunk):
+        cx, cy = x[i:i + chunk, None, None], y[i:i + chunk, None, None]
+        ix = np.round(cx).astype(np.intp) + offsets[None, None, :]
+        iy = np.round(cy).astype(np.intp) + offsets[None, :, None]
+        r2 = (ix - cx)**2 + (iy - cy)**2
+        
+        if psf == 'gaussian':
+            sigma = fwhm / (2.*np.sqrt(2.*np.log(2.)))
+            profile = np.exp(-r2 / (2.*sigma**2)) / (2.*np.pi*sigma**2)
+        elif psf == 'moffat':
+            alpha = fwhm / (2.*np.sqrt(2.**(1. / beta) - 1.))
+            profile = ((beta - 1.) / (np.pi*alpha**2) * 
+                       (1. + r2 / alpha**2)**(-beta))
+        else:
+            raise ValueError('Unknown PSF profile {}'.format(psf))
+        
+        values = profile * flux[i:i + chunk, None, None]
+        ix, iy = np.broadcast_arrays(ix, iy)
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        np.add.at(data, (iy[inside], ix[inside]), values[inside])
+    
+    return data
+
+def renderTrail(data, x_0, y_0, angle, length, flux, fwhm=3.):
+    """
+    Add a satellite trail to an image in place
+    
+    Parameters
+    ----------
+    data : array-like
+        Image to which the trail is added
+    x_0, y_0 : float
+        Pixel coords of the start of the trail (FITS 1-based)
+    angle : float
+        Direction of the trail in degrees anticlockwise from +x
+    length : float
+        Length of the trail in pixels
+    flux : float
+        Total flux of the trail
+    fwhm : float, optional
+        Full width half maximum across the trail in pixels
+        Default = 3.
+    
+    Returns
+    -------
+    data : array-like
+        Image with the trail added
+    """
+    ny, nx = data.shape
+    sigma = fwhm / (2.*np.sqrt(2.*np.log(2.)))
+    dx, dy = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    x_0, y_0 = x_0 - 1, y_0 - 1
+    x_1, y_1 = x_0 + length*dx, y_0 + length*dy
+    
+    # only evaluate the bounding box of the trail
+    pad = 4.*sigma
+    c0 = int(max(np.floor(min(x_0, x_1) - pad), 0))
+    c1 = int(min(np.ceil(max(x_0, x_1) + pad) + 1, nx))
+    r0 = int(max(np.floor(min(y_0, y_1) - pad), 0))
+    r1 = int(min(np.ceil(max(y_0, y_1) + pad) + 1, ny))
+    if c0 >= c1 or r0 >= r1:
+        return data
+    
+    yy, xx = np.mgrid[r0:r1, c0:c1]
+    along = np.clip((xx - x_0)*dx + (yy - y_0)*dy, 0., length)
+    dist2 = (xx - x_0 - along*dx)**2 + (yy - y_0 - along*dy)**2
+    profile = np.exp(-dist2 / (2.*sigma**2)) / (np.sqrt(2.*np.pi)*sigma)
+    data[r0:r1, c0:c1] += (flux / max(length, 1.)) * profile
+    
+    return data
+
+def makeFrame(shape=FRAME_SHAPE, n_stars=5000, stars=None, psf='gaussian',
+              fwhm=3., beta=3., sky=1000., gradient=(0.02, 0.01),
+              gain=1., read_noise=5., n_trails=1, trail_flux=5e5,
+              exptime=30., platescale=PLATESCALE, n_bad_columns=4,
+              saturation=65535., seed=0, dtype=np.float32):
+    """
+    Generate a synthetic CCD frame
+    
+    Parameters
+    ----------
+    shape : tuple, optional
+        (ny, nx) shape of the frame
+        Default = FRAME_SHAPE
+    n_stars : int, optional
+        Number of randomly placed stars, if stars is not given
+        Default = 5000
+    stars : tuple, optional
+        (x, y, flux) of the stars, e.g. projected from a sky field
+        Default = None
+    psf : str, optional
+        Profile of the stars - 'gaussian' or 'moffat'
+        Default = 'gaussian'
+    fwhm : float, optional
+        Seeing in pixels
+        Default = 3.
+    beta : float, optional
+        Moffat power index
+        Default = 3.
+    sky : float, optional
+        Sky level at the centre of the frame in counts
+        Default = 1000.
+    gradient : tuple, optional
+        Change in sky level per pixel along x and y
+        Default = (0.02, 0.01)
+    gain : float, optional
+        Gain in electrons per count
+        Default = 1.
+    read_noise : float, optional
+        Read noise in counts
+        Default = 5.
+    n_trails : int, optional
+        Number of satellite trails
+        Default = 1
+    trail_flux : float, optional
+        Total flux of each trail
+        Default = 5e5
+    exptime : float, optional
+        Exposure time in seconds, setting the trail lengths
+        Default = 30.
+    platescale : float, optional
+        Pixel scale in arcsec per pixel, setting the trail lengths
+        Default = PLATESCALE
+    n_bad_columns : int, optional
+        Number of bad columns, alternately hot and dead
+        Default = 4
+    saturation : float, optional
+        Level at which pixels saturate
+        Default = 65535.
+    seed : int, optional
+        Seed for the random number generator
+        Default = 0
+    dtype : data-type, optional
+        Data type of the frame
+        Default = np.float32
+    
+    Returns
+    -------
+    data : array-like
+        Synthetic image
+    mask : array-like
+        Boolean bad pixel mask, True for bad columns
+    stars : tuple
+        (x, y, flux) of the stars in the frame (FITS 1-based)
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    
+    if stars is None:
+        stars = randomStars(n_stars, shape=shape, seed=seed)
+    
+    # sky plane about the frame centre
+    data = np.empty(shape, dtype=dtype)
+    xs = (np.arange(nx) - nx / 2.) * gradient[0]
+    for y0 in range(0, ny, 1024):
+        y1 = min(y0 + 1024, ny)
+        ys = (np.arange(y0, y1) - ny / 2.) * gradient[1]
+        data[y0:y1] = sky + ys[:, None] + xs[None, :]
+    
+    renderStars(data, stars[0], stars[1], stars[2], psf=psf, fwhm=fwhm,
+                beta=beta)
+    
+    length = getTrailLength(exptime, platescale)
+    for _ in range(n_trails):
+        renderTrail(data,
+                    rng.uniform(1, nx),
+                    rng.uniform(1, ny),
+                    rng.uniform(0., 360.),
+                    length,
+                    trail_flux,
+                    fwhm=fwhm)
+    
+    # photon and read noise, in blocks of rows to bound memory
+    for y0 in range(0, ny, 1024):
+        block = data[y0:y0 + 1024]
+        sigma = np.sqrt(np.maximum(block, 0.) / gain + read_noise**2)
+        block += (rng.standard_normal(block.shape, dtype=np.float32) *
+                  sigma).astype(dtype)
+    np.minimum(data, saturation, out=data)
+    
+    mask = np.zeros(shape, dtype=bool)
+    columns = rng.choice(nx, size=min(n_bad_columns, nx), replace=False)
+    for i, col in enumerate(columns):
+        data[:, col] = saturation if i % 2 == 0 else 0.
+        mask[:, col] = True
+    
+    return data, mask, stars
+
+def writeFrame(filepath, data, header=None, mask_path=None, mask=None,
+               bitpix=-32):
+    """
+    Write a synthetic frame (and optionally its mask) to FITS
+    
+    FITS data are big-endian on disk, so frames written here exercise
+    the byte order conversion done when loading
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the output file
+    data : array-like
+        Image data
+    header : astropy Header object, optional
+        Header for the image HDU
+        Default = None
+    mask_path : str, optional
+        Path to which the bad pixel mask is written
+        Default = None
+    mask : array-like, optional
+        Bad pixel mask
+        Default = None
+    bitpix : int, optional
+        -32 for float32 or 16 for scaled integers
+        Default = -32
+    
+    Returns
+    -------
+    None
+    """
+    if bitpix == 16:
+        hdu = fits.PrimaryHDU(header=header)
+        hdu.data = np.clip(np.round(data), 0, 65535).astype(np.uint16)
+    else:
+        hdu = fits.PrimaryHDU(np.asarray(data, dtype='>f4'), header=header)
+    hdu.writeto(filepath, overwrite=True)
+    
+    if mask_path is not None and mask is not None:
+        fits.PrimaryHDU(mask.astype(np.uint8)).writeto(mask_path,
+                                                       overwrite=True)
+    
+    return None
+
+def makeMosaic(filepath, ra=150., dec=20., n_ccds=4, shape=FRAME_SHAPE,
+               gap=100, n_stars=20000, wcs_dir=None, seed=0,
+               **frame_kwargs):
+    """
+    Generate a multi-extension mosaic with a consistent star field
+    across its CCDs, plus a WCS file for each CCD
+    
+    The WCS solutions map detector coords, so are applied after the
+    detector transformation in each HDU header
+    
+    Parameters
+    ----------
+    filepath : str
+        Path to the output FITS file
+    ra, dec : float, optional
+        Pointing of the mosaic centre in degrees
+        Default = 150., 20.
+    n_ccds : int, optional
+        Number of CCDs, laid side by side along x
+        Default = 4
+    shape : tuple, optional
+        (ny, nx) shape of each CCD
+        Default = FRAME_SHAPE
+    gap : int, optional
+        Gap between CCDs in pixels
+        Default = 100
+    n_stars : int, optional
+        Number of stars over the whole mosaic
+        Default = 20000
+    wcs_dir : str, optional
+        Directory for the WCS files, named <prefix>_ccd<n>.wcs
+        Default = None, alongside the mosaic
+    seed : int, optional
+        Seed for the random number generator
+        Default = 0
+    **frame_kwargs
+        Further keyword arguments for makeFrame
+    
+    Returns
+    -------
+    wcs_paths : list
+        Path to the WCS file for each CCD
+    """
+    ny, nx = shape
+    width = n_ccds*nx + (n_ccds - 1)*gap
+    
+    # stars in detector coords, shared by every CCD
+    x_det, y_det, flux = randomStars(n_stars,
+                                     shape=(ny, width),
+                                     seed=seed)
+    
+    # one solution in detector coords, tangent point at the centre
+    wcs_hdr = wcsHeader(ra, dec, shape=(ny, width))
+    
+    if wcs_dir is None:
+        wcs_dir = os.path.dirname(filepath)
+    prefix = os.path.splitext(os.path.basename(filepath))[0]
+    
+    hdus = [fits.PrimaryHDU()]
+    wcs_paths = []
+    for i in range(n_ccds):
+        x_off = i*(nx + gap)
+        on = (x_det > x_off) & (x_det < x_off + nx + 1)
+        stars = (x_det[on] - x_off, y_det[on], flux[on])
+        data, _, _ = makeFrame(shape=shape,
+                               stars=stars,
+                               seed=seed + i + 1,
+                               **frame_kwargs)
+        
+        hdr = detectorHeader(shape, x_offset=x_off)
+        hdr['EXTNAME'] = 'CCD{}'.format(i + 1)
+        hdr['IMAGEID'] = i + 1
+        hdus.append(fits.ImageHDU(np.asarray(data, dtype='>f4'), header=hdr))
+        
+        wcs_path = os.path.join(wcs_dir,
+                                '{}_ccd{}.wcs'.format(prefix, i + 1))
+        fits.PrimaryHDU(header=wcs_hdr).writeto(wcs_path, overwrite=True)
+        wcs_paths.append(wcs_path)
+    
+    fits.HDUList(hdus).writeto(filepath, overwrite=True)
+    
+    return wcs_paths
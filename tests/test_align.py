@@ -0,0 +1,97 @@
+"""
+Tests of the warp fitting and resampling in align.py
+"""
+
+import numpy as np
+import pytest
+
+from align import Warp, fitWarp, alignImage
+
+def _points(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(1, 1000, n), rng.uniform(1, 800, n)
+
+def test_fit_recovers_homography():
+    h = np.array([[1.001, 0.002, 12.5],
+                  [-0.003, 0.998, -7.25],
+                  [1e-6, -2e-6, 1.]])
+    x, y = _points()
+    x_2, y_2 = Warp('homography', h)(x, y)
+    warp = fitWarp(x, y, x_2, y_2)
+    
+    assert np.allclose(warp.params / warp.params[2, 2], h, rtol=1e-4,
+                       atol=1e-8)
+    assert warp.rms < 1e-3
+    assert warp.inliers.all()
+
+def test_fit_recovers_polynomial():
+    x, y = _points()
+    x_2 = 3. + 1.01*x + 1e-5*x**2 - 2e-6*x*y
+    y_2 = -4. + 0.99*y + 0.002*x + 3e-6*y**2
+    warp = fitWarp(x, y, x_2, y_2, model='polynomial', order=2)
+    
+    assert warp.rms < 1e-8
+    
+    # holds away from the control points too
+    x_t, y_t = _points(seed=1)
+    x_f, y_f = warp(x_t, y_t)
+    assert np.allclose(x_f, 3. + 1.01*x_t + 1e-5*x_t**2 - 2e-6*x_t*y_t)
+    assert np.allclose(y_f, -4. + 0.99*y_t + 0.002*x_t + 3e-6*y_t**2)
+
+def test_ransac_rejects_outliers():
+    h = np.array([[1., 0., 5.], [0., 1., -3.], [0., 0., 1.]])
+    x, y = _points()
+    x_2, y_2 = Warp('homography', h)(x, y)
+    x_2[:5] += 40.
+    warp = fitWarp(x, y, x_2, y_2, ransac_thresh=1.)
+    
+    assert not warp.inliers[:5].any()
+    assert warp.inliers[5:].all()
+    assert np.allclose(warp.params / warp.params[2, 2], h, atol=1e-6)
+
+def test_too_few_points_raise():
+    x, y = _points(n=3)
+    with pytest.raises(ValueError):
+        fitWarp(x, y, x, y)
+    with pytest.raises(ValueError):
+        fitWarp(x, y, x, y, model='polynomial')
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.int16])
+def test_align_output_dtype(dtype):
+    data = np.arange(60 * 40).reshape(60, 40).astype(dtype)
+    warp = Warp('homography', np.eye(3))
+    aligned, _ = alignImage(data, warp, data.shape, n_threads=1)
+    
+    # the last row and column interpolate towards the border fill
+    expected = np.float64 if dtype == np.float64 else np.float32
+    assert aligned.dtype == expected
+    assert np.array_equal(aligned[:-1, :-1],
+                          data[:-1, :-1].astype(expected))
+
+def test_align_integer_shift():
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(70, 50))
+    warp = Warp('homography', [[1., 0., 3.], [0., 1., 5.], [0., 0., 1.]])
+    aligned, _ = alignImage(data, warp, (60, 40), tile_rows=16)
+    
+    # output pixel (x, y) samples frame 2 at (x + 3, y + 5)
+    assert np.allclose(aligned, data[5:65, 3:43])
+
+def test_mask_propagates_through_remap():
+    data = np.zeros((60, 40))
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[30, 20] = True
+    
+    # half-pixel shift in x, so the bad pixel touches two outputs
+    warp = Warp('homography', [[1., 0., 2.5], [0., 1., 0.], [0., 0., 1.]])
+    aligned, aligned_mask = alignImage(data, warp, data.shape, mask=mask,
+                                       tile_rows=7)
+    
+    assert aligned_mask.dtype == bool
+    assert np.array_equal(np.argwhere(aligned_mask[:, :-3]),
+                          [[30, 17], [30, 18]])
+    
+    # outputs mapping beyond frame 2 are bad and filled
+    assert aligned_mask[:, -2:].all()
+    assert np.isnan(aligned[:, -2:]).all()
+    assert not np.isnan(aligned[:-1, :-3]).any()
@@ -0,0 +1,104 @@
+"""
+Tests of the reusable background models in background.py
+"""
+
+import os
+import numpy as np
+import pytest
+
+from synthetic import makeFrame
+from background import BackgroundModel, BackgroundCache
+
+SHAPE = (512, 768)
+
+@pytest.fixture(scope='module')
+def frames():
+    # two exposures of the same stars, the second with a brighter and
+    # steeper sky
+    first, _, stars = makeFrame(shape=SHAPE, n_stars=200, n_trails=0,
+                                n_bad_columns=0, seed=1)
+    second, _, _ = makeFrame(shape=SHAPE, stars=stars, sky=1100.,
+                             gradient=(0.03, 0.015), n_trails=0,
+                             n_bad_columns=0, seed=2)
+    return first, second
+
+def test_model_reproduces_sep_background(frames):
+    model, back = BackgroundModel.estimate(frames[0])
+    
+    assert model.back_mesh.shape == (16, 24)
+    assert np.abs(model.back() - back).max() < 0.01 * model.globalrms
+    assert np.array_equal(model.back(step=4), model.back()[::4, ::4])
+
+@pytest.mark.parametrize('mode', ['rescale', 'incremental'])
+def test_update_tracks_fresh_background(frames, mode):
+    model, _ = BackgroundModel.estimate(frames[0])
+    updated, data_sub, bkg_rms, recomputed = model.update(frames[1],
+                                                          mode=mode)
+    fresh, back = BackgroundModel.estimate(frames[1])
+    
+    # the fresh estimate has its own noise of a few percent of the rms
+    # in each box, so compare typical and worst case differences
+    error = np.abs(updated.back() - back)
+    assert not recomputed and updated is model
+    assert np.median(error) < 0.1 * fresh.globalrms
+    assert error[32:-32, 32:-32].max() < 0.3 * fresh.globalrms
+    assert bkg_rms == pytest.approx(fresh.globalrms, rel=0.05)
+    assert np.allclose(data_sub, frames[1] - updated.back(), atol=1e-3)
+
+@pytest.mark.parametrize('mode', ['rescale', 'incremental'])
+def test_drift_triggers_recompute(frames, mode):
+    # box-scale structure that neither a rescale nor the median
+    # filtered correction can follow
+    yy, xx = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    pattern = np.where((yy // 32 + xx // 32) % 2, 40., -40.)
+    drifted = (frames[1] + pattern).astype(np.float32)
+    
+    model, _ = BackgroundModel.estimate(frames[0])
+    updated, data_sub, bkg_rms, recomputed = model.update(drifted,
+                                                          mode=mode)
+    fresh, back = BackgroundModel.estimate(drifted)
+    
+    assert recomputed and updated is not model
+    assert np.array_equal(updated.back_mesh, fresh.back_mesh)
+    assert np.array_equal(data_sub, drifted - back)
+    assert bkg_rms == fresh.globalrms
+
+def test_update_rejects_other_shapes(frames):
+    model, _ = BackgroundModel.estimate(frames[0])
+    with pytest.raises(ValueError):
+        model.update(frames[1][:256])
+    with pytest.raises(ValueError):
+        model.update(frames[1], mode='spline')
+
+def test_save_load_round_trip(frames, tmp_path):
+    model, _ = BackgroundModel.estimate(frames[0], box_width=64,
+                                        box_height=32, filter_width=5)
+    outpath = str(tmp_path / 'bkg.npz')
+    model.save(outpath)
+    loaded = BackgroundModel.load(outpath)
+    
+    assert np.array_equal(loaded.back_mesh, model.back_mesh)
+    assert np.array_equal(loaded.rms_mesh, model.rms_mesh)
+    assert loaded.shape == model.shape
+    assert loaded.globalrms == model.globalrms
+    assert loaded.matches(SHAPE, box_width=64, box_height=32,
+                          filter_width=5)
+    assert not loaded.matches(SHAPE)
+    assert np.array_equal(loaded.back(), model.back())
+
+def test_cache_reuses_models(frames, tmp_path):
+    cache_dir = str(tmp_path / 'bkg')
+    cache = BackgroundCache(window=600., cache_dir=cache_dir)
+    cache.subtract(frames[0], 1, 1000.)
+    cache.subtract(frames[1], 1, 1100.)
+    cache.subtract(frames[1], 2, 1100.)
+    cache.subtract(frames[1], 1, 1300.)
+    
+    assert cache.counts == {'estimate': 3, 'update': 1, 'recompute': 0}
+    assert sorted(os.listdir(cache_dir)) == ['bkg_1_1.npz', 'bkg_1_2.npz',
+                                             'bkg_2_1.npz']
+    
+    # a new cache sharing the directory picks the models up from disk
+    other = BackgroundCache(window=600., cache_dir=cache_dir)
+    other.subtract(frames[1], 2, 1150.)
+    assert other.counts == {'estimate': 0, 'update': 1, 'recompute': 0}
@@ -0,0 +1,99 @@
+"""
+Tests of the batch subtraction driver in batch_subtract.py
+"""
+
+import os
+import pytest
+
+import batch_subtract
+from batch_subtract import pairJobs, readReport, runBatch, writeReport
+
+def _pair(tmp_path, **kwargs):
+    pair = {'id': 'p1',
+            'img_1': str(tmp_path / 'missing_1.fits'),
+            'img_2': str(tmp_path / 'missing_2.fits'),
+            'wcs_1': str(tmp_path / 'w1_{hdu}.wcs'),
+            'wcs_2': str(tmp_path / 'w2_{hdu}.wcs'),
+            'bp_mask': str(tmp_path / 'bpm.fits'),
+            'hdu_1': '1;2;3;4'}
+    pair.update(kwargs)
+    return pair
+
+def test_pair_jobs_fill_hdu(tmp_path):
+    jobs = pairJobs(_pair(tmp_path, mask_hdu='CCD1;CCD2;CCD3;CCD4'),
+                    out_dir=str(tmp_path))
+    
+    assert [job['hdu'] for job in jobs] == ['1', '2', '3', '4']
+    assert [job['mask_hdu'] for job in jobs] == ['CCD1', 'CCD2', 'CCD3',
+                                                 'CCD4']
+    assert jobs[2]['wcs_1'] == str(tmp_path / 'w1_3.wcs')
+    assert jobs[2]['out'] == str(tmp_path / 'p1_3_diff.fits')
+
+@pytest.mark.parametrize('out, expected', [
+    ('diff.fits', ['diff_1.fits', 'diff_2.fits']),
+    ('diff_{hdu}.fits', ['diff_1.fits', 'diff_2.fits']),
+    ('d/{hdu}/diff', ['d/1/diff', 'd/2/diff'])])
+def test_pair_jobs_distinct_outputs(tmp_path, out, expected):
+    jobs = pairJobs(_pair(tmp_path, hdu_1='1;2', out=out))
+    
+    assert [job['out'] for job in jobs] == expected
+
+def test_pair_jobs_single_hdu_keeps_out(tmp_path):
+    jobs = pairJobs(_pair(tmp_path, hdu_1='2', out='diff.fits'))
+    
+    assert [job['out'] for job in jobs] == ['diff.fits']
+
+def test_pair_jobs_mismatched_hdus(tmp_path):
+    with pytest.raises(ValueError):
+        pairJobs(_pair(tmp_path, hdu_2='1;2'))
+
+def test_retry_skips_done_jobs(tmp_path):
+    jobs = pairJobs(_pair(tmp_path), out_dir=str(tmp_path))
+    report_path = str(tmp_path / 'report.csv')
+    
+    # 1 done, 2 failed, 3 done but its output since removed, 4 new
+    open(jobs[0]['out'], 'w').close()
+    writeReport(report_path, {
+        ('p1', '1'): {'id': 'p1', 'hdu': '1', 'status': 'done',
+                      'out': jobs[0]['out']},
+        ('p1', '2'): {'id': 'p1', 'hdu': '2', 'status': 'failed',
+                      'out': jobs[1]['out']},
+        ('p1', '3'): {'id': 'p1', 'hdu': '3', 'status': 'done',
+                      'out': jobs[2]['out']}})
+    
+    rows = list(runBatch(jobs, report_path, n_workers=2))
+    
+    assert sorted(row['hdu'] for row in rows) == ['2', '3', '4']
+    assert all(row['status'] == 'failed' for row in rows)
+    report = readReport(report_path)
+    assert report[('p1', '1')]['status'] == 'done'
+    assert [report[('p1', h)]['status'] for h in '234'] == ['failed']*3
+    
+    rows = list(runBatch(jobs, report_path, n_workers=2, force=True))
+    assert sorted(row['hdu'] for row in rows) == ['1', '2', '3', '4']
+
+def _dieOnSecond(job, options):
+    # stands in for _runJob, killing the worker process for CCD 2
+    if job['hdu'] == '2':
+        os._exit(1)
+    return {'id': job['id'], 'hdu': job['hdu'], 'out': job['out'],
+            'status': 'done', 'error': ''}
+
+def test_dead_worker_fails_only_its_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_subtract, '_runJob', _dieOnSecond)
+    jobs = pairJobs(_pair(tmp_path, hdu_1='1;2;3;4;5;6'),
+                    out_dir=str(tmp_path))
+    report_path = str(tmp_path / 'report.csv')
+    
+    rows = {row['hdu']: row for row in runBatch(jobs, report_path,
+                                                n_workers=1)}
+    
+    # jobs queued on the broken pool fail with it, later ones run on a
+    # new pool
+    assert sorted(rows) == ['1', '2', '3', '4', '5', '6']
+    assert rows['2']['status'] == 'failed'
+    assert rows['2']['error'].startswith('BrokenProcessPool')
+    assert rows['1']['status'] == rows['6']['status'] == 'done'
+    report = readReport(report_path)
+    assert {h: report[('p1', h)]['status'] for h in rows} == \
+        {h: row['status'] for h, row in rows.items()}
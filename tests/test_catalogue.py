@@ -0,0 +1,137 @@
+"""
+Tests of the source catalogue and catalogue stores in catalogue.py
+"""
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from catalogue import (Catalogue, CatalogueWriter, EXTRA_COLUMNS,
+                       FRAME_ID_WIDTH, nanRows, readCatalogue)
+
+def _objects(n=100, n_nan=5, seed=0):
+    rng = np.random.default_rng(seed)
+    objects = np.empty(n, dtype=[('x', 'f8'), ('y', 'f8'), 
+                                 ('flux', 'f8'), ('flag', 'i2')])
+    objects['x'] = rng.uniform(0., 2048., n)
+    objects['y'] = rng.uniform(0., 4096., n)
+    objects['flux'] = rng.uniform(1e3, 1e5, n)
+    objects['flag'] = rng.integers(0, 4, n)
+    objects['flux'][rng.choice(n, n_nan, replace=False)] = np.nan
+    return objects
+
+def test_from_sep_prunes_and_allocates_extras():
+    objects = _objects()
+    sources = Catalogue.fromSEP(objects, extras=EXTRA_COLUMNS)
+    good = ~np.isnan(objects['flux'])
+    
+    assert len(sources) == good.sum()
+    assert sources.colnames == (list(objects.dtype.names) + 
+                                [name for name, _ in EXTRA_COLUMNS])
+    assert np.array_equal(sources['x'], objects['x'][good])
+    assert np.all(np.isnan(sources['fwhm']))
+    
+    unpruned = Catalogue.fromSEP(objects, prune=False)
+    assert len(unpruned) == len(objects)
+    assert np.array_equal(nanRows(unpruned.data), ~good)
+    assert len(unpruned.pruneNans()) == good.sum()
+
+def test_columns_are_views():
+    sources = Catalogue.fromSEP(_objects(), extras=EXTRA_COLUMNS)
+    sources['flag'] |= 8
+    sources['fwhm'][:] = 3.
+    
+    assert np.all(sources.data['flag'] & 8)
+    assert np.all(sources.data['fwhm'] == 3.)
+
+def test_row_selection_and_new_columns():
+    sources = Catalogue.fromSEP(_objects())
+    bright = sources[sources['flux'] > 5e4]
+    
+    assert isinstance(bright, Catalogue)
+    assert np.all(bright['flux'] > 5e4)
+    assert isinstance(sources[:10], Catalogue) and len(sources[:10]) == 10
+    
+    sources['snr'] = np.arange(len(sources), dtype=np.float32)
+    assert 'snr' in sources
+    assert sources['snr'].dtype == np.float32
+
+def test_table_and_file_round_trip(tmp_path):
+    sources = Catalogue.fromSEP(_objects(), extras=EXTRA_COLUMNS)
+    sources.meta['frame'] = 'r1234567'
+    
+    table = sources.to_table()
+    assert table.colnames == sources.colnames
+    assert table.meta['frame'] == 'r1234567'
+    table['x'][0] = -1.
+    assert sources['x'][0] != -1.
+    
+    outpath = str(tmp_path / 'sources.fits')
+    sources.write(outpath)
+    read = Table.read(outpath)
+    
+    assert read.colnames == sources.colnames
+    for name in sources.colnames:
+        assert np.array_equal(read[name], sources[name], equal_nan=True)
+
+@pytest.mark.parametrize('ext', ['.h5', '.parquet'])
+def test_store_round_trip(tmp_path, ext):
+    store = str(tmp_path / ('night' + ext))
+    frames = [Catalogue.fromSEP(_objects(seed=i), extras=EXTRA_COLUMNS)
+              for i in range(4)]
+    with CatalogueWriter(store, buffer_rows=150) as writer:
+        for i, sources in enumerate(frames):
+            writer.append(sources, 'r{}.fits'.format(i), ccd=i % 2 + 1)
+    
+    everything = readCatalogue(store)
+    assert len(everything) == sum(len(s) for s in frames)
+    
+    sources = readCatalogue(store, frame_id='r2.fits')
+    for name in frames[2].colnames:
+        assert np.array_equal(sources[name], frames[2][name], 
+                              equal_nan=True)
+    assert np.all(sources['ccd'] == 1)
+    
+    projected = readCatalogue(store, columns=['x', 'flux'], ccd=2)
+    assert projected.colnames == ['x', 'flux']
+    assert np.array_equal(projected['x'],
+                          np.concatenate([frames[1]['x'], 
+                                          frames[3]['x']]))
+    
+    assert len(readCatalogue(store, frame_id='r9.fits')) == 0
+
+def test_hdf5_store_appends_across_sessions(tmp_path):
+    store = str(tmp_path / 'night.h5')
+    first = Catalogue.fromSEP(_objects(seed=1))
+    second = Catalogue.fromSEP(_objects(seed=2))
+    with CatalogueWriter(store) as writer:
+        writer.append(first, 'r1.fits')
+    with CatalogueWriter(store) as writer:
+        # a missing column is filled with nan
+        writer.append(second.data[['x', 'y', 'flag']], 'r2.fits')
+    
+    sources = readCatalogue(store, frame_id='r2.fits')
+    assert np.array_equal(sources['x'], second['x'])
+    assert np.all(np.isnan(sources['flux']))
+    assert len(readCatalogue(store)) == len(first) + len(second)
+
+def test_parquet_store_refuses_append(tmp_path):
+    store = str(tmp_path / 'night.parquet')
+    with CatalogueWriter(store) as writer:
+        writer.append(Catalogue.fromSEP(_objects()), 'r1.fits')
+    
+    with pytest.raises(ValueError):
+        CatalogueWriter(store)
+
+@pytest.mark.parametrize('ext', ['.h5', '.parquet'])
+def test_long_frame_id_rejected(tmp_path, ext):
+    store = str(tmp_path / ('night' + ext))
+    frame_id = 'x'*FRAME_ID_WIDTH
+    with CatalogueWriter(store) as writer:
+        writer.append(Catalogue.fromSEP(_objects()), frame_id)
+        with pytest.raises(ValueError):
+            writer.append(Catalogue.fromSEP(_objects()), frame_id + 'y')
+    
+    assert len(readCatalogue(store, frame_id=frame_id)) > 0
+    with pytest.raises(ValueError):
+        readCatalogue(store, frame_id=frame_id + 'y')
@@ -0,0 +1,30 @@
+"""
+Tests of the sky index in crossmatch.py
+"""
+
+import numpy as np
+from astropy.table import Table
+
+from crossmatch import SkyIndex
+from synthetic import detectorHeader, wcsHeader
+from wcs import convertToWCS
+
+def test_insert_catalogue_goes_through_detector_coords():
+    # second CCD of a mosaic, with the WCS in detector coords
+    shape = (1024, 2048)
+    hdr = detectorHeader(shape, x_offset=2100., y_offset=50.)
+    wcs_hdr = wcsHeader(150., 20., shape=(1100, 4200))
+    
+    rng = np.random.default_rng(2)
+    x = rng.uniform(0., shape[1] - 1., 500)
+    y = rng.uniform(0., shape[0] - 1., 500)
+    ra, dec = convertToWCS(x + 1 + 2100., y + 1 + 50., wcs_hdr)
+    
+    index = SkyIndex(tile_size=0.5)
+    index.insertCatalogue(Table({'x': x, 'y': y}), hdr, wcs_hdr, 
+                          frame_id=7)
+    ids, sep = index.match(ra, dec, 0.1 / 3600.)
+    
+    assert np.array_equal(ids, np.arange(500))
+    assert np.all(sep * 3600. < 1e-3)
+    assert np.all(index.frame == 7)
@@ -0,0 +1,144 @@
+"""
+Tests of the frame processing daemon in daemon.py
+"""
+
+import io
+import os
+import signal
+import asyncio
+import numpy as np
+import pytest
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+
+import daemon
+from catalogue import Catalogue, CatalogueWriter, readCatalogue
+from frames import ccdNumber
+from synthetic import makeMosaic
+
+@pytest.fixture
+def worker(tmp_path):
+    handler = signal.getsignal(signal.SIGINT)
+    daemon._initWorker({'out_dir': str(tmp_path)})
+    yield
+    signal.signal(signal.SIGINT, handler)
+
+def _result(filepath, hdu, ccd=1, error=None):
+    sources = np.zeros(3, dtype=[('x', 'f8'), ('y', 'f8')])
+    return {'file': filepath,
+            'hdu': hdu,
+            'ccd': ccd,
+            'sources': None if error else Catalogue(sources),
+            'difference': None,
+            'seconds': 0.,
+            'error': error}
+
+def test_ccd_number():
+    hdr = fits.Header()
+    assert ccdNumber(hdr) == 0
+    assert ccdNumber(hdr, 'CCD3') == 0
+    assert ccdNumber(hdr, 2) == 2
+    assert ccdNumber(hdr, '2') == 2
+    
+    hdr['CCDNUM'] = 4
+    assert ccdNumber(hdr, 'CCD3') == 4
+    hdr['IMAGEID'] = 3
+    assert ccdNumber(hdr, 2) == 3
+
+def test_process_frame_resolves_ccd(tmp_path, worker):
+    filepath = str(tmp_path / 'r1.fits')
+    makeMosaic(filepath, n_ccds=2, shape=(128, 256), gap=20,
+               n_stars=100, n_trails=0, n_bad_columns=0)
+    
+    for hdu in ('CCD2', 2):
+        result = daemon.processFrame(filepath, hdu)
+        assert result['error'] is None
+        assert result['ccd'] == 2
+        assert len(result['sources']) > 0
+
+def test_failed_jobs_are_retried(tmp_path, capsys):
+    in_dir = str(tmp_path / 'in')
+    out_dir = str(tmp_path / 'out')
+    os.makedirs(in_dir)
+    frame = daemon.FrameDaemon(in_dir, out_dir)
+    store = os.path.join(out_dir, 'sources.h5')
+    journal = io.StringIO()
+    with CatalogueWriter(store) as writer:
+        frame.report(_result('a.fits', 'CCD2', ccd=2), writer, journal)
+        frame.report(_result('b.fits', 'CCD2', error='ValueError: no'),
+                     writer, journal)
+    
+    assert frame.done == {('a.fits', 'CCD2')}
+    assert journal.getvalue() == 'a.fits\tCCD2\n'
+    assert 'failed - ValueError: no' in capsys.readouterr().out
+    
+    sources = readCatalogue(store)
+    assert set(sources['frame_id']) == {b'a.fits'}
+    assert np.all(sources['ccd'] == 2)
+    
+    # a restarted daemon skips only the job that succeeded
+    with open(os.path.join(out_dir, daemon.JOURNAL), 'w') as f:
+        f.write(journal.getvalue())
+    restarted = daemon.FrameDaemon(in_dir, out_dir)
+    assert restarted.done == {('a.fits', 'CCD2')}
+
+def _fakeProcess(filepath, hdu):
+    # stands in for processFrame, killing the worker process on request
+    if 'die' in filepath:
+        os._exit(1)
+    return _result(filepath, hdu)
+
+def _drain(frame, jobs, writer, journal):
+    # run one work coroutine until every job has been taken
+    async def _run():
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        task = asyncio.ensure_future(frame.work(queue, writer, journal))
+        try:
+            await asyncio.wait_for(queue.join(), 60.)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return task
+    
+    return asyncio.run(_run())
+
+def test_worker_survives_report_error(tmp_path, monkeypatch, capsys):
+    frame = daemon.FrameDaemon(str(tmp_path), str(tmp_path / 'out'))
+    monkeypatch.setattr(daemon, 'processFrame', _fakeProcess)
+    report = frame.report
+    
+    def _report(result, writer, journal):
+        if result['file'] == 'a.fits':
+            raise OSError('disk full')
+        report(result, writer, journal)
+    
+    monkeypatch.setattr(frame, 'report', _report)
+    journal = io.StringIO()
+    frame.pool = ThreadPoolExecutor(max_workers=1)
+    with CatalogueWriter(frame.catalogue) as writer:
+        task = _drain(frame, [('a.fits', 1), ('b.fits', 1)], writer,
+                      journal)
+    frame.pool.shutdown()
+    
+    assert task.cancelled()
+    assert frame.done == {('b.fits', '1')}
+    assert 'a.fits [1] could not be recorded - OSError: disk full' in \
+        capsys.readouterr().out
+
+def test_broken_pool_is_replaced(tmp_path, monkeypatch, capsys):
+    frame = daemon.FrameDaemon(str(tmp_path), str(tmp_path / 'out'),
+                               n_workers=1)
+    monkeypatch.setattr(daemon, 'processFrame', _fakeProcess)
+    journal = io.StringIO()
+    frame.pool = broken = frame._newPool()
+    with CatalogueWriter(frame.catalogue) as writer:
+        _drain(frame, [('die.fits', 1), ('ok.fits', 1)], writer, journal)
+    frame.pool.shutdown()
+    
+    assert frame.pool is not broken
+    assert frame.done == {('ok.fits', '1')}
+    out = capsys.readouterr().out
+    assert 'Worker pool broken' in out
+    assert 'die.fits [1] failed - BrokenProcessPool' in out
@@ -0,0 +1,77 @@
+"""
+Tests of the quicklook rendering in diagnostics.py
+"""
+
+import os
+import numpy as np
+from matplotlib.image import imread
+
+from synthetic import makeFrame, makeMosaic
+from diagnostics import (downsample, zscaleLimits, renderQuicklook,
+                         renderDirectory)
+
+def test_downsample_block_means():
+    data = np.arange(1003 * 701, dtype=np.float32).reshape(1003, 701)
+    binned, factor = downsample(data, max_size=256)
+    
+    assert factor == 4
+    assert binned.shape == (250, 175)
+    assert binned.dtype == np.float32
+    assert binned[3, 5] == data[12:16, 20:24].mean()
+
+def test_downsample_small_frame_unchanged():
+    data = np.zeros((100, 200))
+    binned, factor = downsample(data, max_size=200)
+    
+    assert factor == 1
+    assert binned is data
+
+def test_zscale_limits_bracket_sky():
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000., 10., (1000, 1000))
+    data[::50, ::50] = 60000.
+    vmin, vmax = zscaleLimits(data)
+    
+    assert 900. < vmin < 1000. < vmax < 1100.
+
+def test_render_quicklook_headless(tmp_path):
+    data, _, stars = makeFrame(shape=(300, 400), n_stars=50, n_trails=0)
+    outpath = str(tmp_path / 'frame.png')
+    
+    assert renderQuicklook(data, outpath, x=stars[0] - 1, y=stars[1] - 1,
+                           title='frame') == outpath
+    
+    # one figure pixel per frame pixel plus an inch for the labels
+    image = imread(outpath)
+    assert image.shape[:2] == (400, 500)
+
+def test_render_directory_reports_failures(tmp_path):
+    makeMosaic(str(tmp_path / 'mosaic.fits'), n_ccds=2, shape=(128, 160),
+               n_stars=50, n_trails=0, n_bad_columns=0)
+    with open(str(tmp_path / 'bad.fits'), 'w') as f:
+        f.write('not a FITS file')
+    output_dir = str(tmp_path / 'png')
+    
+    results = {(os.path.basename(f), hdu): (outpath, error)
+               for f, hdu, outpath, error in 
+               renderDirectory(str(tmp_path), output_dir, n_workers=1)}
+    
+    assert set(results) == {('mosaic.fits', 1), ('mosaic.fits', 2),
+                            ('bad.fits', None)}
+    for hdu in (1, 2):
+        outpath, error = results[('mosaic.fits', hdu)]
+        assert error is None
+        assert outpath == os.path.join(output_dir,
+                                       'mosaic_{}.png'.format(hdu))
+        assert os.path.exists(outpath)
+    
+    outpath, error = results[('bad.fits', None)]
+    assert outpath is None and error.startswith('OSError')
+    
+    # a failed render comes back with the exception
+    (_, hdu, outpath, error), = renderDirectory(str(tmp_path), output_dir,
+                                                pattern='mosaic.fits',
+                                                hdus=['CCD9'],
+                                                n_workers=1)
+    assert hdu == 'CCD9' and outpath is None
+    assert error.startswith('KeyError')
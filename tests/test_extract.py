@@ -0,0 +1,166 @@
+"""
+Tests of the background subtraction and source extraction in extract.py
+"""
+
+import numpy as np
+import pytest
+
+from synthetic import makeFrame, makeMosaic
+from frames import loadFrame
+import extract
+from extract import (subtractBackground, subtractBackgroundTiled,
+                     sourceExtract, batchSourceExtract, computeRadii,
+                     FLAG_KRON_FAILED, FLAG_FLUXR_FAILED)
+
+@pytest.fixture(scope='module')
+def frame():
+    data, _, _ = makeFrame(shape=(1024, 1536),
+                           n_stars=300,
+                           n_trails=0,
+                           n_bad_columns=0,
+                           seed=3)
+    return data
+
+def test_tiled_matches_single_call(frame):
+    # the documented tolerance - within ~2% of the global rms
+    single, rms = subtractBackground(frame.copy())
+    tiled, rms_tiled = subtractBackgroundTiled(frame.copy(),
+                                               tile_size=512,
+                                               n_threads=2)
+    
+    assert np.abs(single - tiled).max() < 0.02*rms
+    assert rms_tiled == pytest.approx(rms, rel=0.01)
+
+def test_tiled_in_place(frame):
+    expected, _ = subtractBackgroundTiled(frame.copy(), tile_size=512)
+    data = frame.copy()
+    data_sub, _ = subtractBackgroundTiled(data, out=data, tile_size=512)
+    
+    assert data_sub is data
+    np.testing.assert_array_equal(data_sub, expected)
+
+def test_tiled_leaves_input_alone(frame):
+    data = frame.copy()
+    subtractBackgroundTiled(data, tile_size=512)
+    
+    np.testing.assert_array_equal(data, frame)
+
+def test_tiled_rejects_bad_arguments(frame):
+    with pytest.raises(ValueError):
+        subtractBackgroundTiled(frame, out=np.empty((10, 10), np.float32))
+    with pytest.raises(ValueError):
+        subtractBackgroundTiled(frame, overlap=1)
+
+def test_batch_extract_per_hdu(tmp_path):
+    mosaic = str(tmp_path / 'mosaic.fits')
+    makeMosaic(mosaic, n_ccds=2, shape=(256, 384), gap=20, n_stars=300,
+               n_trails=0, n_bad_columns=0)
+    bad = str(tmp_path / 'bad.fits')
+    with open(bad, 'w') as f:
+        f.write('not a FITS file')
+    
+    results = {(f, hdu): (sources, error) for f, hdu, sources, error in
+               batchSourceExtract([mosaic, bad], n_workers=2)}
+    
+    assert set(results) == {(mosaic, 1), (mosaic, 2), (bad, None)}
+    for hdu in (1, 2):
+        sources, error = results[(mosaic, hdu)]
+        data, _ = loadFrame(mosaic, hdu=hdu)
+        data_sub, bkg_rms = subtractBackground(data)
+        expected = sourceExtract(data_sub, bkg_rms=bkg_rms)
+        assert error is None
+        assert len(sources) == len(expected) > 50
+        np.testing.assert_array_equal(sources['x'], expected['x'])
+    
+    sources, error = results[(bad, None)]
+    assert sources is None and error.startswith('OSError')
+
+def test_batch_extract_reports_bad_hdu(tmp_path):
+    mosaic = str(tmp_path / 'mosaic.fits')
+    makeMosaic(mosaic, n_ccds=1, shape=(128, 128), n_stars=50,
+               n_trails=0, n_bad_columns=0)
+    
+    results = list(batchSourceExtract([mosaic], hdus=['CCD1', 'CCD9'],
+                                      n_workers=1))
+    errors = {hdu: error for _, hdu, _, error in results}
+    
+    assert errors['CCD1'] is None
+    assert errors['CCD9'].startswith('KeyError')
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_batch_extract_shared_matches_files(tmp_path, tiled):
+    mosaic = str(tmp_path / 'mosaic.fits')
+    makeMosaic(mosaic, n_ccds=2, shape=(256, 384), gap=20, n_stars=300,
+               n_trails=0, n_bad_columns=0)
+    
+    expected = {hdu: sources for _, hdu, sources, _ in
+                batchSourceExtract([mosaic], n_workers=2, tiled=tiled)}
+    results = list(batchSourceExtract([mosaic], hdus=[1, 2, 'CCD9'], 
+                                      n_workers=2, tiled=tiled, 
+                                      shared=True))
+    
+    assert len(results) == 3
+    for _, hdu, sources, error in results:
+        if hdu == 'CCD9':
+            assert sources is None and error.startswith('KeyError')
+            continue
+        assert error is None
+        assert len(sources) == len(expected[hdu]) > 50
+        np.testing.assert_array_equal(sources['x'], expected[hdu]['x'])
+
+def _failOn(func, x_bad):
+    # sep routine that raises for any call including the source at x_bad
+    def _wrapped(data, x, *args, **kwargs):
+        if np.any(x == x_bad):
+            raise ValueError('bad source')
+        return func(data, x, *args, **kwargs)
+    return _wrapped
+
+def test_radii_chunk_failure_flags_only_culprits(frame, monkeypatch):
+    data, bkg_rms = subtractBackground(frame)
+    expected = sourceExtract(data, bkg_rms=bkg_rms, extras=True)
+    kron_bad, flux_bad = 10, 25
+    
+    monkeypatch.setattr(extract.sep, 'kron_radius', 
+                        _failOn(extract.sep.kron_radius, 
+                                expected['x'][kron_bad]))
+    monkeypatch.setattr(extract.sep, 'flux_radius', 
+                        _failOn(extract.sep.flux_radius, 
+                                expected['x'][flux_bad]))
+    sources = sourceExtract(data, bkg_rms=bkg_rms, extras=True, 
+                            chunk_size=16, n_threads=2)
+    
+    assert np.isnan(sources['kronr'][kron_bad])
+    assert np.isnan(sources['fluxr'][flux_bad])
+    assert sources['flag'][kron_bad] & FLAG_KRON_FAILED
+    assert sources['flag'][flux_bad] & FLAG_FLUXR_FAILED
+    
+    # every other source, including the rest of the failed chunks, 
+    # keeps its radii and flags
+    ok = np.ones(len(sources), dtype=bool)
+    ok[[kron_bad, flux_bad]] = False
+    np.testing.assert_array_equal(sources['kronr'][ok], 
+                                  expected['kronr'][ok])
+    np.testing.assert_array_equal(sources['fluxr'][ok], 
+                                  expected['fluxr'][ok])
+    np.testing.assert_array_equal(sources['flag'][ok], expected['flag'][ok])
+    assert not (expected['flag'] & (FLAG_KRON_FAILED | 
+                                    FLAG_FLUXR_FAILED)).any()
+
+def test_threaded_chunks_match_single_chunk(frame):
+    data, bkg_rms = subtractBackground(frame)
+    single = sourceExtract(data, bkg_rms=bkg_rms, extras=True,
+                           chunk_size=100000, n_threads=1)
+    chunked = sourceExtract(data, bkg_rms=bkg_rms, extras=True,
+                            chunk_size=7, n_threads=4)
+    
+    assert len(single) > 100
+    for name in ('kronr', 'fluxr', 'flag'):
+        np.testing.assert_array_equal(chunked[name], single[name])
+    
+    # recomputing in place gives the same radii again
+    chunked['kronr'][:] = np.nan
+    chunked['fluxr'][:] = np.nan
+    computeRadii(data, chunked, chunk_size=13, n_threads=3)
+    np.testing.assert_array_equal(chunked['kronr'], single['kronr'])
+    np.testing.assert_array_equal(chunked['fluxr'], single['fluxr'])
@@ -0,0 +1,166 @@
+"""
+Tests of the forced photometry in forced.py
+"""
+
+import numpy as np
+import pytest
+
+import forced
+from catalogue import CatalogueWriter, readCatalogue
+from forced import (
+    PHOT_COLUMNS,
+    forcedPhotometry,
+    photometer,
+    readLightCurves,
+    skyToFrame,
+    )
+from synthetic import (
+    detectorHeader,
+    makeFrame,
+    makeMosaic,
+    randomStars,
+    wcsHeader,
+    )
+from wcs import convertToWCS
+
+SHAPE = (100, 200)
+
+@pytest.fixture
+def headers():
+    hdr = detectorHeader(SHAPE)
+    hdr['NAXIS1'] = SHAPE[1]
+    hdr['NAXIS2'] = SHAPE[0]
+    return hdr, wcsHeader(150., 20., shape=SHAPE)
+
+def test_sources_tagged_with_ccd(tmp_path):
+    shape, gap, n_stars = (128, 256), 20, 150
+    filepath = str(tmp_path / 'r1.fits')
+    wcs_paths = makeMosaic(filepath, n_ccds=2, shape=shape, gap=gap,
+                           n_stars=n_stars, n_trails=0, n_bad_columns=0)
+    
+    width = 2*shape[1] + gap
+    x_det, y_det, _ = randomStars(n_stars, shape=(shape[0], width))
+    ra, dec = convertToWCS(x_det, y_det, 
+                           wcsHeader(150., 20., shape=(shape[0], width)))
+    
+    # CCDs selected by EXTNAME, the same file for both
+    frames = [(filepath, 'CCD{}'.format(i + 1), wcs_paths[i])
+              for i in range(2)]
+    store = str(tmp_path / 'lc.h5')
+    results = list(forcedPhotometry(frames, ra, dec, store, n_workers=1))
+    
+    assert all(error is None for _, _, _, error in results)
+    rows = readCatalogue(store)
+    assert len(rows) == sum(n for _, _, n, _ in results) > 0
+    
+    # stars on CCD 2 are those beyond the first CCD and the gap
+    on_2 = x_det[rows['id']] > shape[1] + gap + 0.5
+    assert np.array_equal(rows['ccd'], np.where(on_2, 2, 1))
+    assert set(rows['ccd']) == {1, 2}
+
+def test_sky_to_frame_edges_and_margin(headers):
+    hdr, wcs_hdr = headers
+    # zero-based pixel coords just inside and outside the frame edges
+    x0 = np.array([-0.6, -0.4, 50., 199.4, 199.6, 2.4, 2.6, 196.6])
+    y0 = np.array([50., 50., -0.6, 50., 50., 50., 50., 50.])
+    ra, dec = convertToWCS(x0 + 1, y0 + 1, wcs_hdr)
+    
+    index, x, y = skyToFrame(ra, dec, hdr, wcs_hdr)
+    assert list(index) == [1, 3, 5, 6, 7]
+    np.testing.assert_allclose(x, x0[index], atol=1e-3)
+    np.testing.assert_allclose(y, y0[index], atol=1e-3)
+    
+    index, _, _ = skyToFrame(ra, dec, hdr, wcs_hdr, margin=3.)
+    assert list(index) == [6]
+
+def test_sky_to_frame_culls_before_projecting(headers, monkeypatch):
+    hdr, wcs_hdr = headers
+    ra, dec = convertToWCS(np.array([100.]), np.array([50.]), wcs_hdr)
+    ra = np.concatenate([ra, [180., 330., 150.]])
+    dec = np.concatenate([dec, [20., -20., 60.]])
+    
+    # positions far from the frame never reach the inverse transforms
+    projected = []
+    project = forced.convertToPixels
+    def _convert(a, b, header):
+        projected.append(len(a))
+        return project(a, b, header)
+    monkeypatch.setattr(forced, 'convertToPixels', _convert)
+    
+    index, _, _ = skyToFrame(ra, dec, hdr, wcs_hdr)
+    assert list(index) == [0]
+    assert projected == [1, 1]
+
+def test_photometer_chunks_match_single_call():
+    data, mask, stars = makeFrame(SHAPE, n_stars=50, n_trails=0,
+                                  n_bad_columns=1, seed=3)
+    data = data - np.median(data)
+    x = np.asarray(stars[0]) - 1
+    y = np.asarray(stars[1]) - 1
+    rng = np.random.default_rng(1)
+    shapes = (rng.uniform(1., 3., len(x)),
+              rng.uniform(0.5, 1., len(x)),
+              rng.uniform(-1.5, 1.5, len(x)))
+    
+    for kwargs in ({}, {'shapes': shapes, 'radius': 2.}):
+        whole = photometer(data, x, y, err=5., mask=mask,
+                           chunk_size=len(x), **kwargs)
+        chunked = photometer(data, x, y, err=5., mask=mask, chunk_size=7,
+                             **kwargs)
+        for a, b in zip(whole, chunked):
+            np.testing.assert_array_equal(a, b)
+
+def test_elliptical_apertures():
+    data = np.ones(SHAPE)
+    x = np.array([50., 100.5, 150.])
+    y = np.array([50., 49.5, 50.])
+    n = len(x)
+    
+    # a = b = 1 is a circle of the given radius
+    circle, _, _ = photometer(data, x, y, radius=4.)
+    ellipse, _, _ = photometer(data, x, y, radius=4.,
+                               shapes=(np.ones(n), np.ones(n),
+                                       np.zeros(n)))
+    np.testing.assert_allclose(ellipse, circle, rtol=1e-6)
+    np.testing.assert_allclose(circle, np.pi*16., rtol=1e-2)
+    
+    # the area scales with a and b whatever the orientation (exact
+    # overlap rather than subpixel sampling)
+    shapes = (np.full(n, 3.), np.ones(n), np.array([0., 0.7, -1.2]))
+    flux, _, flag = photometer(data, x, y, radius=2., shapes=shapes,
+                               subpix=0)
+    np.testing.assert_allclose(flux, np.pi*6.*2., rtol=1e-6)
+    assert not flag.any()
+
+def _phot(ids, mjd, flux):
+    rows = np.zeros(len(ids), dtype=list(PHOT_COLUMNS))
+    rows['id'] = ids
+    rows['mjd'] = mjd
+    rows['flux'] = flux
+    rows['fluxerr'] = 0.1*np.asarray(flux)
+    rows['flag'] = 2
+    return rows
+
+def test_read_light_curves_orders_and_fills(tmp_path):
+    store = str(tmp_path / 'lc.h5')
+    # frames written out of time order, not every position in each
+    with CatalogueWriter(store) as writer:
+        writer.append(_phot([1, 2, 3], 3., [13., 23., 33.]), 'c.fits')
+        writer.append(_phot([3, 1], 1., [31., 11.]), 'a.fits')
+        writer.append(_phot([2], 2., [22.]), 'b.fits')
+    
+    curves = readLightCurves(store)
+    assert list(curves['id']) == [1, 2, 3]
+    assert list(curves['frame_id']) == [b'a.fits', b'b.fits', b'c.fits']
+    np.testing.assert_array_equal(curves['mjd'], [1., 2., 3.])
+    np.testing.assert_array_equal(curves['flux'],
+                                  [[11., np.nan, 13.],
+                                   [np.nan, 22., 23.],
+                                   [31., np.nan, 33.]])
+    np.testing.assert_array_equal(curves['flag'],
+                                  [[2, -1, 2], [-1, 2, 2], [2, -1, 2]])
+    
+    curves = readLightCurves(store, ids=[3], columns=('flux',))
+    assert list(curves['id']) == [3]
+    assert set(curves) == {'id', 'frame_id', 'mjd', 'flux'}
+    np.testing.assert_array_equal(curves['flux'], [[31., 33.]])
@@ -0,0 +1,96 @@
+"""
+Tests of the FITS frame loading in frames.py
+"""
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from frames import (selectHDU, toNativeByteOrder, loadFrame, loadHeader,
+                    loadSection)
+
+@pytest.fixture(scope='module')
+def mosaic(tmp_path_factory):
+    filepath = str(tmp_path_factory.mktemp('frames') / 'mosaic.fits')
+    rng = np.random.default_rng(0)
+    hdus = [fits.PrimaryHDU()]
+    for i in range(3):
+        hdu = fits.ImageHDU(rng.normal(1000., 10., (60, 90)).astype('>f4'))
+        hdu.header['EXTNAME'] = 'ccd{}'.format(i + 1)
+        hdu.header['IMAGEID'] = [4, 1, 2][i]
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(filepath)
+    return filepath
+
+def test_select_hdu(mosaic):
+    with fits.open(mosaic) as f:
+        assert selectHDU(f, hdu=2) == 2
+        assert selectHDU(f, hdu='2') == 2
+        assert selectHDU(f, hdu=-1) == 3
+        assert selectHDU(f, hdu='CCD3') == 3
+        assert selectHDU(f, extname='Ccd1') == 1
+        assert selectHDU(f, ccd=4) == 1
+        assert selectHDU(f, ccd='2') == 3
+        
+        # the primary HDU holds no data
+        assert selectHDU(f) == 1
+
+@pytest.mark.parametrize('selection', [{'hdu': 4}, {'hdu': -5},
+                                       {'hdu': 'CCD9'}, {'extname': 'x'},
+                                       {'ccd': 3}])
+def test_select_missing_hdu(mosaic, selection):
+    with fits.open(mosaic) as f:
+        with pytest.raises(KeyError):
+            selectHDU(f, **selection)
+
+def test_native_byte_order():
+    big = np.arange(12, dtype='>f4').reshape(3, 4)
+    
+    native = toNativeByteOrder(big)
+    assert native.dtype == np.float32 and native.dtype.isnative
+    np.testing.assert_array_equal(native, big)
+    assert not np.shares_memory(native, big)
+    assert toNativeByteOrder(native) is native
+    
+    converted = toNativeByteOrder(big, dtype=np.float64)
+    assert converted.dtype == np.float64
+    np.testing.assert_array_equal(converted, big)
+    
+    # a pure swap reuses the buffer
+    copy = big.copy()
+    swapped = toNativeByteOrder(copy, inplace=True)
+    assert np.shares_memory(swapped, copy)
+    np.testing.assert_array_equal(swapped, big)
+    
+    strided = toNativeByteOrder(np.arange(12.)[::2])
+    assert strided.flags.c_contiguous
+
+@pytest.mark.parametrize('dtype', [None, np.float32, np.float64])
+def test_load_frame(mosaic, dtype):
+    data, hdr = loadFrame(mosaic, hdu='ccd2', dtype=dtype)
+    expected = fits.getdata(mosaic, 'ccd2')
+    
+    assert data.dtype == np.dtype(dtype or np.float32)
+    assert data.dtype.isnative and data.flags.c_contiguous
+    np.testing.assert_array_equal(data, expected)
+    assert hdr['IMAGEID'] == 1
+    
+    # the file is left as it was
+    np.testing.assert_array_equal(fits.getdata(mosaic, 'ccd2'), expected)
+
+def test_load_header(mosaic):
+    assert loadHeader(mosaic, ccd=2)['EXTNAME'] == 'ccd3'
+
+@pytest.mark.parametrize('x_range, y_range', [((0, 90), (0, 60)),
+                                              ((10, 47), (5, 31)),
+                                              ((89, 90), (59, 60))])
+def test_load_section(mosaic, x_range, y_range):
+    data, _ = loadFrame(mosaic, hdu=3, dtype=np.float32)
+    section, hdr, offset = loadSection(mosaic, x_range, y_range, hdu=3,
+                                       dtype=np.float32)
+    
+    assert offset == (x_range[0], y_range[0])
+    assert section.dtype.isnative
+    np.testing.assert_array_equal(section, data[slice(*y_range),
+                                                slice(*x_range)])
+    assert hdr['NAXIS1'] == 90
@@ -0,0 +1,109 @@
+"""
+Tests of the control point sampling and pair subtraction in
+image_subtract.py
+"""
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from synthetic import (wcsHeader, detectorHeader, makeFrame, randomStars,
+                       writeFrame)
+from frames import loadHeader
+from wcs import overlapBoundingBox
+from image_subtract import sampleOverlap, subtractPair
+
+SHAPE = (1024, 2048)
+
+def _frame(ra, dec, rot=0.):
+    hdr = detectorHeader(SHAPE)
+    hdr['NAXIS1'] = SHAPE[1]
+    hdr['NAXIS2'] = SHAPE[0]
+    return hdr, wcsHeader(ra, dec, shape=SHAPE, rot=rot)
+
+def _offset(dx, dy):
+    # sky position of a frame shifted by (dx, dy) pixels of frame 1
+    scale = 0.333 / 3600.
+    return 150. - dx*scale / np.cos(np.radians(20.)), 20. + dy*scale
+
+@pytest.mark.parametrize('dx, dy, rot', [
+    (300., 100., 0.),
+    (0., 0., 45.),
+    (200., 150., 30.),
+    (1500., 700., 0.),
+    (1400., 600., 60.),
+    ])
+def test_sample_count_and_coverage(dx, dy, rot):
+    hdr_1, wcs_1 = _frame(150., 20.)
+    hdr_2, wcs_2 = _frame(*_offset(dx, dy), rot=rot)
+    
+    x_1, y_1, x_2, y_2 = sampleOverlap(hdr_1, wcs_1, wcs_2, hdr_2,
+                                       n_points=1000)
+    
+    assert 850 <= len(x_1) <= 1150
+    for x, y in ((x_1, y_1), (x_2, y_2)):
+        assert x.min() >= 0.5 and x.max() <= SHAPE[1] + 0.5
+        assert y.min() >= 0.5 and y.max() <= SHAPE[0] + 0.5
+
+def test_seeded_sample_is_reproducible():
+    hdr_1, wcs_1 = _frame(150., 20.)
+    hdr_2, wcs_2 = _frame(*_offset(300., 100.), rot=10.)
+    
+    first = sampleOverlap(hdr_1, wcs_1, wcs_2, hdr_2, seed=4)
+    second = sampleOverlap(hdr_1, wcs_1, wcs_2, hdr_2, seed=4)
+    
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+def test_disjoint_frames_give_no_points():
+    hdr_1, wcs_1 = _frame(150., 20.)
+    hdr_2, wcs_2 = _frame(151., 20.)
+    
+    assert all(len(a) == 0 for a in sampleOverlap(hdr_1, wcs_1, wcs_2,
+                                                  hdr_2))
+
+def _writePair(tmp_path, shape=(1024, 1024), offset=(200., 150.)):
+    # two CCD frames cut from one sparse star field (the PSF matching
+    # needs isolated stars), under one WCS solution
+    ny, nx = shape
+    x, y, flux = randomStars(90, shape=(ny + 200, nx + 300), seed=4)
+    wcs_path = str(tmp_path / 'field.wcs')
+    fits.PrimaryHDU(header=wcsHeader(150., 20.,
+                                     shape=(ny + 200, nx + 300))).writeto(
+                                         wcs_path)
+    paths = []
+    for i, (dx, dy) in enumerate(((0., 0.), offset)):
+        stars = (x - dx, y - dy, flux)
+        data, _, _ = makeFrame(shape=shape, stars=stars, n_trails=0,
+                               n_bad_columns=0, seed=i + 1)
+        paths.append(str(tmp_path / 'frame_{}.fits'.format(i + 1)))
+        writeFrame(paths[-1], data, header=detectorHeader(shape, dx, dy))
+    mask_path = str(tmp_path / 'bpm.fits')
+    fits.PrimaryHDU(np.zeros(shape, dtype=np.uint8)).writeto(mask_path)
+    
+    return paths, wcs_path, mask_path
+
+def test_roi_matches_full_frame(tmp_path):
+    (img_1, img_2), wcs_path, mask_path = _writePair(tmp_path)
+    hdr_1 = loadHeader(img_1)
+    hdr_2 = loadHeader(img_2)
+    wcs_hdr = fits.getheader(wcs_path)
+    bbox = overlapBoundingBox(hdr_1, wcs_hdr, wcs_hdr, hdr_2)
+    
+    # frame 2 overlaps frame 1 only in its lower left corner
+    assert bbox == (0, 825, 0, 875)
+    
+    differences = []
+    for roi in (False, True):
+        out = str(tmp_path / 'diff_{}.fits'.format(roi))
+        info = subtractPair(img_1, img_2, wcs_path, wcs_path, mask_path,
+                            out, dtype=np.float32, roi=roi, verbose=False)
+        assert info['warp_rms'] < 0.01
+        differences.append(fits.getdata(out))
+    
+    full, roi = differences
+    overlap = np.isfinite(full)
+    assert overlap.sum() > 0.2*full.size
+    np.testing.assert_array_equal(np.isfinite(roi), overlap)
+    assert np.abs(full - roi)[overlap].max() < 1e-3*np.std(full[overlap])
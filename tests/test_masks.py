@@ -0,0 +1,112 @@
+"""
+Tests of the bit-packed bad pixel masks in masks.py
+"""
+
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+from scipy import ndimage
+
+from masks import (PackedMask, MaskCache, dilateMask, loadMask,
+                   clearMaskCache)
+
+def _mask(shape=(100, 203), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.random(shape) < 0.01
+
+def test_pack_round_trip():
+    mask = _mask()
+    packed = PackedMask.fromArray(mask)
+    
+    assert packed.nbytes == 100 * 26
+    assert packed.count() == mask.sum()
+    assert np.array_equal(packed.unpack(), mask)
+    assert PackedMask.fromArray(mask.astype(np.uint8)).count() == mask.sum()
+
+@pytest.mark.parametrize('x_range, y_range', [
+    ((0, 203), (0, 100)),
+    ((8, 16), (10, 20)),
+    ((3, 13), (0, 1)),
+    ((17, 203), (50, 100)),
+    ((200, 203), (99, 100)),
+    ((5, 6), (7, 8))])
+def test_section_unpack(x_range, y_range):
+    mask = _mask()
+    section = PackedMask.fromArray(mask).unpack(x_range=x_range,
+                                                y_range=y_range)
+    
+    assert section.flags['C_CONTIGUOUS']
+    assert section.dtype == bool
+    assert np.array_equal(section, mask[slice(*y_range), slice(*x_range)])
+
+def test_save_load(tmp_path):
+    packed = PackedMask.fromArray(_mask())
+    outpath = str(tmp_path / 'mask.npz')
+    packed.save(outpath)
+    loaded = PackedMask.load(outpath)
+    
+    assert loaded.shape == packed.shape
+    assert np.array_equal(loaded.unpack(), packed.unpack())
+
+def test_dilate_matches_binary_dilation():
+    mask = _mask()
+    grow, bleed = 2, 3
+    structure = np.ones((2*(grow + bleed) + 1, 2*grow + 1), dtype=bool)
+    expected = ndimage.binary_dilation(mask, structure=structure)
+    
+    assert np.array_equal(dilateMask(mask, grow=grow, bleed=bleed), 
+                          expected)
+
+def test_dilate_edge_leaves_input():
+    mask = np.zeros((20, 30), dtype=bool)
+    dilated = dilateMask(mask, edge=2)
+    
+    assert not mask.any()
+    assert dilated[:2].all() and dilated[-2:].all()
+    assert dilated[:, :2].all() and dilated[:, -2:].all()
+    assert not dilated[2:-2, 2:-2].any()
+
+@pytest.fixture
+def mask_file(tmp_path):
+    filepath = str(tmp_path / 'bpm.fits')
+    hdus = [fits.PrimaryHDU()]
+    for i in range(2):
+        hdu = fits.ImageHDU(_mask(seed=i).astype(np.uint8))
+        hdu.header['EXTNAME'] = 'CCD{}'.format(i + 1)
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(filepath)
+    return filepath
+
+def test_cache_loads_each_ccd_once(mask_file):
+    cache = MaskCache(mask_file, grow=1, max_unpacked=1)
+    first = cache.get('CCD1')
+    
+    assert np.array_equal(first, _mask(seed=0))
+    assert cache.get('CCD1') is first
+    assert np.array_equal(cache.get('CCD1', dilated=True),
+                          dilateMask(_mask(seed=0), grow=1))
+    assert np.array_equal(cache.get('CCD2'), _mask(seed=1))
+    assert np.array_equal(cache.section((8, 40), (5, 9), 'CCD2'),
+                          _mask(seed=1)[5:9, 8:40])
+    
+    # each CCD read once, with only one unpacked mask kept
+    assert cache.counts == {'load': 2, 'unpack': 3, 'hit': 1}
+    assert len(cache._unpacked) == 1
+
+def test_cache_reloads_changed_file(mask_file):
+    cache = MaskCache(mask_file)
+    cache.get('CCD1')
+    with fits.open(mask_file, mode='update') as hdulist:
+        hdulist['CCD1'].data[:] = 1
+    os.utime(mask_file, (0, 0))
+    
+    assert cache.get('CCD1').all()
+
+def test_load_mask_shared(mask_file):
+    clearMaskCache()
+    mask = loadMask(mask_file, hdu='CCD2', edge=1)
+    
+    assert loadMask(mask_file, hdu='CCD2', edge=1) is mask
+    assert loadMask(mask_file, hdu='CCD2', dilated=True, edge=1)[0].all()
+    clearMaskCache()
@@ -0,0 +1,66 @@
+"""
+Tests of the PSF-matched differencing in psfmatch.py
+"""
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from scipy.signal import fftconvolve
+
+from synthetic import randomStars, renderStars
+from psfmatch import fitKernel, subtractImages
+
+SHAPE = (512, 512)
+SIGMA_KERNEL = 1.2
+OFFSET = 20.
+NOISE = 3.
+
+def _gaussian(sigma, half_width):
+    u, v = np.mgrid[-half_width:half_width + 1, -half_width:half_width + 1]
+    g = np.exp(-(u**2 + v**2) / (2. * sigma**2))
+    return g / g.sum()
+
+@pytest.fixture(scope='module')
+def pair():
+    # sharp template, and the image as the template blurred by a known
+    # Gaussian kernel plus a background offset, both with white noise
+    x, y, flux = randomStars(40, shape=SHAPE, flux_range=(2e4, 2e5),
+                             seed=3)
+    sky = np.full(SHAPE, 100.)
+    renderStars(sky, x, y, flux, fwhm=2.5)
+    blurred = fftconvolve(sky, _gaussian(SIGMA_KERNEL, 8), mode='same')
+    
+    rng = np.random.default_rng(4)
+    template = sky + rng.normal(0., NOISE, SHAPE)
+    image = blurred + OFFSET + rng.normal(0., NOISE, SHAPE)
+    sources = Table({'x': x - 1, 'y': y - 1, 'flux': flux,
+                     'peak': np.zeros(len(x)),
+                     'flag': np.zeros(len(x), dtype=int)})
+    
+    return image, template, sources
+
+def test_fit_recovers_known_kernel(pair):
+    image, template, sources = pair
+    kernel = fitKernel(image, template, sources, half_width=8,
+                       stamp_half=20, spatial_order=0)
+    k = kernel.kernelAt(256., 256.)
+    
+    assert k.shape == (17, 17)
+    assert abs(k.sum() - 1.) < 0.01
+    assert np.abs(k - _gaussian(SIGMA_KERNEL, 8)).max() < 0.01
+    assert abs(kernel.backgroundAt(256., 256.) - OFFSET) < 1.
+
+def test_difference_is_consistent_with_noise(pair):
+    image, template, sources = pair
+    difference, _ = subtractImages(image, template, sources,
+                                   tile_size=128, half_width=8,
+                                   stamp_half=20, spatial_order=0)
+    
+    # the convolved template noise adds sum(k^2) of its variance
+    k_var = np.sum(_gaussian(SIGMA_KERNEL, 8)**2)
+    expected = NOISE * np.sqrt(1. + k_var)
+    inner = difference[16:-16, 16:-16]
+    
+    assert np.isfinite(inner).all()
+    assert abs(np.median(inner)) < 0.1 * expected
+    assert abs(np.std(inner) / expected - 1.) < 0.1
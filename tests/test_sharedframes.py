@@ -0,0 +1,80 @@
+"""
+Tests of the shared memory frame pool in sharedframes.py
+"""
+
+import time
+import numpy as np
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+
+from extract import sourceExtract, subtractBackgroundTiled
+from frames import loadFrame
+from sharedframes import FrameHandle, FramePool
+from synthetic import makeFrame, writeFrame
+
+@pytest.fixture(scope='module')
+def frame(tmp_path_factory):
+    filepath = str(tmp_path_factory.mktemp('frames') / 'frame.fits')
+    data, _, _ = makeFrame((512, 768), n_stars=200, n_trails=0,
+                           n_bad_columns=0, seed=5)
+    writeFrame(filepath, data)
+    return filepath
+
+def test_load_matches_file(frame):
+    expected, _ = loadFrame(frame, dtype=np.float32)
+    with FramePool() as frames:
+        handle, hdr = frames.load(frame, dtype=np.float32)
+        assert np.array_equal(frames.view(handle), expected)
+        assert hdr['NAXIS1'] == 768
+
+def test_module_example(frame):
+    # the example in the module docstring, run as written
+    filepath = frame
+    with FramePool() as frames, ProcessPoolExecutor(2) as pool:
+        handle, hdr = frames.load(filepath, hdu=0, dtype=np.float32)
+        _, bkg_rms = frames.submit(pool, 
+                                   subtractBackgroundTiled, 
+                                   handle, 
+                                   out=handle).result()
+        future = frames.submit(pool, sourceExtract, handle, 
+                               bkg_rms=bkg_rms)
+        frames.release(handle)
+        sources = future.result()
+        
+        # every block is freed once the tasks finish (the callbacks
+        # may run just after the result is handed back)
+        start = time.time()
+        while len(frames) and time.time() - start < 5.:
+            time.sleep(0.01)
+        assert len(frames) == 0
+    
+    data, _ = loadFrame(filepath, dtype=np.float32)
+    data_sub, expected_rms = subtractBackgroundTiled(data)
+    expected = sourceExtract(data_sub, bkg_rms=expected_rms)
+    
+    assert bkg_rms == expected_rms
+    assert len(sources) == len(expected) > 100
+    assert np.array_equal(sources['x'], expected['x'])
+
+def test_out_buffer_returned_as_handle(frame):
+    with FramePool() as frames, ProcessPoolExecutor(1) as pool:
+        handle, _ = frames.load(frame, dtype=np.float32)
+        out, _ = frames.submit(pool, 
+                               subtractBackgroundTiled, 
+                               handle, 
+                               out=handle).result()
+        
+        assert isinstance(out, FrameHandle) and out == handle
+        assert abs(np.median(frames.view(handle))) < 5.
+        frames.release(handle)
+
+def test_released_blocks_are_freed():
+    with FramePool() as frames:
+        handle = frames.put(np.ones((16, 16)))
+        frames.acquire(handle)
+        frames.release(handle)
+        assert handle in frames
+        frames.release(handle)
+        assert handle not in frames
+        with pytest.raises(KeyError):
+            frames.release(handle)
@@ -0,0 +1,221 @@
+"""
+Tests of the concurrent solve-field runner in wcs.py, using a stub
+solve-field executable put on the PATH
+"""
+
+import os
+import sys
+import time
+import subprocess
+import pytest
+from concurrent.futures import CancelledError
+
+from wcs import SolveFieldRunner, solveFields
+
+# the stub reads its behaviour from the input file ('ok', 'fail' or
+# 'sleep <seconds>'), logs each call and writes a dummy solution
+STUB = '''#!{python}
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+filepath = args[0]
+wcs_name = args[args.index('--wcs') + 1]
+out_dir = args[args.index('--dir') + 1] if '--dir' in args \\
+          else os.path.dirname(filepath)
+
+with open(os.environ['STUB_SOLVE_LOG'], 'a') as log:
+    log.write('start {{}} {{}}\\n'.format(filepath, time.time()))
+
+with open(filepath) as f:
+    mode = f.read().split()
+
+if mode[0] == 'sleep':
+    time.sleep(float(mode[1]))
+elif mode[0] == 'fail':
+    sys.exit(1)
+
+with open(os.path.join(out_dir, wcs_name), 'w') as f:
+    f.write('solution for {{}}\\n'.format(os.path.basename(filepath)))
+
+with open(os.environ['STUB_SOLVE_LOG'], 'a') as log:
+    log.write('end {{}} {{}}\\n'.format(filepath, time.time()))
+'''
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    exe = bin_dir / 'solve-field'
+    exe.write_text(STUB.format(python=sys.executable))
+    exe.chmod(0o755)
+    
+    log = tmp_path / 'calls.log'
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir,
+                                               os.pathsep,
+                                               os.environ['PATH']))
+    monkeypatch.setenv('STUB_SOLVE_LOG', str(log))
+    
+    return log
+
+def _calls(log, event='start'):
+    if not log.exists():
+        return []
+    with open(str(log)) as f:
+        return [line.split()[1:] for line in f if line.startswith(event)]
+
+def _input(tmp_path, name, mode='ok'):
+    in_dir = tmp_path / 'in'
+    in_dir.mkdir(exist_ok=True)
+    (in_dir / name).write_text(mode)
+    return str(in_dir), name
+
+def _waitForStart(log, n=1, timeout=10.):
+    start = time.time()
+    while len(_calls(log)) < n:
+        assert time.time() - start < timeout
+        time.sleep(0.05)
+
+def test_solve_writes_solution(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits')
+    with SolveFieldRunner(n_workers=1, executable='solve-field') as runner:
+        wcs_path = runner.submit(name, 'a', input_dir=in_dir).result()
+    
+    assert wcs_path == os.path.join(in_dir, 'a.wcs')
+    assert os.path.exists(wcs_path)
+    assert len(_calls(stub)) == 1
+
+def test_failed_solve_returns_none(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits', 'fail')
+    with SolveFieldRunner(n_workers=1, executable='solve-field') as runner:
+        assert runner.submit(name, 'a', input_dir=in_dir).result() is None
+
+def test_cache_hit_skips_solve(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits')
+    cache_dir = str(tmp_path / 'cache')
+    with SolveFieldRunner(cache_dir=cache_dir,
+                          executable='solve-field') as runner:
+        first = runner.submit(name, 'a', input_dir=in_dir, ra=150.)
+        assert first.result() is not None
+        
+        # same contents and parameters, a different output prefix
+        second = runner.submit(name, 'b', input_dir=in_dir, ra=150.)
+        assert second.done()
+        wcs_path = second.result()
+    
+    assert wcs_path == os.path.join(in_dir, 'b.wcs')
+    with open(wcs_path) as f:
+        assert f.read() == 'solution for a.fits\n'
+    assert len(_calls(stub)) == 1
+
+def test_cache_miss_on_new_contents_or_parameters(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits')
+    cache_dir = str(tmp_path / 'cache')
+    with SolveFieldRunner(cache_dir=cache_dir,
+                          executable='solve-field') as runner:
+        runner.submit(name, 'a', input_dir=in_dir, ra=150.).result()
+        runner.submit(name, 'a', input_dir=in_dir, ra=151.).result()
+        assert len(_calls(stub)) == 2
+        
+        _input(tmp_path, name, 'ok ')
+        runner.submit(name, 'a', input_dir=in_dir, ra=150.).result()
+        assert len(_calls(stub)) == 3
+
+def test_failed_solve_not_cached(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits', 'fail')
+    cache_dir = str(tmp_path / 'cache')
+    with SolveFieldRunner(cache_dir=cache_dir,
+                          executable='solve-field') as runner:
+        runner.submit(name, 'a', input_dir=in_dir).result()
+        runner.submit(name, 'a', input_dir=in_dir).result()
+    
+    assert len(_calls(stub)) == 2
+    assert os.listdir(cache_dir) == []
+
+def test_timeout_kills_solve(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits', 'sleep 30')
+    start = time.time()
+    with SolveFieldRunner(timeout=0.5, executable='solve-field') as runner:
+        future = runner.submit(name, 'a', input_dir=in_dir)
+        with pytest.raises(subprocess.TimeoutExpired):
+            future.result()
+    
+    assert time.time() - start < 10.
+    assert _calls(stub, 'end') == []
+
+def test_cancel_running_solve(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits', 'sleep 30')
+    start = time.time()
+    with SolveFieldRunner(executable='solve-field') as runner:
+        future = runner.submit(name, 'a', input_dir=in_dir)
+        _waitForStart(stub)
+        runner.cancel(future)
+        with pytest.raises(CancelledError):
+            future.result()
+    
+    assert time.time() - start < 10.
+    assert _calls(stub, 'end') == []
+
+def test_cancel_queued_solve(tmp_path, stub):
+    in_dir, name = _input(tmp_path, 'a.fits', 'sleep 1')
+    _input(tmp_path, 'b.fits')
+    with SolveFieldRunner(n_workers=1, executable='solve-field') as runner:
+        running = runner.submit(name, 'a', input_dir=in_dir)
+        queued = runner.submit('b.fits', 'b', input_dir=in_dir)
+        runner.cancel(queued)
+        
+        assert queued.cancelled()
+        assert running.result() is not None
+    
+    assert len(_calls(stub)) == 1
+
+def test_close_with_cancel_stops_everything(tmp_path, stub):
+    in_dir, _ = _input(tmp_path, 'a.fits', 'sleep 30')
+    _input(tmp_path, 'b.fits', 'sleep 30')
+    start = time.time()
+    runner = SolveFieldRunner(n_workers=1, executable='solve-field')
+    futures = [runner.submit(name, name[0], input_dir=in_dir)
+               for name in ('a.fits', 'b.fits')]
+    _waitForStart(stub)
+    runner.close(cancel=True)
+    
+    assert time.time() - start < 10.
+    assert all(f.done() for f in futures)
+    assert futures[1].cancelled()
+
+def test_solves_run_concurrently(tmp_path, stub):
+    names = ['{}.fits'.format(c) for c in 'abcd']
+    for name in names:
+        in_dir, _ = _input(tmp_path, name, 'sleep 1')
+    
+    start = time.time()
+    results = solveFields([os.path.join(in_dir, n) for n in names],
+                          n_workers=4,
+                          executable='solve-field')
+    elapsed = time.time() - start
+    
+    assert sorted(results) == sorted(os.path.join(in_dir, n)
+                                     for n in names)
+    for f, wcs_path in results.items():
+        assert wcs_path == os.path.splitext(f)[0] + '.wcs'
+        assert os.path.exists(wcs_path)
+    
+    # every solve starts before any finishes
+    starts = [float(t) for _, t in _calls(stub)]
+    ends = [float(t) for _, t in _calls(stub, 'end')]
+    assert max(starts) < min(ends)
+    assert elapsed < 3.
+
+def test_solve_fields_reports_errors(tmp_path, stub):
+    in_dir, _ = _input(tmp_path, 'a.fits', 'sleep 30')
+    _input(tmp_path, 'b.fits')
+    results = solveFields([os.path.join(in_dir, n)
+                           for n in ('a.fits', 'b.fits')],
+                          timeout=0.5,
+                          executable='solve-field')
+    
+    assert isinstance(results[os.path.join(in_dir, 'a.fits')],
+                      subprocess.TimeoutExpired)
+    assert results[os.path.join(in_dir, 'b.fits')] == \
+        os.path.join(in_dir, 'b.wcs')
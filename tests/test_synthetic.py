@@ -0,0 +1,65 @@
+"""
+Tests of the synthetic mosaic generator in synthetic.py
+"""
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+from forced import catalogPositions, skyToFrame
+from synthetic import makeMosaic, randomStars, wcsHeader
+from wcs import convertToWCS
+
+SHAPE = (256, 512)
+GAP = 50
+
+@pytest.fixture(scope='module')
+def mosaic(tmp_path_factory):
+    filepath = str(tmp_path_factory.mktemp('mosaic') / 'mosaic.fits')
+    wcs_paths = makeMosaic(filepath, n_ccds=2, shape=SHAPE, gap=GAP,
+                           n_stars=400, n_trails=0, n_bad_columns=0)
+    with fits.open(filepath) as hdulist:
+        hdrs = [hdulist[i + 1].header.copy() for i in range(2)]
+    wcs_hdrs = [fits.getheader(path) for path in wcs_paths]
+    
+    return hdrs, wcs_hdrs
+
+def test_wcs_in_detector_coords(mosaic):
+    _, wcs_hdrs = mosaic
+    width = 2*SHAPE[1] + GAP
+    for wcs_hdr in wcs_hdrs:
+        assert wcs_hdr['IMAGEW'] == width
+        assert wcs_hdr['CRPIX1'] == (width + 1) / 2.
+        ra, dec = convertToWCS((width + 1) / 2., (SHAPE[0] + 1) / 2., 
+                               wcs_hdr)
+        assert np.allclose([ra, dec], [150., 20.])
+
+def test_star_round_trip(mosaic):
+    hdrs, wcs_hdrs = mosaic
+    ny, nx = SHAPE
+    width = 2*nx + GAP
+    x_det, y_det, _ = randomStars(400, shape=(ny, width), seed=0)
+    truth = wcsHeader(150., 20., shape=(ny, width))
+    
+    for i, (hdr, wcs_hdr) in enumerate(zip(hdrs, wcs_hdrs)):
+        x_off = i*(nx + GAP)
+        on = np.nonzero((x_det > x_off + 0.5) & 
+                        (x_det < x_off + nx + 0.5))[0]
+        sources = Table({'x': x_det[on] - x_off - 1, 
+                         'y': y_det[on] - 1})
+        
+        # sky positions agree with the mosaic as a whole
+        ra, dec = catalogPositions(sources, hdr, wcs_hdr)
+        ra_true, dec_true = convertToWCS(x_det[on], y_det[on], truth)
+        assert np.allclose(ra, ra_true, rtol=0., atol=1e-8)
+        assert np.allclose(dec, dec_true, rtol=0., atol=1e-8)
+        
+        # and project back onto the same CCD only
+        index, x, y = skyToFrame(ra, dec, hdr, wcs_hdr)
+        assert np.array_equal(index, np.arange(len(on)))
+        assert np.allclose(x, sources['x'], atol=1e-4)
+        assert np.allclose(y, sources['y'], atol=1e-4)
+        
+        other = hdrs[1 - i]
+        assert len(skyToFrame(ra, dec, other, wcs_hdrs[1 - i])[0]) == 0
@@ -0,0 +1,48 @@
+"""
+Tests of the matched-filter trail detection in trails.py
+"""
+
+import numpy as np
+import pytest
+
+from synthetic import makeFrame, renderTrail
+from extract import subtractBackground
+from trails import detectTrails
+
+LENGTH = 600.
+ANGLE = 30.
+
+@pytest.fixture(scope='module')
+def frames():
+    # a star field, and the same field with one trail added
+    clean, _, _ = makeFrame(shape=(1024, 1024), n_stars=300, n_trails=0,
+                            n_bad_columns=0, seed=7)
+    trailed = clean.copy()
+    renderTrail(trailed, 200., 300., ANGLE, LENGTH, 5e5)
+    
+    return clean, trailed
+
+def test_detects_injected_trail(frames):
+    data, bkg_rms = subtractBackground(frames[1])
+    trails = detectTrails(data, bkg_rms, LENGTH)
+    
+    assert len(trails) == 1
+    trail = trails[0]
+    
+    # zero-based coords of the injected trail
+    x_0, y_0 = 199., 299.
+    x_1 = x_0 + LENGTH*np.cos(np.radians(ANGLE))
+    y_1 = y_0 + LENGTH*np.sin(np.radians(ANGLE))
+    
+    assert abs(trail['angle'] % 180. - ANGLE) < 2.
+    assert abs(trail['x'] - (x_0 + x_1) / 2.) < 5.
+    assert abs(trail['y'] - (y_0 + y_1) / 2.) < 5.
+    assert abs(trail['length'] - LENGTH) < 0.05 * LENGTH
+    assert np.hypot(trail['x_start'] - x_0, trail['y_start'] - y_0) < 10.
+    assert np.hypot(trail['x_end'] - x_1, trail['y_end'] - y_1) < 10.
+    assert abs(trail['flux'] / 5e5 - 1.) < 0.1
+
+def test_no_detections_on_star_field(frames):
+    data, bkg_rms = subtractBackground(frames[0])
+    
+    assert len(detectTrails(data, bkg_rms, LENGTH)) == 0
@@ -0,0 +1,180 @@
+"""
+Tests of the WCS helpers in wcs.py
+"""
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from synthetic import wcsHeader, detectorHeader
+import wcs
+from wcs import (ApproxWCS, getWCS, clearWCSCache, pixelToPixel,
+                 convertToDetector, convertToWCS, convertToPixels,
+                 refineWCS, updateWCS)
+
+def _distorted(factor, ra=150., dec=20.):
+    hdr = wcsHeader(ra, dec)
+    for key in ('A_2_0', 'A_0_2', 'A_1_1', 'B_2_0', 'B_0_2', 'B_1_1'):
+        hdr[key] *= factor
+    return hdr
+
+def _trueErrors(approx, hdr, n=200000):
+    # errors of both transforms on random points over the frame, in 
+    # pixels
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0.5, hdr['NAXIS1'] + 0.5, n)
+    y = rng.uniform(0.5, hdr['NAXIS2'] + 0.5, n)
+    w = getWCS(hdr)
+    ra, dec = w.all_pix2world(x, y, 1)
+    
+    x_w, y_w = w.all_world2pix(*approx.pixToWorld(x, y) + (1,), 
+                               tolerance=1e-10)
+    x_a, y_a = approx.worldToPix(ra, dec)
+    
+    return np.hypot(x_w - x, y_w - y).max(), np.hypot(x_a - x, 
+                                                      y_a - y).max()
+
+@pytest.mark.parametrize('factor', [1, 20])
+@pytest.mark.parametrize('ra, dec', [(150., 20.), (0.05, -60.)])
+def test_reported_errors_bound_random_points(factor, ra, dec):
+    hdr = _distorted(factor, ra, dec)
+    approx = ApproxWCS(hdr)
+    pix2world, world2pix = _trueErrors(approx, hdr)
+    
+    assert pix2world <= approx.max_error_pix2world
+    assert world2pix <= approx.max_error_world2pix
+
+def test_wraps_at_zero_ra():
+    hdr = _distorted(1, 0.05, 20.)
+    approx = ApproxWCS(hdr)
+    ra, dec = approx.pixToWorld([0.5, hdr['NAXIS1'] + 0.5], 
+                                [1., 1.])
+    
+    assert np.all((ra >= 0.) & (ra < 360.))
+    assert ra.max() > 359. and ra.min() < 1.
+
+def test_tolerance_is_met():
+    hdr = _distorted(20)
+    approx = ApproxWCS(hdr, step=256, tol=1e-3)
+    pix2world, world2pix = _trueErrors(approx, hdr)
+    
+    assert approx.step < 256
+    assert max(pix2world, world2pix) <= 1e-3
+
+def test_unreachable_tolerance_raises():
+    with pytest.raises(ValueError):
+        ApproxWCS(_distorted(20), step=1024, tol=1e-12, max_refine=0)
+
+def test_pole_raises():
+    with pytest.raises(ValueError):
+        ApproxWCS(wcsHeader(10., 89.9))
+
+def test_wcs_cache():
+    clearWCSCache()
+    hdr = wcsHeader(150., 20.)
+    w = getWCS(hdr)
+    
+    assert getWCS(hdr) is w
+    assert getWCS(hdr.copy()) is w
+    assert getWCS(w) is w
+    
+    edited = hdr.copy()
+    edited['CRVAL1'] = 150.001
+    w_edited = getWCS(edited)
+    assert w_edited is not w
+    assert w_edited.wcs.crval[0] == 150.001
+    assert getWCS(hdr) is w
+
+def test_pixel_to_pixel_matches_chain():
+    shape = (1024, 2048)
+    hdr_1 = detectorHeader(shape, x_offset=0.)
+    hdr_2 = detectorHeader(shape, x_offset=2100., y_offset=-40.)
+    wcs_1 = wcsHeader(150., 20., shape=(1100, 4200))
+    wcs_2 = wcsHeader(150.05, 20.02, shape=(1100, 4200), rot=0.5)
+    
+    rng = np.random.default_rng(3)
+    x = rng.uniform(0.5, shape[1] + 0.5, 5000)
+    y = rng.uniform(0.5, shape[0] + 0.5, 5000)
+    x_2, y_2 = pixelToPixel(x, y, hdr_1, wcs_1, wcs_2, hdr_2)
+    
+    # the chain of separate transforms, with freshly parsed WCS
+    x_d, y_d = WCS(hdr_1).all_pix2world(x, y, 1)
+    ra, dec = WCS(wcs_1).all_pix2world(x_d, y_d, 1)
+    x_d, y_d = WCS(wcs_2).all_world2pix(ra, dec, 1)
+    x_ref, y_ref = WCS(hdr_2).all_world2pix(x_d, y_d, 1)
+    
+    assert np.abs(x_2 - x_ref).max() < 1e-8
+    assert np.abs(y_2 - y_ref).max() < 1e-8
+    
+    x_d, y_d = convertToDetector(x, y, hdr_1)
+    ra, dec = convertToWCS(x_d, y_d, wcs_1)
+    x_d, y_d = convertToPixels(ra, dec, wcs_2)
+    x_c, y_c = convertToPixels(x_d, y_d, hdr_2)
+    
+    assert np.abs(x_2 - x_c).max() < 1e-8
+    assert np.abs(y_2 - y_c).max() < 1e-8
+
+def _perturbed(shape=(2048, 2048), n=200):
+    # stars placed by a distorted solution, and that solution shifted by
+    # a few pixels and slightly rotated as the previous frame's
+    true = wcsHeader(150., 20., shape=shape)
+    rng = np.random.default_rng(5)
+    x = rng.uniform(1, shape[1], n)
+    y = rng.uniform(1, shape[0], n)
+    ra, dec = getWCS(true).all_pix2world(x, y, 1)
+    
+    old = true.copy()
+    old['CRVAL1'] += 5. * 0.333 / 3600.
+    old['CRVAL2'] -= 3. * 0.333 / 3600.
+    old['CD1_2'] += 2e-8
+    
+    return true, old, x, y, ra, dec
+
+def _rms(hdr, x, y, ra, dec):
+    x_w, y_w = getWCS(hdr).all_world2pix(ra, dec, 1)
+    return np.sqrt(np.mean((x_w - x)**2 + (y_w - y)**2))
+
+def test_refine_lowers_rms_and_keeps_sip():
+    _, old, x, y, ra, dec = _perturbed()
+    hdr, rms, n_matched = refineWCS(old, x, y, ra, dec)
+    
+    assert n_matched == len(x)
+    assert hdr['A_ORDER'] == 2
+    assert rms < 0.01
+    assert _rms(old, x, y, ra, dec) > 5.
+    assert _rms(hdr, x, y, ra, dec) == pytest.approx(rms, rel=1e-3)
+    
+    # a linear fit cannot follow the distortion
+    linear, linear_rms, _ = refineWCS(old, x, y, ra, dec, sip_degree=0)
+    assert 'A_ORDER' not in linear
+    assert linear['CTYPE1'] == 'RA---TAN'
+    assert linear_rms > 10 * rms
+
+def test_update_falls_back_to_blind_solve(tmp_path, monkeypatch, capsys):
+    true, old, x, y, ra, dec = _perturbed()
+    wcs_path = str(tmp_path / 'blind.wcs')
+    fits.PrimaryHDU(header=true).writeto(wcs_path)
+    calls = []
+    
+    def _solveField(filename, file_prefix, **kwargs):
+        calls.append((filename, file_prefix))
+        return wcs_path
+    
+    monkeypatch.setattr(wcs, 'solveField', _solveField)
+    
+    hdr, refined = updateWCS(old, x, y, ra, dec, 'frame.fits', 'frame')
+    assert refined and calls == []
+    
+    # an rms limit the refinement cannot meet forces the blind solve
+    hdr, refined = updateWCS(old, x, y, ra, dec, 'frame.fits', 'frame',
+                             refine_kwargs={'max_rms': 1e-6})
+    assert not refined
+    assert calls == [('frame.fits', 'frame')]
+    assert hdr['CRVAL1'] == true['CRVAL1']
+    assert capsys.readouterr().out == ''
+    
+    updateWCS(old, x, y, ra, dec, 'frame.fits', 'frame',
+              refine_kwargs={'max_rms': 1e-6}, verbose=True)
+    assert 'exceeds' in capsys.readouterr().out
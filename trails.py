@@ -0,0 +1,491 @@
+"""
+Functions for detecting streaked sources (satellite/debris trails)
+-Oriented matched-filter kernels for a range of trail angles
+-FFT convolution on tiles, in parallel across orientations
+-Measurement of trail endpoints, flux and SNR at full resolution
+"""
+
+import os
+import numpy as np
+from scipy import fft, ndimage
+from concurrent.futures import ThreadPoolExecutor
+from catalogue import Catalogue
+from extract import sourceExtract
+from instrument import timed, size
+
+# columns of the trail catalogue (zero-based pixel coords, as for sep)
+TRAIL_COLUMNS = (('x_start', np.float64),
+                 ('y_start', np.float64),
+                 ('x_end', np.float64),
+                 ('y_end', np.float64),
+                 ('x', np.float64),
+                 ('y', np.float64),
+                 ('angle', np.float64),
+                 ('length', np.float64),
+                 ('flux', np.float64),
+                 ('snr', np.float64),
+                 ('npix', np.int64))
+
+def trailKernel(length, angle, fwhm=3.):
+    """
+    Matched-filter kernel for a straight trail of unit total flux
+    
+    Parameters
+    ----------
+    length : float
+        Length of the trail in pixels
+    angle : float
+        Direction of the trail in degrees anticlockwise from +x
+    fwhm : float, optional
+        Full width half maximum across the trail in pixels
+        Default = 3.
+    
+    Returns
+    -------
+    kernel : array-like
+        Odd-sized square kernel centred on the trail midpoint
+    """
+    sigma = fwhm / (2.*np.sqrt(2.*np.log(2.)))
+    half = int(np.ceil(length / 2. + 3.*sigma))
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1].astype(np.float64)
+    
+    dx, dy = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    along = np.clip(xx*dx + yy*dy, -length / 2., length / 2.)
+    dist2 = (xx - along*dx)**2 + (yy - along*dy)**2
+    kernel = np.exp(-dist2 / (2.*sigma**2))
+    
+    return kernel / kernel.sum()
+
+def trailAngles(length, fwhm=3., angle_range=(0., 180.)):
+    """
+    Orientations at which to search so that the end of a trail is never
+    more than about half a width from the nearest kernel
+    
+    Parameters
+    ----------
+    length : float
+        Length of the kernels in pixels
+    fwhm : float, optional
+        Width of the trails in pixels
+        Default = 3.
+    angle_range : tuple, optional
+        Range of directions searched in degrees - trails are symmetric,
+        so (0, 180) covers all orientations
+        Default = (0., 180.)
+    
+    Returns
+    -------
+    angles : array-like
+        Directions of the kernels in degrees
+    """
+    step = np.degrees(np.arctan2(max(fwhm, 1.), length))
+    lo, hi = angle_range
+    n = max(int(np.ceil((hi - lo) / step)), 1)
+    
+    return lo + (np.arange(n) + 0.5) * (hi - lo) / n
+
+def _blockSum(data, factor):
+    """
+    Sum a frame over factor x factor blocks, cropping any remainder
+    """
+    if factor == 1:
+        return np.asarray(data, dtype=np.float32)
+    
+    ny, nx = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    
+    return blocks.sum(axis=(1, 3), dtype=np.float32)
+
+def matchedFilter(data, kernels, tile_size=1024, n_threads=None):
+    """
+    Convolve a frame with a bank of kernels and keep, for each pixel,
+    the largest response and the kernel that gave it
+    
+    Each tile is Fourier transformed once and multiplied by every
+    kernel's transform, with the inverse transforms shared out across
+    orientations on a thread pool
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted frame, with bad pixels set to 0
+    kernels : list
+        Kernels of odd size, each normalised by its L2 norm so the
+        responses are comparable
+    tile_size : int, optional
+        Side of the tiles transformed at once
+        Default = 1024
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    response : array-like
+        Largest response at each pixel
+    index : array-like
+        Index of the kernel giving the largest response
+    """
+    ny, nx = data.shape
+    half = max(k.shape[0] for k in kernels) // 2
+    shape = (fft.next_fast_len(min(tile_size, ny) + 2*half, real=True),
+             fft.next_fast_len(min(tile_size, nx) + 2*half, real=True))
+    step_y, step_x = shape[0] - 2*half, shape[1] - 2*half
+    
+    # kernel transforms, centred so the output lines up with the input
+    transforms = []
+    for k in kernels:
+        padded = np.zeros(shape, dtype=np.float32)
+        h = k.shape[0] // 2
+        padded[:k.shape[0], :k.shape[1]] = k[::-1, ::-1]
+        padded = np.roll(padded, (-h, -h), axis=(0, 1))
+        transforms.append(fft.rfft2(padded))
+    
+    response = np.full(data.shape, -np.inf, dtype=np.float32)
+    index = np.zeros(data.shape, dtype=np.int16)
+    
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    groups = np.array_split(np.arange(len(kernels)), min(n_threads,
+                                                          len(kernels)))
+    
+    def _bestOf(group, tile_fft, ys, xs):
+        best = np.full((ys, xs), -np.inf, dtype=np.float32)
+        best_idx = np.zeros((ys, xs), dtype=np.int16)
+        for i in group:
+            r = fft.irfft2(tile_fft * transforms[i], s=shape)
+            r = r[half:half + ys, half:half + xs]
+            better = r > best
+            best[better] = r[better]
+            best_idx[better] = i
+        
+        return best, best_idx
+    
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for y0 in range(0, ny, step_y):
+            for x0 in range(0, nx, step_x):
+                ys, xs = min(step_y, ny - y0), min(step_x, nx - x0)
+                
+                # zero padding beyond the frame edges
+                tile = np.zeros(shape, dtype=np.float32)
+                r0, r1 = max(y0 - half, 0), min(y0 + ys + half, ny)
+                c0, c1 = max(x0 - half, 0), min(x0 + xs + half, nx)
+                tile[r0 - (y0 - half):r1 - (y0 - half),
+                     c0 - (x0 - half):c1 - (x0 - half)] = data[r0:r1, c0:c1]
+                tile_fft = fft.rfft2(tile)
+                
+                futures = [pool.submit(_bestOf, group, tile_fft, ys, xs)
+                           for group in groups]
+                out_r = response[y0:y0 + ys, x0:x0 + xs]
+                out_i = index[y0:y0 + ys, x0:x0 + xs]
+                for future in futures:
+                    best, best_idx = future.result()
+                    better = best > out_r
+                    out_r[better] = best[better]
+                    out_i[better] = best_idx[better]
+    
+    return response, index
+
+def compactSourceMask(data, bkg_rms, mask=None, thresh=3., 
+                      max_elongation=3., grow=6):
+    """
+    Mask the pixels of compact sources (stars, galaxies) so they do not
+    swamp the trail search, leaving elongated detections in place
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted frame
+    bkg_rms : float
+        Noise per pixel of the frame
+    mask : array-like, optional
+        Bad pixel mask passed to the extraction
+        Default = None
+    thresh : float, optional
+        Extraction threshold in units of bkg_rms
+        Default = 3.
+    max_elongation : float, optional
+        Largest a/b ratio of a source treated as compact
+        Default = 3.
+    grow : int, optional
+        Number of pixels by which the masked footprints are grown, to
+        cover the wings of the sources
+        Default = 6
+    
+    Returns
+    -------
+    source_mask : array-like
+        Boolean mask, True for pixels of compact sources
+    """
+    sources, seg_map = sourceExtract(data, 
+                                     thresh=thresh, 
+                                     bkg_rms=bkg_rms, 
+                                     mask=mask, 
+                                     segment=True)
+    
+    # segmentation ids are 1 + the row of the source in sep's output,
+    # which pruning may have shortened, so flag the elongated ones
+    elongated = np.zeros(seg_map.max() + 1, dtype=bool)
+    long_ones = sources['a'] > max_elongation * sources['b']
+    if long_ones.any():
+        # match pruned rows back to segments by their pixel positions
+        ids = seg_map[np.round(sources['y'][long_ones]).astype(np.intp),
+                      np.round(sources['x'][long_ones]).astype(np.intp)]
+        elongated[ids] = True
+    elongated[0] = True
+    
+    source_mask = ~elongated[seg_map]
+    if grow > 0:
+        source_mask = ndimage.binary_dilation(source_mask, iterations=grow)
+    
+    return source_mask
+
+def measureTrail(data, bkg_rms, x_start, y_start, x_end, y_end, fwhm=3.,
+                 mask=None, n_segments=4):
+    """
+    Measure the flux along a trail in a rectangular aperture
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted frame
+    bkg_rms : float
+        Noise per pixel of the frame
+    x_start, y_start, x_end, y_end : float
+        Zero-based pixel coords of the trail endpoints
+    fwhm : float, optional
+        Width of the trail - the aperture extends 1.5 fwhm either side
+        Default = 3.
+    mask : array-like, optional
+        Bad pixel mask, excluded from the aperture
+        Default = None
+    n_segments : int, optional
+        Number of equal segments in which the flux is also summed
+        Default = 4
+    
+    Returns
+    -------
+    flux : float
+        Total flux in the aperture
+    snr : float
+        Signal to noise ratio of the flux
+    npix : int
+        Number of pixels in the aperture
+    segments : array-like
+        Flux in each segment along the trail
+    """
+    ny, nx = data.shape
+    width = 1.5*fwhm
+    c0 = int(max(np.floor(min(x_start, x_end) - width), 0))
+    c1 = int(min(np.ceil(max(x_start, x_end) + width) + 1, nx))
+    r0 = int(max(np.floor(min(y_start, y_end) - width), 0))
+    r1 = int(min(np.ceil(max(y_start, y_end) + width) + 1, ny))
+    if c0 >= c1 or r0 >= r1:
+        return 0., 0., 0, np.zeros(n_segments)
+    
+    length = max(np.hypot(x_end - x_start, y_end - y_start), 1e-6)
+    dx, dy = (x_end - x_start) / length, (y_end - y_start) / length
+    yy, xx = np.mgrid[r0:r1, c0:c1]
+    along = (xx - x_start)*dx + (yy - y_start)*dy
+    across = np.abs(-(xx - x_start)*dy + (yy - y_start)*dx)
+    
+    inside = (along >= 0) & (along <= length) & (across <= width)
+    if mask is not None:
+        inside &= ~mask[r0:r1, c0:c1]
+    values = data[r0:r1, c0:c1][inside]
+    
+    npix = int(inside.sum())
+    flux = float(values.sum())
+    snr = flux / (bkg_rms * np.sqrt(max(npix, 1)))
+    which = np.minimum((along[inside] / length * n_segments).astype(int),
+                       n_segments - 1)
+    segments = np.bincount(which, weights=values, minlength=n_segments)
+    
+    return flux, snr, npix, segments
+
+def _longestRun(on, max_gap=2):
+    """
+    First and last index of the run of True values containing the most
+    of them, bridging gaps of up to max_gap False values
+    """
+    idx = np.nonzero(on)[0]
+    if len(idx) == 0:
+        return 0, len(on) - 1
+    
+    breaks = np.nonzero(np.diff(idx) > max_gap + 1)[0]
+    starts = np.concatenate([[0], breaks + 1])
+    stops = np.concatenate([breaks, [len(idx) - 1]])
+    best = np.argmax(stops - starts)
+    
+    return idx[starts[best]], idx[stops[best]]
+
+@timed('detect_trails', counts=lambda data, *a, **k: {'pixels': size(data)})
+def detectTrails(data, bkg_rms, length, angle_range=(0., 180.), fwhm=3.,
+                 thresh=5., mask=None, mask_sources=True, binning=4, 
+                 max_kernel=31, min_length=None, max_fraction=0.5, 
+                 tile_size=1024, n_threads=None):
+    """
+    Detect trails in a background subtracted frame with a bank of
+    oriented matched filters
+    
+    The search runs on a block-summed copy of the frame with kernels no
+    longer than max_kernel (binned) pixels, which keeps the number of
+    orientations small; longer trails show up as ridges of high
+    response along their length. Candidates are then measured on the
+    full resolution frame, and rejected if most of their flux lies in
+    one part of the trail (e.g. a bright star).
+    
+    Parameters
+    ----------
+    data : array-like
+        Background subtracted CCD frame
+    bkg_rms : float
+        Noise per pixel of the frame
+    length : float
+        Expected trail length in pixels, e.g. from utils.getTrailLength
+    angle_range : tuple, optional
+        Range of trail directions searched, in degrees
+        Default = (0., 180.), all orientations
+    fwhm : float, optional
+        Width of the trails (the seeing) in pixels
+        Default = 3.
+    thresh : float, optional
+        Detection threshold on the matched-filter signal to noise
+        Default = 5.
+    mask : array-like, optional
+        Bad pixel mask - masked pixels are ignored
+        Default = None
+    mask_sources : bool, optional
+        Toggle to ignore the pixels of compact sources in the search, 
+        with compactSourceMask
+        Default = True
+    binning : int, optional
+        Block size over which the frame is summed for the search
+        Default = 4
+    max_kernel : int, optional
+        Maximum kernel length in binned pixels
+        Default = 31
+    min_length : float, optional
+        Shortest trail kept, in pixels
+        Default = None, half the expected length
+    max_fraction : float, optional
+        Largest fraction of a trail's flux allowed in any quarter of
+        its length
+        Default = 0.5
+    tile_size : int, optional
+        Side of the tiles transformed at once, in binned pixels
+        Default = 1024
+    n_threads : int, optional
+        Number of worker threads
+        Default = None, one per CPU
+    
+    Returns
+    -------
+    trails : Catalogue object
+        Endpoints, midpoint, angle, length, flux, snr and aperture size
+        of each trail (zero-based pixel coords), brightest first
+    """
+    if min_length is None:
+        min_length = 0.5*length
+    
+    frame = np.ascontiguousarray(data, dtype=np.float32)
+    ignore = mask
+    if mask_sources:
+        ignore = compactSourceMask(frame,
+                                   bkg_rms,
+                                   mask=mask,
+                                   grow=int(2*fwhm))
+        if mask is not None:
+            ignore |= mask
+    search = frame if ignore is None else np.where(ignore, 
+                                                   np.float32(0.), 
+                                                   frame)
+    binned = _blockSum(search, binning)
+    
+    # kernels on the binned grid, normalised for equal noise response
+    fwhm_b = max(fwhm / binning, 1.)
+    kernel_length = min(length / binning, max_kernel)
+    angles = trailAngles(kernel_length, fwhm_b, angle_range)
+    kernels = []
+    for a in angles:
+        k = trailKernel(kernel_length, a, fwhm_b)
+        kernels.append((k / np.sqrt((k**2).sum())).astype(np.float32))
+    
+    response, index = matchedFilter(binned,
+                                    kernels,
+                                    tile_size=tile_size,
+                                    n_threads=n_threads)
+    snr_map = response / (bkg_rms * binning)
+    
+    labels, n_labels = ndimage.label(snr_map > thresh,
+                                     structure=np.ones((3, 3)))
+    rows = []
+    if n_labels:
+        objects = ndimage.find_objects(labels)
+        for i, sl in enumerate(objects):
+            yy, xx = np.nonzero(labels[sl] == i + 1)
+            yy, xx = yy + sl[0].start, xx + sl[1].start
+            snr = snr_map[yy, xx]
+            
+            # direction from the kernel at the peak of the ridge
+            peak = np.argmax(snr)
+            angle = angles[index[yy[peak], xx[peak]]]
+            dx, dy = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+            
+            # full resolution coords of the ridge, extended by half a
+            # kernel at each end
+            x = (xx + 0.5)*binning - 0.5
+            y = (yy + 0.5)*binning - 0.5
+            w = snr / snr.sum()
+            xc, yc = (w*x).sum(), (w*y).sum()
+            along = (x - xc)*dx + (y - yc)*dy
+            lo = along.min() - kernel_length*binning / 2.
+            hi = along.max() + kernel_length*binning / 2.
+            if hi - lo < min_length:
+                continue
+            
+            ends = np.array([[xc + lo*dx, yc + lo*dy],
+                             [xc + hi*dx, yc + hi*dy]])
+            ends[:, 0] = np.clip(ends[:, 0], 0, data.shape[1] - 1)
+            ends[:, 1] = np.clip(ends[:, 1], 0, data.shape[0] - 1)
+            (x0, y0), (x1, y1) = ends
+            
+            # the ridge runs past the ends of the trail, so trim to the
+            # longest stretch where the flux profile along it stays above 
+            # half its typical level
+            n_fine = max(int(np.hypot(x1 - x0, y1 - y0) / (2.*fwhm)), 4)
+            profile = measureTrail(frame, 
+                                   bkg_rms, 
+                                   x0, y0, x1, y1, 
+                                   fwhm=fwhm, 
+                                   mask=mask,
+                                   n_segments=n_fine)[3]
+            level = np.median(profile)
+            if level <= 0:
+                continue
+            first, last = _longestRun(profile > 0.5*level, max_gap=2)
+            t0, t1 = first / float(n_fine), (last + 1) / float(n_fine)
+            x0, y0, x1, y1 = (x0 + t0*(x1 - x0), y0 + t0*(y1 - y0),
+                              x0 + t1*(x1 - x0), y0 + t1*(y1 - y0))
+            if np.hypot(x1 - x0, y1 - y0) < min_length:
+                continue
+            
+            flux, snr, npix, segments = measureTrail(frame,
+                                                     bkg_rms,
+                                                     x0, y0, x1, y1,
+                                                     fwhm=fwhm,
+                                                     mask=mask)
+            if snr < thresh or flux <= 0:
+                continue
+            if segments.max() > max_fraction * flux:
+                continue
+            
+            rows.append((x0, y0, x1, y1,
+                         (x0 + x1) / 2., (y0 + y1) / 2.,
+                         angle,
+                         np.hypot(x1 - x0, y1 - y0),
+                         flux, snr, npix))
+    
+    trails = np.array(rows, dtype=list(TRAIL_COLUMNS))
+    
+    return Catalogue(trails[np.argsort(-trails['snr'])])
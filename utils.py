@@ -18,10 +18,14 @@ def pruneNansFromTable(table):
     table : astropy Table object
         Table pruned of nans
     """
-    nan_in_row = np.zeros(len(table), dtype=np.bool)
+    nan_in_row = np.zeros(len(table), dtype=bool)
     for col in table.colnames:
-        nan_in_row |= np.isnan(table[col])
-        
+        if table[col].dtype.kind in 'fc':
+            nan_in_row |= np.isnan(table[col])
+    
+    if not nan_in_row.any():
+        return table
+    
     return table[~nan_in_row]
 
 def getTrailLength(exptime, platescale, rate=15.034):
@@ -4,26 +4,105 @@ CCD frames using the Astrometry.net package
 """
 
 import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+from scipy.spatial import cKDTree
 from astropy.wcs import WCS
+from astropy.wcs.utils import fit_wcs_from_points
+from astropy.coordinates import SkyCoord
 from astropy.io import fits
+from instrument import timed, size
 
 try:
     FileNotFoundError
 except NameError:
     FileNotFoundError = IOError
 
+# number of parsed WCS objects to keep, least recently used first out
+WCS_CACHE_SIZE = 128
+_wcs_cache = OrderedDict()
+_wcs_cache_lock = threading.Lock()
+
+# location of the astrometry.net solve-field executable
+SOLVE_FIELD = '/usr/bin/solve-field'
+
+def solveFieldArgs(filepath, file_prefix, bintable=True, output_dir=None, 
+                   ra=None, dec=None, radius=2., 
+                   scale_low=0.3, scale_high=0.4, nx=8176, ny=6132,
+                   executable=SOLVE_FIELD):
+    """
+    Build the argument list for a solve-field call
+    
+    Parameters are as for solveField, with filepath the full path to
+    the input file
+    
+    Returns
+    -------
+    args : list
+        Executable and arguments, for use with subprocess
+    """
+    args = [
+        executable,                     # call solve-field function
+        filepath,                       # file containing field to solve
+        '--no-verify',                  # ignore existing wcs info
+        '--no-fits2fits',               # don't sanitize fits files
+        '--no-plots',                   # don't create plots of result
+        '--crpix-center',               # set wcs reference to center
+        '--new-fits', 'none',           # no new fits file
+        '--wcs', file_prefix+'.wcs',    # name of wcs output file
+        '--solved', 'none',             # no solved file
+        '--match', 'none',              # no match file
+        '--rdls', 'none',               # no rdls file
+        '--corr', file_prefix+'.corr',  # name of corr output file
+        '--axy', 'none',                # no axy file
+        '--index-xyls', 'none',         # no index-xyls file
+        '--overwrite',                  # overwrite existing outputs
+        '--scale-low', str(scale_low),  # lower bound of scale estimate
+        '--scale-high', str(scale_high),# upper bound of scale estimate
+        '--scale-units', 'arcsecperpix',# units of scale estimates
+        ]
+    
+    if output_dir is not None:
+        args += ['--dir', output_dir]   # name of output directory
+    
+    if bintable:
+        args += [
+            '--x-column', 'x_det',      # name of column containing x
+            '--y-column', 'y_det',      # name of column containing y
+            '--sort-column', 'flux',    # column to sort by
+            '--width', str(nx),         # width of field (pixels)
+            '--height', str(ny),        # height of field (pixels)
+            ]
+    
+    if ra is not None and dec is not None:
+        args += [
+            '--ra', str(ra),            # right ascension of center
+            '--dec', str(dec),          # declination of center
+            '--radius', str(radius),    # radius within which to look
+            ]
+    
+    return args
+
+@timed('solve_field', counts=lambda filename, *a, **k: {'file': filename})
 def solveField(filename, file_prefix, bintable=True,
                input_dir='', output_dir=None, 
                ra=None, dec=None, radius=2.,
-               scale_low=0.3, scale_high=0.4, nx=8176, ny=6132):
+               scale_low=0.3, scale_high=0.4, nx=8176, ny=6132,
+               timeout=None, executable=SOLVE_FIELD, cancel_event=None):
     """
     Solve field using Astrometry.net for images or source tables
     
     Parameters
     ----------
-    filepath : str
-        Path to FITS file containing either image data or a table with
+    filename : str
+        Name of FITS file containing either image data or a table with
         pixel centroids (x,y) and flux for detected sources
     file_prefix : str
         Name of output World Coordinates System file containing the
@@ -31,7 +110,10 @@ def solveField(filename, file_prefix, bintable=True,
     bintable : bool, optional
         Toggle to change between FITS image and FITS bintable format
         Default = True (bintable)
-    out_dir : str, optional
+    input_dir : str, optional
+        Path to directory containing the input file
+        Default = '', current directory
+    output_dir : str, optional
         Path to directory in which to place output files
         Default = None, will use input directory
     ra : float, optional
@@ -56,72 +138,561 @@ def solveField(filename, file_prefix, bintable=True,
     ny : int, optional
         Height of image in pixels
         Default = 6132 [INT frame]
+    timeout : float, optional
+        Time in seconds after which solve-field is killed
+        Default = None, no limit
+    executable : str, optional
+        Path to the solve-field executable
+        Default = SOLVE_FIELD
+    cancel_event : threading.Event, optional
+        Event which, when set, kills the running solve-field
+        Default = None
     
     Returns
     -------
-    None
+    wcs_path : str or None
+        Path to the WCS solution, or None if no solution was found
+    
+    Raises
+    ------
+    subprocess.TimeoutExpired
+        If solve-field runs for longer than timeout
+    concurrent.futures.CancelledError
+        If the solve is cancelled through cancel_event
     """
+    filepath = os.path.join(input_dir, filename)
+    args = solveFieldArgs(filepath, 
+                          file_prefix, 
+                          bintable=bintable, 
+                          output_dir=output_dir, 
+                          ra=ra, 
+                          dec=dec, 
+                          radius=radius,
+                          scale_low=scale_low, 
+                          scale_high=scale_high, 
+                          nx=nx, 
+                          ny=ny,
+                          executable=executable)
     
-    astrom_loc='/usr/bin/'              # location of astrometry.Net
-    cmd = (
-        '{}solve-field '                # call solve-field function 
-        '{} '                           # file containing field to solve
-        '--no-verify '                  # ignore existing wcs info
-        '--no-fits2fits '               # don't sanitize fits files
-        '--no-plots '                   # don't create plots of result
-        '--crpix-center '               # set wcs reference to center
-        '--new-fits none '              # no new fits file
-        '--wcs {} '                     # name of wcs output file
-        '--solved none '                # no solved file
-        '--match none '                 # no match file
-        '--rdls none '                  # no rdls file
-        '--corr {} '                    # name of corr output file
-        '--axy none '                   # no axy file
-        '--index-xyls none '            # no index-xyls file
-        '--overwrite '                  # overwrite existing outputs
-        '--scale-low {} '               # lower bound of scale estimate
-        '--scale-high {} '              # upper bound of scale estimate
-        '--scale-units arcsecperpix '   # units of scale estimates
-        ).format(astrom_loc,
-                 filepath,
-                 file_prefix+'.wcs',
-                 file_prefix+'.corr',
-                 scale_low,
-                 scale_high)
-    
-    if out_dir is not None:
-        cmd = (
-            '{} '                       # previous command
-            '--dir {} '                 # name of output directory
-            ).format(cmd, 
-                     out_dir)
+    # poll so the process can be killed on timeout or cancellation
+    start = time.time()
+    proc = subprocess.Popen(args, 
+                            stdout=subprocess.DEVNULL, 
+                            stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                proc.wait(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if cancel_event is not None and cancel_event.is_set():
+                raise CancelledError()
+            if timeout is not None and time.time() - start > timeout:
+                raise subprocess.TimeoutExpired(args, timeout)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
     
-    if bintable:
-        cmd = (
-            '{} '                       # previous command
-            '--x-column x_det '         # name of column containing x
-            '--y-column y_det '         # name of column containing y
-            '--sort-column flux '       # column to sort by
-            '--width {} --height {} '   # width/height of field (pixels)
-            ).format(cmd, 
-                     nx, 
-                     ny)
-    
-    if ra and dec is not None:
-        cmd = (
-            '{} '                       # previous command
-            '--ra {} '                  # right ascension of center
-            '--dec {} '                 # declination of center
-            '--radius {}'               # radius within which to look
-            ).format(cmd, 
-                     str(ra), 
-                     str(dec), 
-                     str(radius))
-    print(cmd)
-    os.system(cmd)
+    out_dir = input_dir if output_dir is None else output_dir
+    wcs_path = os.path.join(out_dir, file_prefix+'.wcs')
+    if proc.returncode != 0 or not os.path.exists(wcs_path):
+        return None
+    
+    return wcs_path
+
+class SolveFieldRunner(object):
+    """
+    Run solve-field on many files concurrently, with per-job timeouts,
+    cancellation and a content-addressed cache of solutions
+    
+    The cache key combines a hash of the input file contents with the
+    solve parameters, so re-running a night only solves new frames
+    """
+    
+    def __init__(self, n_workers=4, timeout=300., cache_dir=None,
+                 executable=SOLVE_FIELD):
+        """
+        Parameters
+        ----------
+        n_workers : int, optional
+            Maximum number of solve-field processes run at once
+            Default = 4
+        timeout : float, optional
+            Time in seconds after which a solve is abandoned
+            Default = 300.
+        cache_dir : str, optional
+            Directory in which solutions are cached
+            Default = None, no caching
+        executable : str, optional
+            Path to the solve-field executable
+            Default = SOLVE_FIELD
+        """
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.executable = executable
+        self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._events = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close(cancel=exc[0] is not None)
+        return False
+    
+    def cacheKey(self, filepath, **solve_kwargs):
+        """
+        Content-addressed cache key for a solve
+        
+        Parameters
+        ----------
+        filepath : str
+            Path to the input file
+        **solve_kwargs
+            Parameters affecting the solution (ra, dec, scale_low...)
+        
+        Returns
+        -------
+        key : str
+            Hex digest identifying the input and parameters
+        """
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(json.dumps(solve_kwargs, sort_keys=True, 
+                                 default=str).encode())
+        
+        return digest.hexdigest()
+    
+    def submit(self, filename, file_prefix, input_dir='', output_dir=None,
+               **solve_kwargs):
+        """
+        Queue a file to be solved
+        
+        Parameters
+        ----------
+        filename, file_prefix, input_dir, output_dir
+            As for solveField
+        **solve_kwargs
+            Further keyword arguments for solveField (bintable, ra, dec,
+            radius, scale_low, scale_high, nx, ny)
+        
+        Returns
+        -------
+        future : concurrent.futures.Future object
+            Resolves to the path of the WCS solution, or None
+        """
+        out_dir = input_dir if output_dir is None else output_dir
+        wcs_path = os.path.join(out_dir, file_prefix+'.wcs')
+        
+        # serve from the cache without occupying a worker
+        key = None
+        if self.cache_dir is not None:
+            key = self.cacheKey(os.path.join(input_dir, filename), 
+                                **solve_kwargs)
+            cached = os.path.join(self.cache_dir, key+'.wcs')
+            if os.path.exists(cached):
+                if os.path.abspath(cached) != os.path.abspath(wcs_path):
+                    shutil.copyfile(cached, wcs_path)
+                future = Future()
+                future.set_result(wcs_path)
+                return future
+        
+        event = threading.Event()
+        future = self._pool.submit(self._solve, 
+                                   key, 
+                                   event, 
+                                   filename, 
+                                   file_prefix, 
+                                   input_dir, 
+                                   output_dir, 
+                                   solve_kwargs)
+        self._events[future] = event
+        future.add_done_callback(lambda f: self._events.pop(f, None))
+        
+        return future
+    
+    def _solve(self, key, event, filename, file_prefix, input_dir, 
+               output_dir, solve_kwargs):
+        """
+        Worker task - run solve-field and cache any solution
+        """
+        wcs_path = solveField(filename, 
+                              file_prefix, 
+                              input_dir=input_dir,
+                              output_dir=output_dir,
+                              timeout=self.timeout,
+                              executable=self.executable,
+                              cancel_event=event,
+                              **solve_kwargs)
+        
+        if wcs_path is not None and key is not None:
+            # copy then rename, so a partial file is never cached
+            cached = os.path.join(self.cache_dir, key+'.wcs')
+            shutil.copyfile(wcs_path, cached+'.tmp')
+            os.replace(cached+'.tmp', cached)
+        
+        return wcs_path
+    
+    def cancel(self, future):
+        """
+        Cancel a queued or running solve
+        
+        Parameters
+        ----------
+        future : concurrent.futures.Future object
+            Future returned by submit
+        
+        Returns
+        -------
+        None
+        """
+        if not future.cancel():
+            event = self._events.get(future)
+            if event is not None:
+                event.set()
+        
+        return None
+    
+    def close(self, cancel=False):
+        """
+        Shut down the runner, waiting for running solves to finish
+        
+        Parameters
+        ----------
+        cancel : bool, optional
+            Toggle to cancel queued and running solves instead
+            Default = False
+        
+        Returns
+        -------
+        None
+        """
+        if cancel:
+            for future in list(self._events):
+                self.cancel(future)
+        self._pool.shutdown(wait=True)
+        
+        return None
+
+def solveFields(filenames, file_prefixes=None, n_workers=4, timeout=300., 
+                cache_dir=None, executable=SOLVE_FIELD, **solve_kwargs):
+    """
+    Solve many fields concurrently with a SolveFieldRunner
+    
+    Parameters
+    ----------
+    filenames : list
+        Paths to the files to solve
+    file_prefixes : list, optional
+        Output prefixes for each file
+        Default = None, the file names without extension
+    n_workers : int, optional
+        Maximum number of solve-field processes run at once
+        Default = 4
+    timeout : float, optional
+        Time in seconds after which a solve is abandoned
+        Default = 300.
+    cache_dir : str, optional
+        Directory in which solutions are cached
+        Default = None, no caching
+    executable : str, optional
+        Path to the solve-field executable
+        Default = SOLVE_FIELD
+    **solve_kwargs
+        Further keyword arguments for solveField
+    
+    Returns
+    -------
+    results : dict
+        Path to the WCS solution (or None) for each file, or the
+        exception raised while solving it
+    """
+    if file_prefixes is None:
+        file_prefixes = [os.path.splitext(os.path.basename(f))[0] 
+                         for f in filenames]
+    
+    results = {}
+    with SolveFieldRunner(n_workers=n_workers, 
+                          timeout=timeout, 
+                          cache_dir=cache_dir, 
+                          executable=executable) as runner:
+        futures = {runner.submit(os.path.basename(f), 
+                                 prefix, 
+                                 input_dir=os.path.dirname(f), 
+                                 **solve_kwargs): f
+                   for f, prefix in zip(filenames, file_prefixes)}
+        for future, f in futures.items():
+            try:
+                results[f] = future.result()
+            except Exception as e:
+                results[f] = e
+    
+    return results
+
+@timed('refine_wcs', 
+       counts=lambda wcs_hdr, x, *a, **k: {'sources': size(x)})
+def refineWCS(wcs_hdr, x, y, ref_ra, ref_dec, flux=None, ref_flux=None,
+              n_max=300, max_shift=50., match_radius=2., min_matches=12,
+              sip_degree=None, max_rms=1.):
+    """
+    Refine an existing WCS solution for a new frame at the same or a 
+    nearby pointing, without a blind solve
+    
+    Reference stars are projected into the new frame with the old 
+    solution, the bulk offset is found by voting on the pairwise 
+    differences with detected sources, stars are matched one-to-one by
+    nearest neighbour and the solution (CRVAL, CD and optionally SIP 
+    distortion) is refitted by least squares
+    
+    Parameters
+    ----------
+    wcs_hdr : astropy Header object or astropy WCS object
+        Previous WCS solution, e.g. for the preceding exposure
+    x, y : array-like
+        Pixel coords of sources detected in the new frame (FITS 1-based
+        convention)
+    ref_ra, ref_dec : array-like
+        World coords of reference stars, e.g. the previous frame's
+        sources passed through convertToWCS
+    flux, ref_flux : array-like, optional
+        Fluxes used to keep only the brightest n_max sources of each
+        list
+        Default = None, keep the first n_max
+    n_max : int, optional
+        Maximum number of sources from each list used for matching
+        Default = 300
+    max_shift : float, optional
+        Largest offset in pixels searched between the old solution and
+        the new frame
+        Default = 50.
+    match_radius : float, optional
+        Matching radius in pixels once the offset is removed
+        Default = 2.
+    min_matches : int, optional
+        Minimum number of matched stars for the fit
+        Default = 12
+    sip_degree : int, optional
+        Degree of SIP distortion polynomial to fit - 0 for a linear 
+        solution
+        Default = None, the degree of the previous solution's SIP 
+        distortion (A_ORDER), or linear if it has none
+    max_rms : float, optional
+        Largest acceptable rms residual of the fit in pixels
+        Default = 1.
+    
+    Returns
+    -------
+    hdr : astropy Header object
+        Header containing the refined WCS solution
+    rms : float
+        Rms residual of the matched stars in pixels
+    n_matched : int
+        Number of stars used in the fit
+    
+    Raises
+    ------
+    ValueError
+        If too few stars are matched or the fit is poor
+    """
+    w = getWCS(wcs_hdr)
+    if sip_degree is None:
+        sip_degree = w.sip.a_order if w.sip is not None else 0
+    x, y = _brightest(x, y, flux, n_max)
+    ref_ra, ref_dec = _brightest(ref_ra, ref_dec, ref_flux, n_max)
+    
+    # where the reference stars fall according to the old solution
+    ref_x, ref_y = w.all_world2pix(ref_ra, ref_dec, 1)
+    ok = np.isfinite(ref_x) & np.isfinite(ref_y)
+    ref_ra, ref_dec = ref_ra[ok], ref_dec[ok]
+    ref_x, ref_y = ref_x[ok], ref_y[ok]
+    if len(x) < min_matches or len(ref_x) < min_matches:
+        raise ValueError('Too few sources to refine the solution')
+    
+    # vote on the offsets of all pairs within max_shift
+    tree = cKDTree(np.column_stack([x, y]))
+    pairs = tree.query_ball_point(np.column_stack([ref_x, ref_y]), 
+                                  max_shift)
+    j = np.repeat(np.arange(len(ref_x)), [len(p) for p in pairs])
+    i = np.concatenate([np.asarray(p, dtype=np.intp) for p in pairs])
+    if len(i) < min_matches:
+        raise ValueError('No sources within {} pixels of the reference '
+                         'stars'.format(max_shift))
+    dx, dy = x[i] - ref_x[j], y[i] - ref_y[j]
+    
+    edges = np.arange(-max_shift, max_shift + match_radius, match_radius)
+    votes, _, _ = np.histogram2d(dx, dy, bins=(edges, edges))
+    bx, by = np.unravel_index(np.argmax(votes), votes.shape)
+    peak = ((np.abs(dx - (edges[bx] + match_radius/2.)) <= match_radius) & 
+            (np.abs(dy - (edges[by] + match_radius/2.)) <= match_radius))
+    shift_x, shift_y = np.median(dx[peak]), np.median(dy[peak])
+    
+    # one-to-one nearest neighbour matches after removing the offset
+    dist, nearest = tree.query(np.column_stack([ref_x + shift_x, 
+                                                ref_y + shift_y]), 
+                               distance_upper_bound=match_radius)
+    found = np.isfinite(dist)
+    order = np.argsort(dist[found])
+    ref_idx = np.nonzero(found)[0][order]
+    src_idx, first = np.unique(nearest[ref_idx], return_index=True)
+    ref_idx = ref_idx[first]
+    if len(src_idx) < min_matches:
+        raise ValueError('Only {} stars matched, need {}'.format(
+            len(src_idx), min_matches))
+    
+    # a linear fit drops any SIP distortion of the old solution
+    projection = w.deepcopy()
+    if not sip_degree:
+        projection.sip = None
+        projection.wcs.ctype = [c.replace('-SIP', '') 
+                                for c in projection.wcs.ctype]
+    
+    # astropy fits in zero-based pixel coords
+    world = SkyCoord(ref_ra[ref_idx], ref_dec[ref_idx], unit='deg')
+    fitted = fit_wcs_from_points((x[src_idx] - 1, y[src_idx] - 1), 
+                                 world, 
+                                 projection=projection, 
+                                 sip_degree=sip_degree or None)
+    
+    fit_x, fit_y = fitted.all_world2pix(ref_ra[ref_idx], ref_dec[ref_idx], 
+                                        1)
+    rms = float(np.sqrt(np.mean((fit_x - x[src_idx])**2 + 
+                                (fit_y - y[src_idx])**2)))
+    if not rms <= max_rms:
+        raise ValueError('Refined solution rms {:.2f} pixels exceeds '
+                         '{:.2f}'.format(rms, max_rms))
+    
+    hdr = fitted.to_header(relax=True)
+    if w.pixel_shape is not None:
+        hdr['IMAGEW'], hdr['IMAGEH'] = w.pixel_shape
+    
+    return hdr, rms, len(src_idx)
+
+def _brightest(a, b, flux, n_max):
+    """
+    Keep the n_max brightest entries of a pair of coordinate arrays
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if flux is None:
+        return a[:n_max], b[:n_max]
+    
+    keep = np.argsort(-np.asarray(flux, dtype=np.float64))[:n_max]
+    
+    return a[keep], b[keep]
+
+def updateWCS(wcs_hdr, x, y, ref_ra, ref_dec, filename, file_prefix, 
+              flux=None, ref_flux=None, refine_kwargs=None, verbose=False,
+              **solve_kwargs):
+    """
+    Refine the previous WCS solution for a new frame, falling back to
+    a blind solve with solveField if the refinement fails
+    
+    Parameters
+    ----------
+    wcs_hdr : astropy Header object or None
+        Previous WCS solution - None forces a blind solve
+    x, y, ref_ra, ref_dec, flux, ref_flux
+        As for refineWCS
+    filename, file_prefix
+        Input file and output prefix for solveField
+    refine_kwargs : dict, optional
+        Further keyword arguments for refineWCS
+        Default = None
+    verbose : bool, optional
+        Report why the refinement failed before solving blind
+        Default = False
+    **solve_kwargs
+        Further keyword arguments for solveField
+    
+    Returns
+    -------
+    hdr : astropy Header object or None
+        Header containing the new WCS solution, or None if both the 
+        refinement and the blind solve failed
+    refined : bool
+        True if the solution came from refineWCS
+    """
+    if wcs_hdr is not None:
+        try:
+            hdr, _, _ = refineWCS(wcs_hdr, 
+                                  x, 
+                                  y, 
+                                  ref_ra, 
+                                  ref_dec, 
+                                  flux=flux, 
+                                  ref_flux=ref_flux,
+                                  **(refine_kwargs or {}))
+            return hdr, True
+        except ValueError as e:
+            if verbose:
+                print('Refinement failed ({}), solving blind...'.format(e))
+    
+    wcs_path = solveField(filename, file_prefix, **solve_kwargs)
+    if wcs_path is None:
+        return None, False
+    
+    return fits.getheader(wcs_path), False
+
+def getWCS(hdr):
+    """
+    Fetch a parsed WCS object for a header from the least recently 
+    used cache, parsing and caching it on a miss
+    
+    Parameters
+    ----------
+    hdr : astropy Header object, str or astropy WCS object
+        FITS header containing the transformation - WCS objects are
+        passed straight through
+    
+    Returns
+    -------
+    w : astropy WCS object
+        Parsed WCS for the header
+    """
+    if isinstance(hdr, WCS):
+        return hdr
+    
+    # key on the header contents, not the object identity
+    text = hdr.tostring() if isinstance(hdr, fits.Header) else str(hdr)
+    key = hashlib.sha1(text.encode('ascii', 'replace')).hexdigest()
+    
+    with _wcs_cache_lock:
+        if key in _wcs_cache:
+            _wcs_cache.move_to_end(key)
+            return _wcs_cache[key]
+    
+    w = WCS(hdr)
+    with _wcs_cache_lock:
+        _wcs_cache[key] = w
+        while len(_wcs_cache) > WCS_CACHE_SIZE:
+            _wcs_cache.popitem(last=False)
+    
+    return w
+
+def clearWCSCache():
+    """
+    Empty the cache of parsed WCS objects
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    None
+    """
+    with _wcs_cache_lock:
+        _wcs_cache.clear()
     
     return None
 
+@timed(counts=lambda x, *a: {'points': size(x)})
 def convertToDetector(x, y, hdu_hdr):
     """
     Convert a list of xy pixel coordinates to detector coordinates for
@@ -139,15 +710,16 @@ def convertToDetector(x, y, hdu_hdr):
     x_det, y_det : array-like
         Detector coords corresponding to input xy coords
     """
-    w = WCS(hdu_hdr)
-    xy_coords = np.column_stack([x, y])
+    w = getWCS(hdu_hdr)
     
     # FITS convention, so use Fortran-like 1-based origin
-    detector = w.all_pix2world(xy_coords, 1)
-    x_det, y_det = detector[:, 0], detector[:, 1]
+    x_det, y_det = w.all_pix2world(np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64), 
+                                   1)
     
     return x_det, y_det
 
+@timed(counts=lambda x, *a: {'points': size(x)})
 def convertToWCS(x, y, wcs_hdr):
     """
     Convert a list of xy pixel coordinates to (ra,dec) coordinates
@@ -164,15 +736,16 @@ def convertToWCS(x, y, wcs_hdr):
     ra, dec : array-like
         WCS coords corresponding to input xy coords
     """
-    w = WCS(wcs_hdr)
-    xy_coords = np.column_stack([x, y])
+    w = getWCS(wcs_hdr)
     
     # FITS convention, so use Fortran-like 1-based origin
-    world = w.all_pix2world(xy_coords, 1)
-    ra, dec = world[:, 0], world[:, 1]
+    ra, dec = w.all_pix2world(np.asarray(x, dtype=np.float64),
+                              np.asarray(y, dtype=np.float64), 
+                              1)
     
     return ra, dec
 
+@timed(counts=lambda ra, *a: {'points': size(ra)})
 def convertToPixels(ra, dec, wcs_hdr):
     """
     Convert a list of (ra,dec) coordinates to xy pixel coordinates
@@ -189,11 +762,617 @@ def convertToPixels(ra, dec, wcs_hdr):
     x, y : array-like
         Pixel coords corresponding to input world coords
     """
-    w = WCS(wcs_hdr)
-    world_coords = np.column_stack([ra, dec])
+    w = getWCS(wcs_hdr)
     
     # FITS convention, so use Fortran-like 1-based origin
-    pixel = w.all_world2pix(world_coords, 1)
-    x, y = pixel[:, 0], pixel[:, 1]
+    x, y = w.all_world2pix(np.asarray(ra, dtype=np.float64),
+                           np.asarray(dec, dtype=np.float64), 
+                           1)
     
     return x, y 
+
+def pixelToPixel(x, y, hdr_1, wcs_1, wcs_2, hdr_2):
+    """
+    Convert xy pixel coordinates in one CCD frame of a mosaic to xy 
+    pixel coordinates in another, via detector and world coordinates
+    
+    Parameters
+    ----------
+    x, y : array-like
+        Lists of xy positions in CCD frame 1
+    hdr_1, hdr_2 : astropy Header object
+        FITS headers for the HDUs, containing transformation 
+        coefficients to detector coordinates
+    wcs_1, wcs_2 : astropy Header object
+        FITS headers containing the WCS solutions
+    
+    Returns
+    -------
+    x_2, y_2 : array-like
+        Pixel coords in CCD frame 2 corresponding to input xy coords
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    
+    # FITS convention, so use Fortran-like 1-based origin throughout
+    x, y = getWCS(hdr_1).all_pix2world(x, y, 1)
+    x, y = getWCS(wcs_1).all_pix2world(x, y, 1)
+    x, y = getWCS(wcs_2).all_world2pix(x, y, 1)
+    x_2, y_2 = getWCS(hdr_2).all_world2pix(x, y, 1)
+    
+    return x_2, y_2
+
+def overlapBoundingBox(hdr_1, wcs_1, wcs_2, hdr_2, n_edge=64, margin=0):
+    """
+    Determine the section of CCD frame 2 that overlaps CCD frame 1,
+    using only the HDU and WCS headers of the two frames
+    
+    The perimeter of frame 1 is sampled and transformed into the pixel
+    coordinates of frame 2, the bounding box of which (clipped to the
+    extent of frame 2) contains every pixel of frame 2 that frame 1 
+    overlaps
+    
+    Parameters
+    ----------
+    hdr_1, hdr_2 : astropy Header object
+        FITS headers for the HDUs, containing transformation 
+        coefficients to detector coordinates
+    wcs_1, wcs_2 : astropy Header object
+        FITS headers containing the WCS solutions
+    n_edge : int, optional
+        Number of points sampled along each edge of frame 1
+        Default = 64
+    margin : int, optional
+        Number of pixels by which to grow the bounding box on each side
+        Default = 0
+    
+    Returns
+    -------
+    bbox : tuple or None
+        (x_min, x_max, y_min, y_max) zero-based array bounds of the
+        overlapping section of frame 2, with the maxima exclusive - 
+        None if the frames do not overlap
+    """
+    nx_1, ny_1 = hdr_1['NAXIS1'], hdr_1['NAXIS2']
+    nx_2, ny_2 = hdr_2['NAXIS1'], hdr_2['NAXIS2']
+    
+    # perimeter of frame 1 in FITS (1-based) pixel coordinates
+    tx = np.linspace(0.5, nx_1 + 0.5, n_edge)
+    ty = np.linspace(0.5, ny_1 + 0.5, n_edge)
+    x_1 = np.concatenate([tx, tx, np.full(n_edge, 0.5), 
+                          np.full(n_edge, nx_1 + 0.5)])
+    y_1 = np.concatenate([np.full(n_edge, 0.5), np.full(n_edge, ny_1 + 0.5),
+                          ty, ty])
+    
+    x_2, y_2 = pixelToPixel(x_1, y_1, hdr_1, wcs_1, wcs_2, hdr_2)
+    
+    good = np.isfinite(x_2) & np.isfinite(y_2)
+    if not good.any():
+        return None
+    
+    # convert to zero-based array indices covering the footprint
+    x_min = int(np.floor(x_2[good].min() - 1)) - margin
+    x_max = int(np.ceil(x_2[good].max())) + margin
+    y_min = int(np.floor(y_2[good].min() - 1)) - margin
+    y_max = int(np.ceil(y_2[good].max())) + margin
+    
+    x_min, x_max = max(x_min, 0), min(x_max, nx_2)
+    y_min, y_max = max(y_min, 0), min(y_max, ny_2)
+    if x_min >= x_max or y_min >= y_max:
+        return None
+    
+    return x_min, x_max, y_min, y_max
+
+def skyFootprint(hdr, wcs_hdr, n_edge=16):
+    """
+    Determine the footprint of a CCD frame on the sky as a polygon
+    
+    Parameters
+    ----------
+    hdr : astropy Header object
+        FITS header for the HDU, containing transformation coefficients
+        to detector coordinates
+    wcs_hdr : astropy Header object
+        FITS header containing the WCS solution
+    n_edge : int, optional
+        Number of vertices along each edge of the frame
+        Default = 16
+    
+    Returns
+    -------
+    ra, dec : array-like
+        World coords of the polygon vertices, in order around the 
+        perimeter of the frame
+    """
+    nx, ny = hdr['NAXIS1'], hdr['NAXIS2']
+    
+    # walk the frame edges anticlockwise in pixel space
+    t = np.linspace(0., 1., n_edge, endpoint=False)
+    x = np.concatenate([0.5 + nx*t, np.full(n_edge, nx + 0.5),
+                        nx + 0.5 - nx*t, np.full(n_edge, 0.5)])
+    y = np.concatenate([np.full(n_edge, 0.5), 0.5 + ny*t,
+                        np.full(n_edge, ny + 0.5), ny + 0.5 - ny*t])
+    
+    x_det, y_det = convertToDetector(x, y, hdr)
+    ra, dec = convertToWCS(x_det, y_det, wcs_hdr)
+    
+    return ra, dec
+
+def footprintOverlap(hdr_1, wcs_1, wcs_2, hdr_2, n_edge=16):
+    """
+    Intersect the sky footprints of two CCD frames
+    
+    The footprints are projected onto a common tangent plane, centred
+    on frame 1, and intersected there
+    
+    Parameters
+    ----------
+    hdr_1, hdr_2 : astropy Header object
+        FITS headers for the HDUs, containing transformation 
+        coefficients to detector coordinates
+    wcs_1, wcs_2 : astropy Header object
+        FITS headers containing the WCS solutions
+    n_edge : int, optional
+        Number of vertices along each edge of the frames
+        Default = 16
+    
+    Returns
+    -------
+    ra, dec : array-like
+        World coords of the vertices of the overlap polygon - empty if
+        the frames do not overlap
+    """
+    ra_1, dec_1 = skyFootprint(hdr_1, wcs_1, n_edge=n_edge)
+    ra_2, dec_2 = skyFootprint(hdr_2, wcs_2, n_edge=n_edge)
+    
+    # tangent point at the mean position of frame 1
+    vec = _unitVector(ra_1, dec_1).mean(axis=0)
+    ra_0 = np.degrees(np.arctan2(vec[1], vec[0]))
+    dec_0 = np.degrees(np.arctan2(vec[2], np.hypot(vec[0], vec[1])))
+    
+    xi_1, eta_1 = _toTangentPlane(ra_1, dec_1, ra_0, dec_0)
+    xi_2, eta_2 = _toTangentPlane(ra_2, dec_2, ra_0, dec_0)
+    
+    # the rest of frame 2 is behind the tangent plane
+    if not (np.isfinite(xi_2).all() and np.isfinite(eta_2).all()):
+        return np.array([]), np.array([])
+    
+    xi, eta = clipPolygon(xi_1, eta_1, xi_2, eta_2)
+    if len(xi) < 3:
+        return np.array([]), np.array([])
+    
+    return _fromTangentPlane(xi, eta, ra_0, dec_0)
+
+def clipPolygon(x, y, clip_x, clip_y):
+    """
+    Clip a polygon to a convex polygon (Sutherland-Hodgman)
+    
+    Parameters
+    ----------
+    x, y : array-like
+        Vertices of the polygon to be clipped
+    clip_x, clip_y : array-like
+        Vertices of the convex clipping polygon, in either order
+    
+    Returns
+    -------
+    x, y : array-like
+        Vertices of the clipped polygon - empty if the polygons do not
+        intersect
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    clip_x = np.asarray(clip_x, dtype=np.float64)
+    clip_y = np.asarray(clip_y, dtype=np.float64)
+    
+    # inside is to the left of each edge, so clip anticlockwise
+    if polygonArea(clip_x, clip_y) < 0:
+        clip_x, clip_y = clip_x[::-1], clip_y[::-1]
+    
+    for ax, ay, bx, by in zip(clip_x, clip_y, 
+                              np.roll(clip_x, -1), np.roll(clip_y, -1)):
+        if len(x) == 0:
+            break
+        ex, ey = bx - ax, by - ay
+        inside = ex*(y - ay) - ey*(x - ax) >= 0
+        
+        # each edge of the subject runs from the previous vertex (s)
+        sx, sy, s_in = np.roll(x, 1), np.roll(y, 1), np.roll(inside, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((ex*(sy - ay) - ey*(sx - ax)) / 
+                 (ey*(x - sx) - ex*(y - sy)))
+        ix, iy = sx + t*(x - sx), sy + t*(y - sy)
+        
+        # keep the crossing point where an edge crosses the boundary,
+        # then the end vertex if it is inside
+        keep = np.column_stack([s_in != inside, inside]).ravel()
+        x = np.column_stack([ix, x]).ravel()[keep]
+        y = np.column_stack([iy, y]).ravel()[keep]
+    
+    return x, y
+
+def polygonArea(x, y):
+    """
+    Signed area of a polygon - positive if anticlockwise
+    
+    Parameters
+    ----------
+    x, y : array-like
+        Vertices of the polygon
+    
+    Returns
+    -------
+    area : float
+        Signed area of the polygon
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    
+    return 0.5 * np.sum(x*np.roll(y, -1) - np.roll(x, -1)*y)
+
+def pointsInPolygon(x, y, poly_x, poly_y):
+    """
+    Test which points lie inside a polygon (even-odd rule)
+    
+    Parameters
+    ----------
+    x, y : array-like
+        Positions of the points to test
+    poly_x, poly_y : array-like
+        Vertices of the polygon
+    
+    Returns
+    -------
+    inside : array-like
+        Boolean mask, True for points inside the polygon
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros(x.shape, dtype=bool)
+    
+    for ax, ay, bx, by in zip(poly_x, poly_y, 
+                              np.roll(poly_x, -1), np.roll(poly_y, -1)):
+        if ay == by:
+            continue
+        crosses = (ay > y) != (by > y)
+        x_cross = ax + (y - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (x < x_cross)
+    
+    return inside
+
+def _unitVector(ra, dec):
+    """
+    Cartesian unit vectors for world coords in degrees
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    
+    return np.column_stack([np.cos(dec)*np.cos(ra),
+                            np.cos(dec)*np.sin(ra),
+                            np.sin(dec)])
+
+def _toTangentPlane(ra, dec, ra_0, dec_0):
+    """
+    Gnomonic projection of world coords about (ra_0, dec_0), all in
+    degrees - points more than 90 degrees away map to nan
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra_0, dec_0 = np.radians(ra_0), np.radians(dec_0)
+    
+    cos_c = (np.sin(dec_0)*np.sin(dec) + 
+             np.cos(dec_0)*np.cos(dec)*np.cos(ra - ra_0))
+    cos_c = np.where(cos_c > 0, cos_c, np.nan)
+    xi = np.cos(dec)*np.sin(ra - ra_0) / cos_c
+    eta = (np.cos(dec_0)*np.sin(dec) - 
+           np.sin(dec_0)*np.cos(dec)*np.cos(ra - ra_0)) / cos_c
+    
+    return xi, eta
+
+def _fromTangentPlane(xi, eta, ra_0, dec_0):
+    """
+    Inverse gnomonic projection about (ra_0, dec_0), in degrees
+    """
+    ra_0, dec_0 = np.radians(ra_0), np.radians(dec_0)
+    
+    denom = np.cos(dec_0) - eta*np.sin(dec_0)
+    ra = ra_0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec_0) + eta*np.cos(dec_0), 
+                     np.hypot(xi, denom))
+    
+    return np.degrees(ra) % 360., np.degrees(dec)
+
+class ApproxWCS(object):
+    """
+    Fast approximate pixel <-> world transforms for a distorted WCS 
+    (e.g. SIP or TPV solutions for INT WFC)
+    
+    The exact astropy transforms are evaluated once on two grids - a 
+    pixel grid for pixToWorld and an (ra, dec) grid over the footprint 
+    of the frame for worldToPix - each spaced per axis to about step 
+    pixels. Every grid cell stores the coefficients of its bilinear 
+    interpolant, so bulk queries only index the cell directly and 
+    evaluate a polynomial, with no calls into wcslib, trigonometry or 
+    iterative inversions. RA is interpolated as an offset from the 
+    frame centre, which fails for frames containing a celestial pole.
+    
+    The errors stored in max_error_pix2world and max_error_world2pix 
+    (pixels) come from the bilinear remainder term: within a cell of 
+    unit size the error is at most (max|f_ss| + max|f_tt|) / 8, with 
+    the second derivatives bounded from the second differences at the 
+    cell corners plus twice the nearby third differences. This holds 
+    as long as the transform is smooth on the scale of the grid (the 
+    third derivative varies little from cell to cell). If a tolerance 
+    is given the grids are refined until both are below it.
+    """
+    
+    def __init__(self, hdr, shape=None, step=64, tol=None, max_refine=4):
+        """
+        Build the interpolation grids for a WCS
+        
+        Parameters
+        ----------
+        hdr : astropy Header object or astropy WCS object
+            FITS header containing the WCS solution
+        shape : tuple, optional
+            (ny, nx) shape of the region in which queries will fall
+            Default = None, taken from NAXIS2, NAXIS1 of the header
+        step : float, optional
+            Approximate spacing of the grids, in pixels
+            Default = 64
+        tol : float, optional
+            Required maximum interpolation error in pixels
+            Default = None, no refinement
+        max_refine : int, optional
+            Maximum number of times the grid spacing is halved to reach
+            tol
+            Default = 4
+        
+        Raises
+        ------
+        ValueError
+            If the region size cannot be determined, the frame contains
+            a celestial pole or tol cannot be reached within max_refine
+            refinements
+        """
+        self.wcs = getWCS(hdr)
+        if shape is None:
+            if self.wcs.pixel_shape is None:
+                raise ValueError('Supply the shape of the frame')
+            nx, ny = self.wcs.pixel_shape
+            shape = (ny, nx)
+        self.shape = shape
+        self.celestial = (self.wcs.has_celestial and 
+                          self.wcs.wcs.lng == 0 and 
+                          self.wcs.wcs.lat == 1)
+        
+        # world coords at the centre of the frame
+        centre = self.wcs.all_pix2world([(shape[1] + 1) / 2.], 
+                                        [(shape[0] + 1) / 2.], 1)
+        self.ref = (float(centre[0][0]), float(centre[1][0]))
+        
+        for _ in range(max_refine + 1):
+            self._build(step)
+            if tol is None or max(self.max_error_pix2world, 
+                                  self.max_error_world2pix) <= tol:
+                break
+            step = step / 2.
+        else:
+            raise ValueError('Could not reach tolerance {} pixels, '
+                             'achieved {} pixels'.format(
+                                 tol, 
+                                 max(self.max_error_pix2world, 
+                                     self.max_error_world2pix)))
+    
+    def _offset(self, w1):
+        """
+        First world coord as an offset from the reference, wrapped to 
+        [-180, 180) degrees for celestial coords
+        """
+        w1 = w1 - self.ref[0]
+        if self.celestial:
+            w1 = (w1 + 180.) % 360. - 180.
+        
+        return w1
+    
+    def _build(self, step):
+        """
+        Evaluate the exact transforms on both grids, fill the lookup
+        tables and bound the interpolation errors
+        """
+        ny, nx = self.shape
+        self.step = step
+        
+        # pixel grid aligned with the frame edges, one cell of margin
+        x_g = _gridAxis(0.5, nx + 0.5, step)
+        y_g = _gridAxis(0.5, ny + 0.5, step)
+        x, y = np.meshgrid(x_g, y_g)
+        w1, w2 = self.wcs.all_pix2world(x, y, 1)
+        w1 = self._offset(w1)
+        if self.celestial and (np.abs(np.diff(w1, axis=0)).max() > 180. or 
+                               np.abs(np.diff(w1, axis=1)).max() > 180.):
+            raise ValueError('Frame contains a celestial pole')
+        self._pix = (x_g[0], y_g[0], 
+                     1. / (x_g[1] - x_g[0]), 1. / (y_g[1] - y_g[0]),
+                     _bilinearCoefficients(w1) + 
+                     _bilinearCoefficients(w2))
+        
+        # sky error per cell, converted to pixels with the smallest 
+        # singular value of the local Jacobian
+        e1, e2 = _bilinearError(w1), _bilinearError(w2)
+        cos_dec = np.ones_like(e1)
+        if self.celestial:
+            cos_dec = np.cos(np.radians(np.minimum(
+                np.abs(w2[:-1, :-1]), np.abs(w2[1:, 1:]))))
+        a = np.diff(w1[:-1], axis=1) * cos_dec / (x_g[1] - x_g[0])
+        b = np.diff(w1[:, :-1], axis=0) * cos_dec / (y_g[1] - y_g[0])
+        c = np.diff(w2[:-1], axis=1) / (x_g[1] - x_g[0])
+        d = np.diff(w2[:, :-1], axis=0) / (y_g[1] - y_g[0])
+        s = a**2 + b**2 + c**2 + d**2
+        sigma = np.sqrt((s - np.sqrt(s**2 - 4*(a*d - b*c)**2)) / 2.)
+        error = np.hypot(e1 * cos_dec, e2) / sigma
+        self.max_error_pix2world = float(error[1:-1, 1:-1].max())
+        
+        # world grid over the footprint of the frame, spaced to about 
+        # step pixels along each axis
+        frame = (slice(1, -1), slice(1, -1))
+        scale = np.sqrt(np.abs(a*d - b*c)).min()
+        cos_max = cos_dec.max() if self.celestial else 1.
+        u_g = _gridAxis(w1[frame].min(), w1[frame].max(), 
+                        step * scale / cos_max)
+        v_g = _gridAxis(w2[frame].min(), w2[frame].max(), step * scale)
+        u, v = np.meshgrid(u_g, v_g)
+        px, py = self.wcs.all_world2pix(u + self.ref[0], v, 1, 
+                                        tolerance=1e-10, 
+                                        quiet=True)
+        self._world = (u_g[0], v_g[0], 
+                       1. / (u_g[1] - u_g[0]), 1. / (v_g[1] - v_g[0]),
+                       _bilinearCoefficients(px) + 
+                       _bilinearCoefficients(py))
+        
+        # only cells reaching into the frame (and their neighbours) 
+        # count towards the error
+        def _reaches(p, lo, hi):
+            corners = np.stack([p[:-1, :-1], p[:-1, 1:], 
+                                p[1:, :-1], p[1:, 1:]])
+            return (corners.max(axis=0) >= lo) & (corners.min(axis=0) <= hi)
+        
+        inside = _reaches(px, 0.5, nx + 0.5) & _reaches(py, 0.5, ny + 0.5)
+        near = inside.copy()
+        near[1:] |= inside[:-1]
+        near[:-1] |= inside[1:]
+        near[:, 1:] |= near[:, :-1].copy()
+        near[:, :-1] |= near[:, 1:].copy()
+        error = np.hypot(_bilinearError(px), _bilinearError(py))
+        self.max_error_world2pix = float(error[near].max())
+        
+        # offsets only need wrapping when the grids cross RA = 0
+        self._wrap = self.celestial and (
+            min(w1.min(), u_g[0]) + self.ref[0] < 0. or 
+            max(w1.max(), u_g[-1]) + self.ref[0] >= 360.)
+    
+    @staticmethod
+    def _lookup(table, p, q):
+        """
+        Evaluate the bilinear interpolants of a lookup table at grid
+        positions (p, q), extrapolating from the edge cells outside it
+        """
+        p_0, q_0, p_scale, q_scale, coefficients = table
+        n_q, n_p = coefficients[0].shape
+        
+        # cell indices and positions within the cells
+        fp = (p - p_0) * p_scale
+        fq = (q - q_0) * q_scale
+        ip = fp.astype(np.intp)
+        iq = fq.astype(np.intp)
+        np.clip(ip, 0, n_p - 1, out=ip)
+        np.clip(iq, 0, n_q - 1, out=iq)
+        fp -= ip
+        fq -= iq
+        i = iq * n_p
+        i += ip
+        
+        values = []
+        for k in (0, 4):
+            c_0, c_p, c_q, c_pq = [c.ravel() 
+                                   for c in coefficients[k:k + 4]]
+            f = np.take(c_pq, i)
+            f *= fq
+            f += np.take(c_p, i)
+            f *= fp
+            g = np.take(c_q, i)
+            g *= fq
+            f += g
+            f += np.take(c_0, i)
+            values.append(f)
+        
+        return values
+    
+    def pixToWorld(self, x, y):
+        """
+        Approximate conversion of xy pixel coordinates to world coords
+        
+        Parameters
+        ----------
+        x, y : array-like
+            xy positions in the CCD image (FITS 1-based convention)
+        
+        Returns
+        -------
+        ra, dec : array-like
+            World coords corresponding to input xy coords
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        w1, w2 = self._lookup(self._pix, x, y)
+        w1 += self.ref[0]
+        if self._wrap:
+            w1 %= 360.
+        
+        return w1, w2
+    
+    def worldToPix(self, ra, dec):
+        """
+        Approximate conversion of world coordinates to xy pixel coords
+        
+        Parameters
+        ----------
+        ra, dec : array-like
+            World coords to be converted to pixel coords
+        
+        Returns
+        -------
+        x, y : array-like
+            Pixel coords (FITS 1-based convention) corresponding to 
+            input world coords
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        u = self._offset(ra) if self._wrap else ra - self.ref[0]
+        
+        return self._lookup(self._world, u, dec)
+
+def _gridAxis(start, stop, step):
+    """
+    Evenly spaced nodes covering [start, stop] at a spacing of at most
+    step, with one extra node beyond each end
+    """
+    n = max(int(np.ceil((stop - start) / step)), 1)
+    h = (stop - start) / n if stop > start else step
+    
+    return start + h * np.arange(-1, n + 2)
+
+def _bilinearCoefficients(f):
+    """
+    Coefficients (c_0, c_p, c_q, c_pq) of the bilinear interpolant in 
+    each cell of a grid of node values, with positions p, q in [0, 1) 
+    measured from the lower corner of the cell
+    """
+    c_0 = f[:-1, :-1]
+    c_p = f[:-1, 1:] - c_0
+    c_q = f[1:, :-1] - c_0
+    c_pq = f[1:, 1:] - f[1:, :-1] - c_p
+    
+    return tuple(np.ascontiguousarray(c) for c in (c_0, c_p, c_q, c_pq))
+
+def _bilinearError(f):
+    """
+    Bound on the bilinear interpolation error in each cell of a grid 
+    of node values, from the remainder term (max|f_pp| + max|f_qq|)/8
+    in units of the cell size
+    """
+    def _secondDerivative(f):
+        # |second differences| at the nodes, taken from the nearest 
+        # interior node at the edges
+        d2 = np.abs(f[:, :-2] - 2*f[:, 1:-1] + f[:, 2:])
+        d2 = np.concatenate([d2[:, :1], d2, d2[:, -1:]], axis=1)
+        
+        # |third differences| centred on each cell
+        d3 = np.abs(f[:, 3:] - 3*f[:, 2:-1] + 3*f[:, 1:-2] - f[:, :-3])
+        d3 = np.concatenate([d3[:, :1], d3, d3[:, -1:]], axis=1)
+        
+        # the second differences equal f_pp within a cell of each 
+        # corner, so anywhere in the cell f_pp differs from them by at 
+        # most twice the third derivative
+        m = np.maximum(d2[:, :-1], d2[:, 1:]) + 2*d3
+        
+        return np.maximum(m[:-1], m[1:])
+    
+    return (_secondDerivative(f) + _secondDerivative(f.T).T) / 8.